@@ -1,19 +1,68 @@
-from fastapi import FastAPI, HTTPException
+import os
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient
 from datetime import datetime, timedelta
-import pandas as pd
 from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
+from db_setup import bootstrap
+from hot_state import HotState
+from event_stream import EventBroadcaster
+from rollups import rollup_for, rollup_pipeline
+from downsampling import (EPOCH, bucket_seconds, bucket_pipeline, columns_stage, concat_bucket_rows,
+                          lttb_columns, lttb_rows, rows_to_columns, to_columns, LTTB_OVERSAMPLE)
+import cold_storage
+from response_cache import ResponseCache, json_body, make_etag
+import response_formats
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram, \
+    RequestMetricsMiddleware, StartupClock
 
-# MongoDB connection
-client = MongoClient("mongodb://localhost:27017/")
-db = client["iot_monitoring"]
-sensor_data_collection = db["sensor_data"]
-predictions_collection = db["predictions"]
+# MongoDB connection (async driver, pool shared by all requests in a worker)
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = "iot_monitoring"
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "10"))
+
+# Latest values published by the processor, read before falling back to Mongo
+hot_state = HotState()
+
+# Encoded history responses, revalidated against the newest data timestamp
+response_cache = ResponseCache()
+
+# Set on startup so the client is bound to the server's event loop
+client = None
+db = None
+sensor_data_collection = None
+predictions_collection = None
+broadcaster = None
 
 app = FastAPI(title="IoT Monitoring API")
 
+# Prometheus metrics for this worker, served on /metrics
+REQUEST_SECONDS = Histogram('api_request_seconds', 'Time to response headers by route',
+                            ['route', 'method', 'status'])
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+READINGS_AGGREGATED = Histogram('api_readings_aggregated',
+                                'Readings summarised per history query, by collection read',
+                                ['collection'], buckets=ROW_BUCKETS)
+ROWS_RETURNED = Histogram('api_rows_returned', 'Buckets returned per history query',
+                          ['collection'], buckets=ROW_BUCKETS)
+RESPONSE_CACHE = Counter('api_response_cache_total', 'History responses by cache outcome', ['result'])
+RESPONSE_CACHE.set_function(lambda: response_cache.hits, result='hit')
+RESPONSE_CACHE.set_function(lambda: response_cache.misses, result='miss')
+RESPONSE_CACHE.set_function(lambda: response_cache.not_modified, result='not_modified')
+STREAM_CLIENTS = Gauge('api_stream_clients', 'Connected /api/stream clients')
+STREAM_CLIENTS.set_function(lambda: len(broadcaster.subscribers) if broadcaster else 0)
+STARTUP_SECONDS = Gauge('api_startup_seconds', 'Seconds from worker start to each startup milestone',
+                        ['milestone'])
+
+# imported (startup hook entered), db_ready
+startup = StartupClock(STARTUP_SECONDS)
+
+app.add_middleware(RequestMetricsMiddleware, histogram=REQUEST_SECONDS)
+
 # Enable CORS for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -23,13 +72,90 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+def device_filter(device_id: Optional[str]) -> Dict[str, Any]:
+    """Restrict a query to one device when a device_id is given"""
+    return {"device_id": device_id} if device_id else {}
+
+def prediction_filter(device_id: Optional[str], model_version: Optional[str] = None) -> Dict[str, Any]:
+    """Predictions of one model version, or the live ones.
+
+    replay.py can write predictions alongside the live ones, tagged with
+    alongside=True; they are only read when their version is asked for.
+    """
+    if model_version:
+        return {**device_filter(device_id), "model_version": model_version}
+    return {**device_filter(device_id), "alongside": None}
+
+@app.on_event("startup")
+async def connect_db():
+    global client, db, sensor_data_collection, predictions_collection, broadcaster
+    startup.mark('imported')
+    client = AsyncMongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE,
+                              minPoolSize=MONGO_MIN_POOL_SIZE)
+    db = client[MONGO_DB]
+    sensor_data_collection = db["sensor_data"]
+    predictions_collection = db["predictions"]
+    broadcaster = EventBroadcaster(sensor_data_collection, predictions_collection)
+    
+    # Indexes on timestamp and (device_id, timestamp) for the queries below
+    def create_indexes():
+        with MongoClient(MONGO_URI) as sync_client:
+            bootstrap(sync_client[MONGO_DB])
+    await run_in_threadpool(create_indexes)
+    startup.mark('db_ready')
+    print(f"Startup: {startup.summary()}")
+
+@app.on_event("shutdown")
+async def close_db():
+    if client is not None:
+        await client.close()
+
+async def aggregate(collection, pipeline):
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list(None)
+
+async def latest_with_lookups(device_id, averages_since=None):
+    """Latest reading, latest prediction and optional averages in one round trip.
+
+    The newest sensor_data document is found through the timestamp index and
+    the other lookups are joined onto it with uncorrelated $lookup stages
+    (a leading $facet would scan the whole collection, it cannot use indexes).
+    """
+    pipeline = [
+        {"$match": device_filter(device_id)},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "predictions",
+            "pipeline": [
+                {"$match": prediction_filter(device_id)},
+                {"$sort": {"timestamp": -1}},
+                {"$limit": 1},
+            ],
+            "as": "latest_prediction",
+        }},
+    ]
+    if averages_since is not None:
+        rollup = await rollup_level(60 * 60)
+        pipeline.append({"$lookup": {
+            "from": rollup.name if rollup is not None else "sensor_data",
+            "pipeline": averages_pipeline(averages_since, datetime.now(), device_id,
+                                          from_rollup=rollup is not None),
+            "as": "averages",
+        }})
+    
+    results = await aggregate(sensor_data_collection, pipeline)
+    return results[0] if results else None
+
 class SensorData(BaseModel):
+    device_id: Optional[str] = None
     temperature: float
     humidity: float
     air_quality: float
     timestamp: datetime
 
 class PredictionData(BaseModel):
+    device_id: Optional[str] = None
     temperature_pred: float
     humidity_pred: float
     air_quality_pred: float
@@ -41,99 +167,320 @@ class PredictionData(BaseModel):
     timestamp: datetime
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "IoT Monitoring API is running"}
 
-@app.get("/api/latest-data")
-def get_latest_data():
-    # Get latest sensor readings
-    latest_sensor = sensor_data_collection.find_one(
-        sort=[("timestamp", -1)]  # Sort by timestamp descending
-    )
+async def hot_latest(device_id):
+    """hot_state.latest without blocking the event loop on a networked store"""
+    if hot_state.store.blocking:
+        return await run_in_threadpool(hot_state.latest, device_id)
+    return hot_state.latest(device_id)
+
+def prediction_devices(prediction):
+    """Device states recorded with a prediction document"""
+    return {name: prediction[f"{name}_state"] for name in ("ac", "purifier", "dehumidifier")}
+
+async def latest_state(device_id, averages_since=None):
+    """(sensor, prediction, devices, averages) for the newest reading.
+
+    Served from the processor's hot state when it is fresh; Mongo is only
+    queried when the cache is cold. sensor is None when no data exists;
+    devices is None when no device states are known.
+    """
+    state = await hot_latest(device_id)
+    if state is not None and state.get("sensor"):
+        averages = None
+        if averages_since is not None:
+            rollup = await rollup_level(60 * 60)
+            averages = await aggregate(
+                rollup if rollup is not None else sensor_data_collection,
+                averages_pipeline(averages_since, datetime.now(), device_id,
+                                  from_rollup=rollup is not None))
+        return state["sensor"], state.get("prediction"), state.get("devices"), averages
     
+    latest_sensor = await latest_with_lookups(device_id, averages_since)
     if not latest_sensor:
-        raise HTTPException(status_code=404, detail="No sensor data found")
+        return None, None, None, None
     
     # Convert ObjectId to string for JSON serialization
     latest_sensor["_id"] = str(latest_sensor["_id"])
+    predictions = latest_sensor.pop("latest_prediction")
+    latest_prediction = predictions[0] if predictions else None
+    if latest_prediction:
+        latest_prediction["_id"] = str(latest_prediction["_id"])
+    averages = latest_sensor.pop("averages", None)
+    devices = prediction_devices(latest_prediction) if latest_prediction else None
+    return latest_sensor, latest_prediction, devices, averages
+
+@app.get("/api/latest-data")
+async def get_latest_data(device_id: Optional[str] = None):
+    # Get latest sensor reading and prediction together
+    latest_sensor, latest_prediction, devices, _ = await latest_state(device_id)
     
-    # Get latest prediction
-    latest_prediction = predictions_collection.find_one(
-        sort=[("timestamp", -1)]
-    )
+    if not latest_sensor:
+        raise HTTPException(status_code=404, detail="No sensor data found")
     
     if not latest_prediction:
-        # If no prediction exists, use current values as prediction
+        # If no prediction exists, use current values as prediction and
+        # the processor's device states when it has them
+        devices = devices or {"ac": "OFF", "purifier": "OFF", "dehumidifier": "OFF"}
         latest_prediction = {
             "temperature_pred": latest_sensor["temperature"],
             "humidity_pred": latest_sensor["humidity"],
             "air_quality_pred": latest_sensor["air_quality"],
             "comfort_level": "comfortable",  # Default
             "comfort_reasons": [],
-            "ac_state": "OFF",
-            "purifier_state": "OFF",
-            "dehumidifier_state": "OFF",
+            "ac_state": devices["ac"],
+            "purifier_state": devices["purifier"],
+            "dehumidifier_state": devices["dehumidifier"],
             "timestamp": latest_sensor["timestamp"]
         }
-    else:
-        # Convert ObjectId to string for JSON serialization
-        latest_prediction["_id"] = str(latest_prediction["_id"])
     
     # Combine sensor data and prediction data
     combined_data = {**latest_sensor, **latest_prediction}
     
     return combined_data
 
-@app.get("/api/historical-data")
-def get_historical_data(hours: int = 24):
-    """Get historical sensor data for charts"""
-    end_time = datetime.now()
-    start_time = end_time - timedelta(hours=hours)
+SENSOR_FIELDS = ["temperature", "humidity", "air_quality"]
+PREDICTION_FIELDS = ["temperature_pred", "humidity_pred", "air_quality_pred"]
+PREDICTION_LAST_FIELDS = ["comfort_level", "comfort_reasons", "ac_state",
+                          "purifier_state", "dehumidifier_state", "model_version"]
+
+# Rollup collections known to hold data; once populated they stay populated
+populated_rollups = set()
+
+async def rollup_level(bucket_s):
+    """Rollup collection to read for a bucket width, if one fits and is populated"""
+    level = rollup_for(bucket_s)
+    if level is None:
+        return None
+    name = level[0]
+    if name not in populated_rollups:
+        if await db[name].estimated_document_count() == 0:
+            return None
+        populated_rollups.add(name)
+    return db[name]
+
+def averages_pipeline(start_time, end_time, device_id, from_rollup):
+    """Average of each field over a range, from hourly rollups or raw data"""
+    if from_rollup:
+        return [
+            {"$match": {"bucket": {"$gte": start_time, "$lte": end_time}, **device_filter(device_id)}},
+            {"$group": {
+                "_id": None,
+                "count": {"$sum": "$count"},
+                "temperature_sum": {"$sum": "$temperature_sum"},
+                "humidity_sum": {"$sum": "$humidity_sum"},
+                "air_quality_sum": {"$sum": "$air_quality_sum"},
+            }},
+            {"$project": {
+                "_id": 0,
+                "avg_temperature": {"$divide": ["$temperature_sum", "$count"]},
+                "avg_humidity": {"$divide": ["$humidity_sum", "$count"]},
+                "avg_air_quality": {"$divide": ["$air_quality_sum", "$count"]},
+            }}
+        ]
+    return [
+        {"$match": {"timestamp": {"$gte": start_time, "$lte": end_time}, **device_filter(device_id)}},
+        {"$group": {
+            "_id": None,
+            "avg_temperature": {"$avg": "$temperature"},
+            "avg_humidity": {"$avg": "$humidity"},
+            "avg_air_quality": {"$avg": "$air_quality"},
+        }},
+        {"$project": {"_id": 0}}
+    ]
+
+def history_bucket_seconds(start_time, end_time, points, resolution, mode):
+    """Width of the Mongo buckets behind a history response"""
+    if mode not in ("minmax", "lttb"):
+        raise HTTPException(status_code=400, detail="mode must be 'minmax' or 'lttb'")
     
-    # Query MongoDB for data in the specified time range
-    cursor = sensor_data_collection.find({
-        "timestamp": {"$gte": start_time, "$lte": end_time}
-    }).sort("timestamp", 1)  # Sort by timestamp ascending
+    # LTTB picks its points out of a finer set of buckets
+    bucket_points = points * LTTB_OVERSAMPLE if mode == "lttb" else points
+    return bucket_seconds(start_time, end_time, bucket_points, resolution)
+
+def column_names(fields, last_fields):
+    names = ["timestamp", "count"]
+    for field in fields:
+        names += [field, f"{field}_min", f"{field}_max"]
+    return names + list(last_fields)
+
+async def downsample(collection, start_time, end_time, device_id, fields, last_fields,
+               points, bucket_s, mode, use_rollups=False, columnar=False, match=None):
+    """Bucket a time range in MongoDB and return one row per bucket.
+
+    With columnar=True Mongo also pivots the buckets into one array per
+    column and a dict of NumPy arrays is returned instead of rows.
+    use_rollups is only set for sensor_data, which is also the collection
+    with archived days. match replaces device_filter(device_id) for the
+    raw documents.
+    """
+    # Sensor data is read from the coarsest rollup that still fits the bucket
+    rollup = await rollup_level(bucket_s) if use_rollups else None
+    archived = []
+    if rollup is not None:
+        match = {"bucket": {"$gte": start_time, "$lte": end_time}, **device_filter(device_id)}
+        collection, pipeline = rollup, rollup_pipeline(match, bucket_s)
+    else:
+        # Rollups cover archived days too; raw sensor data before the archive
+        # boundary is bucketed from Parquet instead (see cold_storage)
+        hot_start = start_time
+        archive_end = cold_storage.boundary() if use_rollups else None
+        if archive_end is not None and start_time < archive_end:
+            archived = await run_in_threadpool(cold_storage.bucket_rows, start_time,
+                                               min(end_time, archive_end), device_id, fields, bucket_s)
+            hot_start = archive_end
+        match = {"timestamp": {"$gte": hot_start, "$lte": end_time},
+                 **(device_filter(device_id) if match is None else match)}
+        pipeline = bucket_pipeline(match, fields, bucket_s, last_fields)
     
-    data = []
-    for doc in cursor:
-        doc["_id"] = str(doc["_id"])  # Convert ObjectId to string
-        data.append(doc)
+    if archived:
+        data = concat_bucket_rows(archived, await aggregate(collection, pipeline), fields)
+        READINGS_AGGREGATED.observe(sum(row["count"] for row in data), collection=collection.name)
+        ROWS_RETURNED.observe(len(data), collection=collection.name)
+        if columnar:
+            names = column_names(fields, last_fields)
+            data = rows_to_columns(data, names, set(names) - set(last_fields))
+            return lttb_columns(data, fields, points) if mode == "lttb" else data
+        return lttb_rows(data, fields, points) if mode == "lttb" else data
     
-    # If there's too much data for the chart, reduce it by sampling
-    if len(data) > 100:
-        # Perform basic sampling by taking every Nth record
-        sampling_rate = len(data) // 100
-        data = data[::sampling_rate]
+    if columnar:
+        names = column_names(fields, last_fields)
+        docs = await aggregate(collection, pipeline + [columns_stage(names)])
+        numeric = set(names) - set(last_fields)
+        data = to_columns(docs[0] if docs else None, names, numeric)
+        READINGS_AGGREGATED.observe(int(data["count"].sum()), collection=collection.name)
+        ROWS_RETURNED.observe(len(data["count"]), collection=collection.name)
+        if mode == "lttb":
+            data = lttb_columns(data, fields, points)
+        return data
     
+    data = await aggregate(collection, pipeline)
+    READINGS_AGGREGATED.observe(sum(row["count"] for row in data), collection=collection.name)
+    ROWS_RETURNED.observe(len(data), collection=collection.name)
+    if mode == "lttb":
+        data = lttb_rows(data, fields, points)
     return data
 
-@app.get("/api/comfort-history")
-def get_comfort_history(days: int = 7):
-    """Get historical comfort levels for analysis"""
+def response_format(request, format):
+    try:
+        return response_formats.negotiate(format, request.headers.get("accept"))
+    except response_formats.UnsupportedFormat as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+async def encoded_history(fmt, *args, **kwargs):
+    """Downsampled history encoded as rows JSON or one of the columnar formats"""
+    if fmt == "rows":
+        return json_body(await downsample(*args, **kwargs))
+    columns = await downsample(*args, columnar=True, **kwargs)
+    return response_formats.encode_columns(fmt, columns)
+
+async def newest_timestamp(collection, device_id):
+    """Timestamp of the newest document, read from the index alone"""
+    newest = await collection.find_one(
+        device_filter(device_id),
+        projection={"_id": 0, "timestamp": 1},
+        sort=[("timestamp", -1)]
+    )
+    return newest["timestamp"] if newest else None
+
+async def newest_replay(collection):
+    """When replay.py last wrote predictions, read from the sparse replayed_at index"""
+    newest = await collection.find_one(
+        {"replayed_at": {"$exists": True}},
+        projection={"_id": 0, "replayed_at": 1},
+        sort=[("replayed_at", -1)]
+    )
+    return newest["replayed_at"] if newest else None
+
+async def cached_history(request, key, collection, device_id, start_time, bucket_s, build,
+                         fmt="rows", replayed=False):
+    """Serve a history response with ETag/Last-Modified and the response cache.
+
+    The ETag covers the query, the newest timestamp in the collection and the
+    bucket the window starts in, so it changes when data is ingested or when
+    the window slides into the next bucket. Unchanged data costs one indexed
+    find_one instead of an aggregation. replayed=True also covers the last
+    replay.py run, which rewrites history without moving the newest timestamp.
+    """
+    newest = await newest_timestamp(collection, device_id)
+    window = int((start_time - EPOCH).total_seconds() // bucket_s)
+    replayed_at = await newest_replay(collection) if replayed else None
+    etag = make_etag(key, newest, window, replayed_at)
+    modified = max((t for t in (newest, replayed_at) if t is not None), default=None)
+    return await response_cache.respond(request, key, etag, modified, build,
+                                        response_formats.MEDIA_TYPES[fmt])
+
+@app.get("/api/historical-data")
+async def get_historical_data(request: Request, hours: int = 24, device_id: Optional[str] = None,
+                        points: int = Query(100, ge=1, le=10000),
+                        resolution: Optional[int] = Query(None, ge=1),
+                        mode: str = "minmax", format: Optional[str] = None):
+    """Get historical sensor data for charts.
+
+    Readings are averaged into time buckets (about `points` of them, or
+    `resolution` seconds wide) with min/max per bucket so spikes survive.
+    mode=lttb thins finer buckets with Largest-Triangle-Three-Buckets.
+    format (or Accept) selects rows JSON, columnar JSON, Arrow or MessagePack.
+    """
     end_time = datetime.now()
-    start_time = end_time - timedelta(days=days)
+    start_time = end_time - timedelta(hours=hours)
+    bucket_s = history_bucket_seconds(start_time, end_time, points, resolution, mode)
+    fmt = response_format(request, format)
     
-    cursor = predictions_collection.find({
-        "timestamp": {"$gte": start_time, "$lte": end_time}
-    }).sort("timestamp", 1)
+    async def build():
+        return await encoded_history(fmt, sensor_data_collection, start_time, end_time, device_id,
+                                     SENSOR_FIELDS, (), points, bucket_s, mode, use_rollups=True)
     
-    data = []
-    for doc in cursor:
-        doc["_id"] = str(doc["_id"])
-        data.append(doc)
+    key = ("historical-data", hours, device_id, points, resolution, mode, fmt)
+    return await cached_history(request, key, sensor_data_collection, device_id,
+                                start_time, bucket_s, build, fmt)
+
+@app.get("/api/comfort-history")
+async def get_comfort_history(request: Request, days: int = 7, device_id: Optional[str] = None,
+                        points: int = Query(100, ge=1, le=10000),
+                        resolution: Optional[int] = Query(None, ge=1),
+                        mode: str = "minmax", format: Optional[str] = None,
+                        model_version: Optional[str] = None):
+    """Get historical comfort levels for analysis.
+
+    Predictions are bucketed like /api/historical-data; comfort level and
+    device states are the last values seen in each bucket. model_version
+    selects one model's predictions, including those replayed alongside the
+    live ones (see replay.py).
+    """
+    end_time = datetime.now()
+    start_time = end_time - timedelta(days=days)
+    bucket_s = history_bucket_seconds(start_time, end_time, points, resolution, mode)
+    fmt = response_format(request, format)
     
-    # If there's too much data, sample it
-    if len(data) > 100:
-        sampling_rate = len(data) // 100
-        data = data[::sampling_rate]
+    async def build():
+        return await encoded_history(fmt, predictions_collection, start_time, end_time, device_id,
+                                     PREDICTION_FIELDS, PREDICTION_LAST_FIELDS, points, bucket_s, mode,
+                                     match=prediction_filter(device_id, model_version))
     
-    return data
+    key = ("comfort-history", days, device_id, points, resolution, mode, fmt, model_version)
+    return await cached_history(request, key, predictions_collection, device_id,
+                                start_time, bucket_s, build, fmt, replayed=True)
+
+@app.get("/api/devices")
+async def list_devices():
+    """List the device ids that have reported sensor data"""
+    return sorted(await sensor_data_collection.distinct("device_id"))
 
 @app.get("/api/device-status")
-def get_device_status():
+async def get_device_status(device_id: Optional[str] = None):
     """Get current status of all devices"""
-    latest_prediction = predictions_collection.find_one(
+    state = await hot_latest(device_id)
+    if state is not None and state.get("devices"):
+        return {
+            **state["devices"],
+            "last_updated": state["sensor"]["timestamp"]
+        }
+    
+    latest_prediction = await predictions_collection.find_one(
+        prediction_filter(device_id),
         sort=[("timestamp", -1)]
     )
     
@@ -153,37 +500,15 @@ def get_device_status():
     }
 
 @app.get("/api/dashboard-summary")
-def get_dashboard_summary():
+async def get_dashboard_summary(device_id: Optional[str] = None):
     """Get a summary of all data for the dashboard"""
-    # Get latest sensor readings
-    latest_sensor = sensor_data_collection.find_one(
-        sort=[("timestamp", -1)]
-    )
+    # Latest reading, latest prediction and 24-hour averages
+    latest_sensor, latest_prediction, devices, averages = await latest_state(
+        device_id, averages_since=datetime.now() - timedelta(hours=24))
     
     if not latest_sensor:
         raise HTTPException(status_code=404, detail="No sensor data found")
     
-    # Get latest prediction
-    latest_prediction = predictions_collection.find_one(
-        sort=[("timestamp", -1)]
-    )
-    
-    # Get 24-hour averages
-    end_time = datetime.now()
-    start_time = end_time - timedelta(hours=24)
-    
-    pipeline = [
-        {"$match": {"timestamp": {"$gte": start_time, "$lte": end_time}}},
-        {"$group": {
-            "_id": None,
-            "avg_temperature": {"$avg": "$temperature"},
-            "avg_humidity": {"$avg": "$humidity"},
-            "avg_air_quality": {"$avg": "$air_quality"},
-        }}
-    ]
-    
-    averages = list(sensor_data_collection.aggregate(pipeline))
-    
     # Format the response
     return {
         "current": {
@@ -198,13 +523,41 @@ def get_dashboard_summary():
             "avg_humidity": latest_sensor["humidity"],
             "avg_air_quality": latest_sensor["air_quality"],
         },
-        "devices": {
-            "ac": latest_prediction["ac_state"] if latest_prediction else "OFF",
-            "purifier": latest_prediction["purifier_state"] if latest_prediction else "OFF",
-            "dehumidifier": latest_prediction["dehumidifier_state"] if latest_prediction else "OFF",
-        }
+        "devices": devices or {"ac": "OFF", "purifier": "OFF", "dehumidifier": "OFF"},
     }
 
+@app.get("/api/stream")
+async def stream_events(request: Request, device_id: Optional[str] = None,
+                        since: Optional[str] = None):
+    """Server-Sent Events feed of new readings, predictions and device-state changes.
+
+    One poller per worker feeds every client. Slow clients lose their oldest
+    buffered events rather than holding up the others. Pass `since` (ISO
+    timestamp), or reconnect with Last-Event-ID, to replay what was missed.
+    """
+    resume_from = since or request.headers.get("last-event-id")
+    since_time = None
+    if resume_from:
+        try:
+            since_time = datetime.fromisoformat(resume_from)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be an ISO timestamp")
+        # Stored timestamps are naive local time; clients may send UTC ("...Z")
+        if since_time.tzinfo is not None:
+            since_time = since_time.astimezone().replace(tzinfo=None)
+    
+    subscriber = broadcaster.subscribe(device_id)
+    return StreamingResponse(
+        broadcaster.stream(subscriber, since_time),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics for this worker process"""
+    return Response(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
+
 if __name__ == "__main__":
     import uvicorn
     # Start the API server on port 8000
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import deque
+
+from pymongo.errors import BulkWriteError
+
+
+class BatchWriter:
+    """Write-behind buffer that flushes documents with insert_many.
+
+    Documents are queued by add() and written in a background thread once
+    either max_batch documents are waiting or max_delay seconds have passed
+    since the first queued document. after_flush, if given, is called with
+    the documents of each batch that were written.
+
+    When a flush fails (MongoDB unreachable, a timeout) the batch goes back
+    to the front of the buffer and is retried after a backoff that doubles
+    up to max_retry_delay seconds. At most max_buffer documents are held;
+    beyond that the oldest are dropped and counted in `dropped`. Documents
+    rejected individually (a BulkWriteError) are not retried.
+    """
+
+    def __init__(self, collection, max_batch=500, max_delay=1.0, name=None,
+                 after_flush=None, max_buffer=100000, max_retry_delay=30.0):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.name = name or collection.name
+        self.after_flush = after_flush
+        self.max_buffer = max_buffer
+        self.max_retry_delay = max_retry_delay
+
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._first_queued = None
+        # After a failed flush, no automatic flush before this (monotonic)
+        self._retry_at = 0.0
+        self._retry_delay = 0.0
+        self._running = False
+        self._thread = None
+
+        # Counters
+        self.docs_written = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.hook_errors = 0
+        self.dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name=f"batch-writer-{self.name}", daemon=True)
+        self._thread.start()
+
+    def add(self, doc):
+        with self._lock:
+            if not self._buffer:
+                self._first_queued = time.monotonic()
+            if len(self._buffer) == self._buffer.maxlen:
+                # The deque drops the oldest document to make room
+                self.dropped += 1
+            self._buffer.append(doc)
+            if len(self._buffer) >= self.max_batch:
+                self._wakeup.notify()
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def _take_batch(self):
+        with self._lock:
+            batch = list(self._buffer)
+            self._buffer.clear()
+            self._first_queued = None
+        return batch
+
+    def _requeue(self, batch):
+        """Put a failed batch back in front of newer documents, within max_buffer"""
+        with self._lock:
+            room = self._buffer.maxlen - len(self._buffer) if self._buffer.maxlen else len(batch)
+            if room < len(batch):
+                # The batch is older than anything buffered, so its head goes first
+                self.dropped += len(batch) - room
+                batch = batch[len(batch) - room:]
+            self._buffer.extendleft(reversed(batch))
+            if self._buffer:
+                self._first_queued = time.monotonic()
+            self._retry_delay = min(max(self._retry_delay * 2, self.max_delay), self.max_retry_delay)
+            self._retry_at = time.monotonic() + self._retry_delay
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._running and not self._due():
+                    self._wakeup.wait(timeout=self._time_to_deadline())
+                if not self._running:
+                    return
+            self.flush()
+
+    def _due(self):
+        if not self._buffer:
+            return False
+        if time.monotonic() < self._retry_at:
+            return False
+        if len(self._buffer) >= self.max_batch:
+            return True
+        return time.monotonic() - self._first_queued >= self.max_delay
+
+    def _time_to_deadline(self):
+        if not self._buffer:
+            return self.max_delay
+        now = time.monotonic()
+        return max(0.0, self._retry_at - now,
+                   self.max_delay - (now - self._first_queued))
+
+    def flush(self):
+        """Write everything currently buffered. Safe to call from any thread."""
+        with self._flush_lock:
+            batch = self._take_batch()
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            inserted = batch
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # With ordered=False the rest of the batch is still written
+                self.flush_errors += 1
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                inserted = [doc for i, doc in enumerate(batch) if i not in failed]
+                print(f"[{self.name}] bulk insert failed for {len(failed)} documents")
+            except Exception as e:
+                # Nothing is known to be written; insert_many set each _id,
+                # so a retry cannot store a document twice
+                self.flush_errors += 1
+                inserted = []
+                self._requeue(batch)
+                print(f"[{self.name}] flush failed, {len(batch)} documents requeued: {e}")
+            else:
+                with self._lock:
+                    self._retry_delay, self._retry_at = 0.0, 0.0
+            written = len(inserted)
+            latency = time.perf_counter() - start
+
+            self.docs_written += written
+            self.flush_count += 1
+            self.last_flush_latency = latency
+            self.total_flush_latency += latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+
+            if inserted and self.after_flush is not None:
+                try:
+                    self.after_flush(inserted)
+                except Exception as e:
+                    self.hook_errors += 1
+                    print(f"[{self.name}] after_flush failed: {e}")
+            return written
+
+    def stop(self):
+        """Stop the background thread and flush whatever is left."""
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        avg_latency = (self.total_flush_latency / self.flush_count
+                       if self.flush_count else 0.0)
+        return {
+            'queue_depth': self.queue_depth(),
+            'docs_written': self.docs_written,
+            'flush_count': self.flush_count,
+            'flush_errors': self.flush_errors,
+            'hook_errors': self.hook_errors,
+            'dropped': self.dropped,
+            'last_flush_latency': self.last_flush_latency,
+            'avg_flush_latency': avg_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
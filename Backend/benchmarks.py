@@ -0,0 +1,465 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from data_loader import SENSOR_FIELDS, training_arrays
+from memory_mongo import ColumnarDatabase
+from replay import comfort_columns
+from rollups import ROLLUP_LEVELS
+from synthetic_data import generate as generate_synthetic
+
+BASELINE_PATH = 'benchmarks_baseline.json'
+# A case fails when its best round is this much slower than the baseline's.
+# The best round is the least disturbed by other load on the machine.
+DEFAULT_THRESHOLD = 0.25
+
+# Documents per collection for the API cases, and training rows for the fit cases
+API_SIZES = (1_000, 100_000, 10_000_000)
+FIT_SIZES = (1_000, 10_000, 100_000)
+
+# Rounds per case; each round times `number` calls and reports the mean
+REPEAT = 7
+FIT_REPEAT = 2
+
+# API data covers the default /api/comfort-history window
+API_DAYS = 7
+# Most readings per simulated device; larger sizes add devices
+MAX_ROWS_PER_DEVICE = 100_000
+
+GROUPS = ('processor', 'training', 'api')
+
+
+class Case:
+    """One timed call. fn takes no arguments; setup has already run."""
+
+    def __init__(self, name, fn, number=1, repeat=REPEAT, warmup=1):
+        self.name = name
+        self.fn = fn
+        self.number = number
+        self.repeat = repeat
+        self.warmup = warmup
+
+
+def measure(case):
+    """Seconds per call for each round"""
+    for _ in range(case.warmup):
+        case.fn()
+    rounds = []
+    for _ in range(case.repeat):
+        start = time.perf_counter()
+        for _ in range(case.number):
+            case.fn()
+        rounds.append((time.perf_counter() - start) / case.number)
+    return rounds
+
+
+def summarize(rounds, case):
+    seconds = np.asarray(rounds)
+    return {
+        'median_s': float(np.median(seconds)),
+        'min_s': float(seconds.min()),
+        'p95_s': float(np.percentile(seconds, 95)),
+        'rounds': len(rounds),
+        'number': case.number,
+    }
+
+
+def machine_info():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+    }
+
+
+# --- Processor hot path: prediction and comfort rules ---
+
+def benchmark_models(seed):
+    """Scaler and three 100-tree forests, fitted like train_models.py does.
+
+    Fixed seeds keep the forests, and with them the timings, the same from
+    run to run; models on disk change with every retrain.
+    """
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.preprocessing import StandardScaler
+
+    columns, _ = generate_synthetic(days=5, interval=600, seed=seed)
+    features, targets = training_arrays(columns)
+    scaler = StandardScaler()
+    scaled = scaler.fit_transform(features)
+    models = [RandomForestRegressor(n_estimators=100, random_state=seed).fit(scaled, targets[:, i])
+              for i in range(targets.shape[1])]
+    return models, scaler
+
+
+def processor_cases(seed):
+    import mqtt_processor as mp
+    import train_models
+    from inference_engine import legacy_heads
+    from model_bundle import ModelBundle
+
+    from feature_store import FeatureStore
+
+    (temp_model, humid_model, air_model), scaler = benchmark_models(seed)
+    mp.set_current_bundle(ModelBundle('benchmark', legacy_heads(temp_model, humid_model, air_model),
+                                      scaler))
+    reading = {'temperature': 24.5, 'humidity': 55.0, 'air_quality': 520.0}
+
+    # Six hours of 10-second readings, so every window is full
+    store = FeatureStore()
+    started = datetime(2024, 1, 1, 8)
+    for i in range(6 * 360):
+        store.update('bench', started + timedelta(seconds=10 * i), reading)
+    features = store.update('bench', started + timedelta(hours=6), reading)
+    clock = iter(started + timedelta(hours=6, seconds=i) for i in itertools.count())
+
+    yield Case('FeatureStore.update', lambda: store.update('bench', next(clock), reading), number=1000)
+    yield Case('predict_values', lambda: mp.predict_values(features), number=200)
+    yield Case('train_models.infer_on_new_data',
+               lambda: train_models.infer_on_new_data(24.5, 55.0, 520.0, 14, 2, temp_model,
+                                                      humid_model, air_model, scaler),
+               number=200)
+    # Uncomfortable on every rule, so every branch runs
+    yield Case('determine_comfort_level',
+               lambda: mp.determine_comfort_level(29.5, 70.0, 750.0), number=10_000)
+
+
+# --- Model fitting as the training set grows ---
+
+def training_columns(rows, seed):
+    """Synthetic readings giving about `rows` training rows (10-minute spacing)"""
+    interval = 600
+    devices = max(1, rows // 10_000)
+    days = (rows / devices + 6) * interval / 86400
+    columns, _ = generate_synthetic(devices=devices, days=days, interval=interval, seed=seed)
+    return columns
+
+
+@contextlib.contextmanager
+def scratch_directory():
+    """Run in a temp directory with a models/ folder, so fits never touch real models"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='iot-bench-') as directory:
+        os.makedirs(os.path.join(directory, 'models'))
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
+
+
+def training_cases(sizes, seed):
+    import train_models
+    from model_bundle import train_bundle
+
+    for rows in sizes:
+        columns = training_columns(rows, seed)
+        features, targets = training_arrays(columns)
+        df = train_models.preprocess_data(columns)
+
+        def fit_bundle(features=features, targets=targets):
+            # What update_ml_models runs in its worker process
+            with scratch_directory() as directory:
+                train_bundle(features, targets, bundle_dir=directory)
+
+        def fit_legacy(df=df):
+            with scratch_directory(), contextlib.redirect_stdout(io.StringIO()):
+                train_models.train_models(df)
+
+        yield Case(f'train_bundle[rows={rows}]', fit_bundle, repeat=FIT_REPEAT, warmup=0)
+        yield Case(f'train_models.train_models[rows={rows}]', fit_legacy, repeat=FIT_REPEAT, warmup=0)
+
+
+# --- API routes against an in-memory database ---
+
+def load_rollups(db, timestamp, device, device_ids, values):
+    """Fill the rollup collections the way RollupWriter would have"""
+    for name, seconds in ROLLUP_LEVELS:
+        bucket = timestamp - timestamp % (seconds * 1000)
+        order = np.lexsort((timestamp, bucket, device))
+        b, d = bucket[order], device[order]
+        starts = np.flatnonzero(np.r_[True, (b[1:] != b[:-1]) | (d[1:] != d[:-1])])
+        ends = np.r_[starts[1:], len(order)]
+        columns = {
+            'device_id': d[starts],
+            'bucket': b[starts],
+            'count': ends - starts,
+            'last_timestamp': timestamp[order][ends - 1],
+        }
+        for field in SENSOR_FIELDS:
+            v = values[field][order]
+            columns[f'{field}_sum'] = np.add.reduceat(v, starts)
+            columns[f'{field}_min'] = np.minimum.reduceat(v, starts)
+            columns[f'{field}_max'] = np.maximum.reduceat(v, starts)
+            columns[f'{field}_last'] = v[ends - 1]
+        db[name].load(columns, dates=('bucket', 'last_timestamp'), categories={'device_id': device_ids})
+
+
+def api_database(documents, seed):
+    """sensor_data, predictions and rollups with `documents` readings over API_DAYS"""
+    devices = max(1, documents // MAX_ROWS_PER_DEVICE)
+    interval = API_DAYS * 86400 * devices / documents
+    columns, _ = generate_synthetic(devices=devices, days=API_DAYS, interval=interval, seed=seed)
+    n = len(columns)
+    timestamp, device = columns.timestamp[:n], columns.device[:n]
+    values = {field: columns.values[field][:n] for field in SENSOR_FIELDS}
+    device_ids = columns.device_ids
+
+    db = ColumnarDatabase()
+    db['sensor_data'].load({'timestamp': timestamp, 'device_id': device, **values},
+                           dates=('timestamp',), categories={'device_id': device_ids})
+
+    rng = np.random.default_rng(seed)
+    level, levels, reason_code, reasons, flags = comfort_columns(values)
+    on_off = ['OFF', 'ON']
+    db['predictions'].load({
+        'timestamp': timestamp,
+        'device_id': device,
+        'temperature_pred': values['temperature'] + rng.normal(0, 0.5, n),
+        'humidity_pred': values['humidity'] + rng.normal(0, 1.5, n),
+        'air_quality_pred': values['air_quality'] + rng.normal(0, 25, n),
+        'comfort_level': level,
+        'comfort_reasons': reason_code,
+        'ac_state': flags[0].astype(np.int32),
+        'purifier_state': flags[4].astype(np.int32),
+        'dehumidifier_state': flags[2].astype(np.int32),
+        'model_version': np.zeros(n, dtype=np.int32),
+    }, dates=('timestamp',), categories={
+        'device_id': device_ids,
+        'comfort_level': levels,
+        'comfort_reasons': reasons,
+        'ac_state': on_off,
+        'purifier_state': on_off,
+        'dehumidifier_state': on_off,
+        'model_version': ['benchmark'],
+    })
+    load_rollups(db, timestamp, device, device_ids, values)
+    return db, device_ids
+
+
+async def asgi_get(app, path, query='', headers=()):
+    """One GET through the full ASGI stack (middleware, routing, encoding); (status, body)"""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'root_path': '', 'query_string': query.encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+        'client': ('127.0.0.1', 0), 'server': ('benchmark', 80),
+    }
+    response = {'status': None, 'body': []}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'].append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return response['status'], b''.join(response['body'])
+
+
+def api_requests(device_id):
+    """(case name, path, query, headers, expected status, clear response cache)"""
+    return [
+        ('/', '/', '', (), 200, False),
+        ('/api/latest-data', '/api/latest-data', '', (), 200, False),
+        ('/api/latest-data?device_id', '/api/latest-data', f'device_id={device_id}', (), 200, False),
+        ('/api/historical-data', '/api/historical-data', '', (), 200, True),
+        ('/api/historical-data?device_id', '/api/historical-data', f'device_id={device_id}', (), 200, True),
+        ('/api/historical-data?hours=168', '/api/historical-data', 'hours=168', (), 200, True),
+        ('/api/historical-data?mode=lttb', '/api/historical-data', 'mode=lttb', (), 200, True),
+        ('/api/historical-data?format=columnar', '/api/historical-data', 'format=columnar', (), 200, True),
+        ('/api/historical-data (cached)', '/api/historical-data', '', (), 200, False),
+        ('/api/comfort-history', '/api/comfort-history', '', (), 200, True),
+        ('/api/comfort-history?format=columnar', '/api/comfort-history', 'format=columnar', (), 200, True),
+        ('/api/devices', '/api/devices', '', (), 200, False),
+        ('/api/device-status', '/api/device-status', '', (), 200, False),
+        ('/api/dashboard-summary', '/api/dashboard-summary', '', (), 200, False),
+        ('/metrics', '/metrics', '', (), 200, False),
+    ]
+
+
+def api_cases(sizes, seed):
+    """Every route except /api/stream, which never completes.
+
+    The hot-state cache is left empty so "latest" routes query the
+    database; the (hot) cases read a published state instead. History
+    routes clear the response cache before each call unless marked cached.
+    """
+    import api_endpoints as api
+    from hot_state import HotState
+    from load_harness import MemoryHotStateStore
+
+    loop = asyncio.new_event_loop()
+    for documents in sizes:
+        db, device_ids = api_database(documents, seed)
+        api.db = db
+        api.sensor_data_collection = db['sensor_data']
+        api.predictions_collection = db['predictions']
+        api.broadcaster = None
+        api.populated_rollups.clear()
+        api.hot_state = HotState(store=MemoryHotStateStore())
+
+        for label, path, query, headers, expected, uncached in api_requests(device_ids[0]):
+            def call(path=path, query=query, headers=headers, uncached=uncached):
+                if uncached:
+                    api.response_cache.entries.clear()
+                return loop.run_until_complete(asgi_get(api.app, path, query, headers))
+
+            status, body = call()
+            if status != expected:
+                raise RuntimeError(f"{label} returned {status}: {body[:200]!r}")
+            yield Case(f'api {label}[docs={documents}]', call)
+
+        # Latest values served from the processor's hot state
+        sensor = loop.run_until_complete(db['sensor_data'].find_one({}, sort=[('timestamp', -1)]))
+        prediction = loop.run_until_complete(db['predictions'].find_one({}, sort=[('timestamp', -1)]))
+        devices = {name: prediction[f'{name}_state'] for name in ('ac', 'purifier', 'dehumidifier')}
+        api.hot_state.publish(sensor['device_id'], sensor, prediction, devices)
+        for label in ('/api/latest-data', '/api/device-status', '/api/dashboard-summary'):
+            def call(path=label):
+                return loop.run_until_complete(asgi_get(api.app, path))
+            yield Case(f'api {label} (hot)[docs={documents}]', call)
+    loop.close()
+
+
+# --- Baselines ---
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Annotate results with baseline ratios; names of cases that got slower"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        ratio = result['min_s'] / base['min_s'] if base['min_s'] else 1.0
+        result['baseline_min_s'] = base['min_s']
+        result['ratio'] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:9.1f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:9.2f} ms"
+    return f"{seconds:9.2f} s "
+
+
+def print_table(results, regressions):
+    width = max((len(name) for name in results), default=10)
+    print(f"{'case':<{width}}  {'median':>12}  {'best':>12}  {'baseline':>12}  ratio")
+    for name, result in results.items():
+        baseline = result.get('baseline_min_s')
+        ratio = result.get('ratio')
+        flag = '  SLOWER' if name in regressions else ''
+        print(f"{name:<{width}}  {format_seconds(result['median_s'])}  {format_seconds(result['min_s'])}  "
+              f"{format_seconds(baseline) if baseline is not None else '           -'}  "
+              f"{f'{ratio:5.2f}' if ratio is not None else '    -'}{flag}")
+
+
+def run(groups, api_sizes, fit_sizes, only=None, seed=0, repeat=None):
+    sources = {
+        'processor': lambda: processor_cases(seed),
+        'training': lambda: training_cases(fit_sizes, seed),
+        'api': lambda: api_cases(api_sizes, seed),
+    }
+    results = {}
+    for group in groups:
+        for case in sources[group]():
+            if only and not any(pattern in case.name for pattern in only):
+                continue
+            if repeat is not None:
+                case.repeat = repeat
+            results[case.name] = summarize(measure(case), case)
+            print(f"  {case.name}: {format_seconds(results[case.name]['median_s']).strip()}", flush=True)
+    return results
+
+
+def parse_sizes(text):
+    return tuple(int(float(size)) for size in text.split(',') if size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the prediction, comfort, "
+                                                 "training and API hot paths")
+    parser.add_argument('--groups', default=','.join(GROUPS),
+                        help=f"comma-separated subset of {', '.join(GROUPS)}")
+    parser.add_argument('--sizes', type=parse_sizes, default=API_SIZES,
+                        help="documents per collection for the API cases, e.g. 1000,100000")
+    parser.add_argument('--fit-sizes', type=parse_sizes, default=FIT_SIZES,
+                        help="training rows for the fit cases")
+    parser.add_argument('--only', action='append', help="run cases whose name contains this (repeatable)")
+    parser.add_argument('--repeat', type=int, help="rounds per case, overriding the defaults")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline file to compare against")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store these results as the baseline (merged into an existing file)")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="fail when a case's best round is this fraction slower than its baseline")
+    parser.add_argument('--report', help="write the JSON results here")
+    args = parser.parse_args()
+
+    groups = [group for group in args.groups.split(',') if group]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        parser.error(f"unknown groups: {', '.join(sorted(unknown))}")
+
+    results = run(groups, args.sizes, args.fit_sizes, args.only, args.seed, args.repeat)
+    report = {'generated_at': datetime.now().isoformat(), 'machine': machine_info(), 'cases': results}
+
+    regressions = []
+    baseline = load_baseline(args.baseline)
+    if args.save_baseline:
+        merged = dict(baseline['cases']) if baseline else {}
+        merged.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({**report, 'cases': merged}, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+    elif baseline is not None:
+        if baseline.get('machine') != report['machine']:
+            print("Warning: the baseline was recorded on a different machine or software versions")
+        regressions = compare(results, baseline, args.threshold)
+
+    print()
+    print_table(results, regressions)
+    if args.report:
+        report['regressions'] = regressions
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"Report written to {args.report}")
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) more than {args.threshold:.0%} slower than the baseline")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import argparse
+import os
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+
+from downsampling import EPOCH
+
+SENSOR_FIELDS = ['temperature', 'humidity', 'air_quality']
+
+# Archived sensor_data lives under <dir>/date=YYYY-MM-DD/readings.parquet
+COLD_STORAGE_DIR = os.environ.get("COLD_STORAGE_DIR", "archive/sensor_data")
+# Whole days older than this are moved out of MongoDB
+COLD_STORAGE_AGE_DAYS = int(os.environ.get("COLD_STORAGE_AGE_DAYS", "7"))
+
+PARTITION_PREFIX = "date="
+PARTITION_FILE = "readings.parquet"
+# Rows are sorted by device, so each row group covers few devices and
+# device filters skip most of them using the column statistics
+ROW_GROUP_ROWS = 64 * 1024
+# Documents per cursor batch when reading a day out of MongoDB
+ARCHIVE_BATCH_SIZE = 10000
+
+
+def _schema():
+    import pyarrow
+
+    return pyarrow.schema([
+        ('device_id', pyarrow.string()),
+        ('timestamp', pyarrow.timestamp('ms')),
+    ] + [(field, pyarrow.float64()) for field in SENSOR_FIELDS])
+
+
+def partition_path(day, directory=COLD_STORAGE_DIR):
+    return os.path.join(directory, f"{PARTITION_PREFIX}{day.isoformat()}", PARTITION_FILE)
+
+
+def partitions(directory=COLD_STORAGE_DIR, start_time=None, end_time=None):
+    """(day, path) of archived days overlapping [start_time, end_time], oldest first"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    found = []
+    for name in names:
+        if not name.startswith(PARTITION_PREFIX):
+            continue
+        try:
+            day = date.fromisoformat(name[len(PARTITION_PREFIX):])
+        except ValueError:
+            continue
+        if start_time is not None and day < start_time.date():
+            continue
+        if end_time is not None and day > end_time.date():
+            continue
+        path = os.path.join(directory, name, PARTITION_FILE)
+        if os.path.exists(path):
+            found.append((day, path))
+    return sorted(found)
+
+
+def boundary(directory=COLD_STORAGE_DIR):
+    """Start of the day after the newest archived one, or None without an archive.
+
+    Readings before it are read from Parquet and readings from it on from
+    MongoDB, so a day is never counted twice.
+    """
+    archived = partitions(directory)
+    if not archived:
+        return None
+    return datetime.combine(archived[-1][0] + timedelta(days=1), time.min)
+
+
+def row_count(start_time=None, end_time=None, directory=COLD_STORAGE_DIR):
+    """Rows in the archived days overlapping a range, from the file footers alone"""
+    import pyarrow.parquet
+
+    return sum(pyarrow.parquet.ParquetFile(path).metadata.num_rows
+               for _, path in partitions(directory, start_time, end_time))
+
+
+def _bson_precision(value):
+    """Drop the microseconds BSON cannot store, so bounds match MongoDB's"""
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+def read_partitions(start_time, end_time, device_id=None, fields=SENSOR_FIELDS,
+                    directory=COLD_STORAGE_DIR):
+    """Archived readings in [start_time, end_time), one partition at a time.
+
+    Only partitions overlapping the range are opened, only the timestamp,
+    device_id and requested field columns are read, and row groups whose
+    statistics rule out the range or device are skipped. Yields
+    (epoch-ms timestamps, device codes, device ids, {field: values}) sorted
+    by time.
+    """
+    import pyarrow.parquet
+
+    start_time, end_time = _bson_precision(start_time), _bson_precision(end_time)
+    for day, path in partitions(directory, start_time, end_time):
+        # Row filtering is costly, so days wholly inside the range skip the time filter
+        day_start = datetime.combine(day, time.min)
+        filters = [('device_id', '==', device_id)] if device_id else []
+        if start_time > day_start:
+            filters.append(('timestamp', '>=', start_time))
+        if end_time < day_start + timedelta(days=1):
+            filters.append(('timestamp', '<', end_time))
+        table = pyarrow.parquet.read_table(path, columns=['timestamp', 'device_id'] + list(fields),
+                                           filters=filters or None)
+        if table.num_rows == 0:
+            continue
+        timestamp = table.column('timestamp').to_numpy().astype('datetime64[ms]').view(np.int64)
+        # Readings from before device ids were recorded have a null device_id
+        devices = table.column('device_id').combine_chunks().dictionary_encode(null_encoding='encode')
+        order = np.argsort(timestamp, kind='stable')
+        yield (timestamp[order],
+               devices.indices.to_numpy().astype(np.int32)[order],
+               devices.dictionary.to_pylist(),
+               {field: table.column(field).to_numpy().astype(np.float64)[order] for field in fields})
+
+
+def bucket_rows(start_time, end_time, device_id=None, fields=SENSOR_FIELDS, bucket_s=60,
+                directory=COLD_STORAGE_DIR):
+    """Archived readings in [start_time, end_time) as downsampling.bucket_pipeline rows"""
+    pieces = list(read_partitions(start_time, end_time, device_id, fields, directory))
+    if not pieces:
+        return []
+    # Partitions come oldest first and each is sorted by time, so every
+    # bucket is one contiguous run and reduceat can summarise it
+    timestamp = np.concatenate([piece[0] for piece in pieces])
+    bucket_ms = bucket_s * 1000
+    keys, starts, counts = np.unique(timestamp - timestamp % bucket_ms,
+                                     return_index=True, return_counts=True)
+
+    columns = {}
+    for field in fields:
+        values = np.concatenate([piece[3][field] for piece in pieces])
+        # Missing values are skipped, like $avg/$min/$max skip nulls
+        valid = ~np.isnan(values)
+        n = np.add.reduceat(valid, starts)
+        total = np.add.reduceat(np.where(valid, values, 0.0), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns[field] = np.where(n > 0, total / np.maximum(n, 1), np.nan)
+            columns[f'{field}_min'] = np.fmin.reduceat(values, starts)
+            columns[f'{field}_max'] = np.fmax.reduceat(values, starts)
+
+    rows = []
+    for i, key in enumerate(keys.tolist()):
+        row = {'timestamp': EPOCH + timedelta(milliseconds=key), 'count': int(counts[i])}
+        for name, values in columns.items():
+            value = float(values[i])
+            row[name] = None if np.isnan(value) else value
+        rows.append(row)
+    return rows
+
+
+def _device_table(timestamp, device_codes, device_ids, values):
+    """Arrow table sorted by device id, then time"""
+    import pyarrow
+
+    names = np.array(device_ids, dtype=object)
+    rank = np.argsort(np.argsort([device_id or '' for device_id in device_ids], kind='stable'))
+    order = np.lexsort((timestamp, rank[device_codes]))
+    arrays = [pyarrow.array(names[device_codes[order]], pyarrow.string()),
+              pyarrow.array(timestamp[order].astype('datetime64[ms]'), pyarrow.timestamp('ms'))]
+    arrays += [pyarrow.array(values[field][order], pyarrow.float64()) for field in SENSOR_FIELDS]
+    return pyarrow.Table.from_arrays(arrays, schema=_schema())
+
+
+def write_partition(day, timestamp, device_codes, device_ids, values, directory=COLD_STORAGE_DIR):
+    """Write (or extend) one day's partition; returns the rows it holds.
+
+    Rows already in the partition are kept, so running the job again after
+    a failed delete or for late readings compacts the day into one file.
+    Readings with the same device and timestamp are stored once. The file
+    is written next to the old one and swapped in with a rename.
+    """
+    import pyarrow.parquet
+
+    path = partition_path(day, directory)
+    day_start = datetime.combine(day, time.min)
+    existing = list(read_partitions(day_start, day_start + timedelta(days=1), directory=directory))
+    if existing:
+        old_timestamp, old_codes, old_ids, old_values = existing[0]
+        codes = {device_id: code for code, device_id in enumerate(device_ids)}
+        device_ids = list(device_ids)
+        for device_id in old_ids:
+            if device_id not in codes:
+                codes[device_id] = len(device_ids)
+                device_ids.append(device_id)
+        remap = np.array([codes[device_id] for device_id in old_ids], dtype=np.int32)
+        timestamp = np.concatenate([old_timestamp, timestamp])
+        device_codes = np.concatenate([remap[old_codes], device_codes])
+        values = {field: np.concatenate([old_values[field], values[field]]) for field in SENSOR_FIELDS}
+
+    table = _device_table(timestamp, device_codes, device_ids, values)
+    device = table.column('device_id').to_numpy(zero_copy_only=False)
+    stamps = table.column('timestamp').to_numpy().view(np.int64)
+    unique = np.ones(table.num_rows, dtype=bool)
+    unique[1:] = (device[1:] != device[:-1]) | (stamps[1:] != stamps[:-1])
+    if not unique.all():
+        table = table.filter(pyarrow.array(unique))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.tmp'
+    pyarrow.parquet.write_table(table, partial, row_group_size=ROW_GROUP_ROWS, compression='zstd')
+    os.replace(partial, path)
+    return table.num_rows
+
+
+def archive_day(db, day, directory=COLD_STORAGE_DIR, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move one day of sensor_data into its partition; returns the documents moved"""
+    # data_loader reads the archive, so it is imported here rather than at the top
+    from data_loader import stream_columns
+
+    start = datetime.combine(day, time.min)
+    query = {'timestamp': {'$gte': start, '$lt': start + timedelta(days=1)}}
+    projection = {'_id': 0, 'timestamp': 1, 'device_id': 1}
+    projection.update({field: 1 for field in SENSOR_FIELDS})
+    collection = db['sensor_data']
+    # Read and delete only up to the newest document now present (ObjectIds
+    # grow with insertion time), so a late reading inserted while the day
+    # is being written stays in MongoDB for the next run
+    newest = collection.find_one(query, projection={'_id': 1}, sort=[('_id', -1)])
+    if newest is None:
+        return 0
+    query['_id'] = {'$lte': newest['_id']}
+    capacity = collection.count_documents(query)
+    columns = stream_columns(collection.find(query, projection, batch_size=batch_size),
+                             SENSOR_FIELDS, capacity, batch_size)
+    write_partition(day, columns.timestamp, columns.device, columns.device_ids, columns.values,
+                    directory)
+    # Only delete once the partition is safely in place
+    collection.delete_many(query)
+    return len(columns)
+
+
+def archive(db, age_days=COLD_STORAGE_AGE_DAYS, directory=COLD_STORAGE_DIR, now=None):
+    """Move every whole day of sensor_data older than age_days to Parquet.
+
+    Readings that arrived late for days already archived are merged into
+    their partitions too: raw reads take everything before boundary() from
+    the archive, so they are not seen until this runs again.
+
+    Rollups stay in MongoDB, so history at a minute or coarser keeps being
+    served from them; only raw reads go to the archive.
+    """
+    cutoff = datetime.combine((now or datetime.now()).date() - timedelta(days=age_days), time.min)
+    archived = boundary(directory)
+    limit = max(cutoff, archived) if archived is not None else cutoff
+    collection = db['sensor_data']
+    moved = {}
+    day_start = None
+    while True:
+        # Jump to the next day that has readings rather than stepping through empty ones
+        query = {'$lt': limit} if day_start is None else {'$gte': day_start, '$lt': limit}
+        oldest = collection.find_one({'timestamp': query}, projection={'timestamp': 1},
+                                     sort=[('timestamp', 1)])
+        if oldest is None:
+            return moved
+        day = oldest['timestamp'].date()
+        count = archive_day(db, day, directory)
+        if count:
+            moved[day.isoformat()] = count
+            print(f"Archived {count} readings from {day.isoformat()}")
+        day_start = datetime.combine(day + timedelta(days=1), time.min)
+
+
+def main():
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Move aged sensor_data to date-partitioned Parquet")
+    parser.add_argument('--archive', action='store_true', help="archive days older than --age-days")
+    parser.add_argument('--age-days', type=int, default=COLD_STORAGE_AGE_DAYS)
+    parser.add_argument('--dir', default=COLD_STORAGE_DIR, help="archive directory")
+    args = parser.parse_args()
+
+    if args.archive:
+        client = pymongo.MongoClient("mongodb://localhost:27017/")
+        moved = archive(client["iot_monitoring"], args.age_days, args.dir)
+        print(f"Archived {sum(moved.values())} readings from {len(moved)} days")
+        return
+
+    import pyarrow.parquet
+
+    for day, path in partitions(args.dir):
+        metadata = pyarrow.parquet.ParquetFile(path).metadata
+        print(f"{day.isoformat()}: {metadata.num_rows} readings, {metadata.num_row_groups} row groups, "
+              f"{os.path.getsize(path) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import cold_storage
+from feature_store import rolling_features
+from inference_engine import FEATURE_NAMES
+from rollups import rollup_for, rollup_pipeline
+
+SENSOR_FIELDS = ['temperature', 'humidity', 'air_quality']
+
+# Documents per cursor batch; also the most documents held as dicts at once
+LOAD_BATCH_SIZE = 10000
+
+# Targets are the readings this far ahead of each feature row...
+TARGET_HORIZON = timedelta(hours=1)
+# ...give or take this much; rows without such a reading get no target
+TARGET_TOLERANCE = timedelta(minutes=5)
+
+MS_PER_HOUR = 60 * 60 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+# 1970-01-01 was a Thursday (Monday=0, like datetime.weekday)
+EPOCH_WEEKDAY = 3
+
+
+class SensorColumns:
+    """Readings as NumPy columns: epoch-ms timestamps, device codes, values.
+
+    Arrays are allocated up front (from a count when one is available) and
+    doubled only if more documents arrive than expected.
+    """
+
+    def __init__(self, fields=SENSOR_FIELDS, capacity=0):
+        self.fields = list(fields)
+        self.size = 0
+        self.device_ids = []
+        self._codes = {}
+        capacity = max(int(capacity), 1)
+        self.timestamp = np.empty(capacity, dtype=np.int64)
+        self.device = np.empty(capacity, dtype=np.int32)
+        self.values = {field: np.empty(capacity, dtype=np.float64) for field in self.fields}
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, n):
+        needed = self.size + n
+        capacity = len(self.timestamp)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        self.timestamp = np.resize(self.timestamp, capacity)
+        self.device = np.resize(self.device, capacity)
+        for field in self.fields:
+            self.values[field] = np.resize(self.values[field], capacity)
+
+    def device_code(self, device_id):
+        code = self._codes.get(device_id)
+        if code is None:
+            code = self._codes[device_id] = len(self.device_ids)
+            self.device_ids.append(device_id)
+        return code
+
+    def append(self, timestamps, device_ids, values):
+        """Append one batch: lists of datetimes, device ids and per-field values"""
+        n = len(timestamps)
+        if n == 0:
+            return
+        self._reserve(n)
+        end = self.size + n
+        self.timestamp[self.size:end] = np.array(timestamps, dtype='datetime64[ms]').astype(np.int64)
+        self.device[self.size:end] = [self.device_code(device_id) for device_id in device_ids]
+        for field in self.fields:
+            # None (missing field) becomes NaN
+            self.values[field][self.size:end] = np.array(values[field], dtype=np.float64)
+        self.size = end
+
+    def extend(self, timestamp, device_codes, device_ids, values):
+        """Append arrays whose device codes index device_ids (epoch-ms timestamps)"""
+        n = len(timestamp)
+        if n == 0:
+            return
+        self._reserve(n)
+        end = self.size + n
+        remap = np.array([self.device_code(device_id) for device_id in device_ids], dtype=np.int32)
+        self.timestamp[self.size:end] = timestamp
+        self.device[self.size:end] = remap[device_codes]
+        for field in self.fields:
+            self.values[field][self.size:end] = values[field]
+        self.size = end
+
+    def trim(self):
+        """Drop the unused tail of the preallocated arrays"""
+        self.timestamp = self.timestamp[:self.size].copy()
+        self.device = self.device[:self.size].copy()
+        for field in self.fields:
+            self.values[field] = self.values[field][:self.size].copy()
+        return self
+
+    def hour(self):
+        return (self.timestamp[:self.size] // MS_PER_HOUR) % 24
+
+    def day_of_week(self):
+        return (self.timestamp[:self.size] // MS_PER_DAY + EPOCH_WEEKDAY) % 7
+
+    def features(self):
+        """(n, len(MODEL_FEATURE_NAMES)) feature matrix in inference order"""
+        columns = {field: self.values[field][:self.size] for field in self.fields}
+        columns['hour'] = self.hour()
+        columns['day_of_week'] = self.day_of_week()
+        instant = np.column_stack([columns[name] for name in FEATURE_NAMES])
+        rolling = rolling_features(self.timestamp[:self.size], self.device[:self.size], columns)
+        return np.hstack([instant, rolling]).astype(np.float64)
+
+    @classmethod
+    def from_arrays(cls, timestamp, device, device_ids, values):
+        """Columns wrapping existing arrays (epoch-ms timestamps, device codes)"""
+        columns = cls(list(values), capacity=0)
+        columns.timestamp = np.ascontiguousarray(timestamp, dtype=np.int64)
+        columns.device = np.ascontiguousarray(device, dtype=np.int32)
+        columns.values = {field: np.ascontiguousarray(array, dtype=np.float64)
+                          for field, array in values.items()}
+        columns.size = len(columns.timestamp)
+        for device_id in device_ids:
+            columns.device_code(device_id)
+        return columns
+
+    @classmethod
+    def concatenate(cls, parts, fields=SENSOR_FIELDS):
+        """Join columns that share the same device_ids"""
+        if not parts:
+            return cls(fields)
+        return cls.from_arrays(
+            np.concatenate([part.timestamp[:part.size] for part in parts]),
+            np.concatenate([part.device[:part.size] for part in parts]),
+            parts[0].device_ids,
+            {field: np.concatenate([part.values[field][:part.size] for part in parts])
+             for field in parts[0].fields})
+
+    @classmethod
+    def from_frame(cls, df, fields=SENSOR_FIELDS):
+        """Columns from a DataFrame with timestamp, sensor fields and optional device_id"""
+        columns = cls(fields, capacity=len(df))
+        device_ids = df['device_id'].tolist() if 'device_id' in df.columns else [None] * len(df)
+        columns.append(df['timestamp'].tolist(), device_ids,
+                       {field: df[field].tolist() for field in fields})
+        return columns
+
+
+def stream_columns(cursor, fields=SENSOR_FIELDS, capacity=0, batch_size=LOAD_BATCH_SIZE,
+                   columns=None):
+    """Drain a cursor into SensorColumns (new, or appended to `columns`),
+    converting batch_size documents at a time"""
+    columns = columns if columns is not None else SensorColumns(fields, capacity)
+    timestamps, device_ids = [], []
+    values = {field: [] for field in fields}
+    for doc in cursor:
+        timestamps.append(doc['timestamp'])
+        device_ids.append(doc.get('device_id'))
+        for field in fields:
+            values[field].append(doc.get(field))
+        if len(timestamps) >= batch_size:
+            columns.append(timestamps, device_ids, values)
+            timestamps, device_ids = [], []
+            values = {field: [] for field in fields}
+    columns.append(timestamps, device_ids, values)
+    return columns.trim()
+
+
+def load_raw(collection, start_time, end_time, device_id=None, fields=SENSOR_FIELDS,
+             batch_size=LOAD_BATCH_SIZE, archive_dir=None):
+    """Raw readings in [start_time, end_time], projected to the needed fields.
+
+    With an archive_dir, days already moved to Parquet (see cold_storage)
+    are read from there and only newer readings from MongoDB.
+    """
+    archived = cold_storage.boundary(archive_dir) if archive_dir else None
+    cold = archived is not None and start_time < archived
+    if cold:
+        # Archive reads exclude their end, this range includes it
+        cold_end = min(end_time + timedelta(milliseconds=1), archived)
+        hot_start = archived
+        capacity = cold_storage.row_count(start_time, cold_end, archive_dir)
+    else:
+        hot_start, capacity = start_time, 0
+
+    query = {'timestamp': {'$gte': hot_start, '$lte': end_time}}
+    if device_id:
+        query['device_id'] = device_id
+    projection = {'_id': 0, 'timestamp': 1, 'device_id': 1}
+    projection.update({field: 1 for field in fields})
+
+    capacity += collection.count_documents(query)
+    columns = SensorColumns(fields, capacity)
+    if cold:
+        for piece in cold_storage.read_partitions(start_time, cold_end, device_id, fields, archive_dir):
+            columns.extend(*piece)
+    cursor = collection.find(query, projection, batch_size=batch_size).sort('timestamp', 1)
+    return stream_columns(cursor, fields, batch_size=batch_size, columns=columns)
+
+
+def load_rollup(collection, start_time, end_time, resolution, batch_size=LOAD_BATCH_SIZE):
+    """Per-device averages over resolution-second buckets from a rollup collection"""
+    match = {'bucket': {'$gte': start_time, '$lte': end_time}}
+    cursor = collection.aggregate(
+        rollup_pipeline(match, resolution, per_device=True),
+        batchSize=batch_size, allowDiskUse=True)
+    # One row per device per bucket; assume a single device to start with
+    span = (end_time - start_time).total_seconds()
+    return stream_columns(cursor, SENSOR_FIELDS, span // resolution + 1, batch_size)
+
+
+def load_window(db, start_time, end_time=None, resolution=None, batch_size=LOAD_BATCH_SIZE,
+                archive_dir=cold_storage.COLD_STORAGE_DIR):
+    """Readings for a time window, from the coarsest fitting rollup when possible.
+
+    Memory is bounded by the window (and resolution), not by how much
+    history the collection holds. Raw readings older than the archive
+    boundary come from Parquet.
+    """
+    end_time = end_time or datetime.now()
+    level = rollup_for(resolution) if resolution else None
+    if level is not None and db[level[0]].estimated_document_count() > 0:
+        return load_rollup(db[level[0]], start_time, end_time, resolution, batch_size)
+    return load_raw(db['sensor_data'], start_time, end_time, batch_size=batch_size,
+                    archive_dir=archive_dir)
+
+
+def horizon_targets(columns, horizon=TARGET_HORIZON, tolerance=TARGET_TOLERANCE):
+    """Index of each row's target reading, and a mask of rows that have one.
+
+    The target is the same device's reading closest to timestamp + horizon,
+    accepted if it is within tolerance. Matching is on time, so gaps and
+    irregular reporting rates do not shift targets the way a fixed row
+    offset would.
+    """
+    n = len(columns)
+    if n == 0:
+        return np.empty(0, dtype=np.intp), np.zeros(0, dtype=bool)
+    timestamp = columns.timestamp[:n]
+    device = columns.device[:n].astype(np.int64)
+    horizon_ms = int(horizon.total_seconds() * 1000)
+    tolerance_ms = int(tolerance.total_seconds() * 1000)
+
+    # One sorted key per (device, time): devices occupy disjoint key ranges
+    start = timestamp.min()
+    stride = int(timestamp.max() - start) + horizon_ms + tolerance_ms + 1
+    key = device * stride + (timestamp - start)
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+
+    wanted = key + horizon_ms
+    after = np.searchsorted(sorted_key, wanted, side='left')
+    before = np.clip(after - 1, 0, n - 1)
+    after = np.clip(after, 0, n - 1)
+    use_after = np.abs(sorted_key[after] - wanted) <= np.abs(sorted_key[before] - wanted)
+    nearest = np.where(use_after, after, before)
+
+    target = order[nearest]
+    valid = ((np.abs(sorted_key[nearest] - wanted) <= tolerance_ms)
+             & (device[target] == device)
+             & (target != np.arange(n)))
+    return target, valid
+
+
+def training_arrays(columns, horizon=TARGET_HORIZON, tolerance=TARGET_TOLERANCE,
+                    with_timestamps=False):
+    """(features, targets) for rows whose horizon reading exists.
+
+    with_timestamps=True adds the rows' epoch-ms timestamps, for splitting
+    by time.
+    """
+    target, valid = horizon_targets(columns, horizon, tolerance)
+    values = np.column_stack([columns.values[field][:len(columns)] for field in SENSOR_FIELDS])
+    features = columns.features()
+    complete = valid & ~np.isnan(features).any(axis=1) & ~np.isnan(values[target]).any(axis=1)
+    if with_timestamps:
+        return features[complete], values[target[complete]], columns.timestamp[:len(columns)][complete]
+    return features[complete], values[target[complete]]
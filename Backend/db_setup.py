@@ -0,0 +1,205 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import CollectionInvalid
+
+from rollups import ensure_rollup_indexes
+
+# Set MONGO_TIMESERIES=1 to create new raw collections as time-series collections
+USE_TIMESERIES = os.environ.get("MONGO_TIMESERIES", "0") == "1"
+
+RAW_COLLECTIONS = ['sensor_data', 'predictions']
+
+TIMESERIES_OPTIONS = {
+    'timeField': 'timestamp',
+    'metaField': 'device_id',
+    'granularity': 'seconds',
+}
+
+MIGRATION_BATCH = 5000
+
+
+def is_timeseries(db, name):
+    info = next(db.list_collections(filter={'name': name}), None)
+    return info is not None and info.get('type') == 'timeseries'
+
+
+def create_timeseries_collection(db, name):
+    """Create `name` as a time-series collection unless it already exists"""
+    try:
+        db.create_collection(name, timeseries=TIMESERIES_OPTIONS)
+        print(f"Created time-series collection {name}")
+    except CollectionInvalid:
+        pass
+
+
+def ensure_indexes(db):
+    """Indexes for latest-value lookups and time-range queries"""
+    for name in RAW_COLLECTIONS:
+        collection = db[name]
+        collection.create_index([('timestamp', DESCENDING)])
+        collection.create_index([('device_id', ASCENDING), ('timestamp', DESCENDING)])
+    # Newest replay.py write, part of the history validators
+    db['predictions'].create_index([('replayed_at', DESCENDING)], sparse=True)
+    ensure_rollup_indexes(db)
+
+
+def bootstrap(db, timeseries=USE_TIMESERIES):
+    """Create collections and indexes; safe to run on every startup"""
+    if timeseries:
+        existing = set(db.list_collection_names())
+        for name in RAW_COLLECTIONS:
+            if name not in existing:
+                create_timeseries_collection(db, name)
+    ensure_indexes(db)
+
+
+def _copy_resume_filter(db, name, legacy_name):
+    """Filter for the legacy documents not yet copied into `name`.
+
+    Documents are copied in (timestamp, _id) order, and live writers only
+    add readings newer than the legacy data, so the newest copied document
+    is the newest one in `name` no later than the legacy data.
+    """
+    newest_legacy = db[legacy_name].find_one({}, projection={'timestamp': 1}, sort=[('timestamp', -1)])
+    if newest_legacy is None:
+        return None
+    copied = db[name].find_one({'timestamp': {'$lte': newest_legacy['timestamp']}},
+                               projection={'timestamp': 1}, sort=[('timestamp', -1)])
+    if copied is None:
+        return {}
+    # The batch that reached this timestamp may have been cut short
+    at = copied['timestamp']
+    done = [doc['_id'] for doc in db[name].find({'timestamp': at}, projection={'_id': 1})]
+    return {'$or': [{'timestamp': {'$gt': at}},
+                    {'timestamp': at, '_id': {'$nin': done}}]}
+
+
+def migrate_to_timeseries(db, name, drop_legacy=False):
+    """Move an existing regular collection into a time-series collection.
+
+    Time-series collections cannot be renamed, so the old collection is
+    renamed to `<name>_legacy` first and `name` is recreated as time-series;
+    writers that keep inserting during the copy land in the new collection.
+    Running it again after a failed copy carries on where the copy stopped.
+    """
+    legacy_name = f'{name}_legacy'
+    collections = set(db.list_collection_names())
+    if not is_timeseries(db, name):
+        if legacy_name in collections:
+            raise RuntimeError(f"{name} is not time-series but {legacy_name} exists; "
+                               f"move one of them aside before migrating")
+        if name in collections:
+            db[name].rename(legacy_name)
+        create_timeseries_collection(db, name)
+        if not is_timeseries(db, name):
+            # A writer inserted between the rename and the create, and
+            # MongoDB made `name` a regular collection again
+            raise RuntimeError(f"{name} was recreated as a regular collection by a concurrent "
+                               f"write; stop the writers, rename {name} aside and migrate again")
+    elif legacy_name not in collections:
+        print(f"{name} is already a time-series collection")
+        return 0
+
+    query = _copy_resume_filter(db, name, legacy_name)
+    copied = 0
+    batch = []
+    if query is not None:
+        cursor = db[legacy_name].find(query, batch_size=MIGRATION_BATCH).sort(
+            [('timestamp', ASCENDING), ('_id', ASCENDING)])
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= MIGRATION_BATCH:
+                db[name].insert_many(batch, ordered=False)
+                copied += len(batch)
+                batch = []
+    if batch:
+        db[name].insert_many(batch, ordered=False)
+        copied += len(batch)
+    print(f"Copied {copied} documents from {legacy_name} to {name}")
+
+    ensure_indexes(db)
+    if drop_legacy:
+        db[legacy_name].drop()
+    return copied
+
+
+def _plan_stages(plan):
+    """Flatten a winning plan into its stage names, outermost first"""
+    stages = []
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        if 'inputStage' in plan:
+            plan = plan['inputStage']
+        elif plan.get('inputStages'):
+            plan = plan['inputStages'][0]
+        else:
+            plan = plan.get('queryPlan')
+    return stages
+
+
+def _winning_plan(explain):
+    if 'queryPlanner' in explain:
+        return explain['queryPlanner']['winningPlan']
+    # Aggregations report their plan per pipeline stage
+    for stage in explain.get('stages', []):
+        if '$cursor' in stage:
+            return stage['$cursor']['queryPlanner']['winningPlan']
+    return {}
+
+
+def explain_queries(db):
+    """Winning plan stages for the hot API/processor queries.
+
+    Returns {query name: [stage, ...]}; an IXSCAN stage confirms index use,
+    COLLSCAN means the query is scanning the whole collection.
+    """
+    day_ago = datetime.now() - timedelta(hours=24)
+    range_filter = {'timestamp': {'$gte': day_ago}}
+    queries = {
+        'latest sensor_data': db['sensor_data'].find({}).sort('timestamp', -1).limit(1),
+        'latest prediction': db['predictions'].find({}).sort('timestamp', -1).limit(1),
+        'latest sensor_data by device': db['sensor_data'].find(
+            {'device_id': 'default'}).sort('timestamp', -1).limit(1),
+        'sensor_data 24h range': db['sensor_data'].find(range_filter).sort('timestamp', 1),
+        'predictions 24h range': db['predictions'].find(range_filter).sort('timestamp', 1),
+    }
+
+    report = {}
+    for label, cursor in queries.items():
+        report[label] = _plan_stages(_winning_plan(cursor.explain()))
+    return report
+
+
+def main():
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Create MongoDB indexes and collections")
+    parser.add_argument('--timeseries', action='store_true',
+                        help="create missing sensor_data/predictions as time-series collections")
+    parser.add_argument('--migrate', action='store_true',
+                        help="move existing sensor_data/predictions into time-series collections")
+    parser.add_argument('--drop-legacy', action='store_true',
+                        help="drop the *_legacy collections after migrating")
+    parser.add_argument('--explain', action='store_true', help="print query plans for the hot queries")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient("mongodb://localhost:27017/")
+    db = client["iot_monitoring"]
+
+    if args.migrate:
+        for name in RAW_COLLECTIONS:
+            migrate_to_timeseries(db, name, drop_legacy=args.drop_legacy)
+    bootstrap(db, timeseries=args.timeseries or USE_TIMESERIES)
+    print("Indexes are in place")
+
+    if args.explain:
+        for label, stages in explain_queries(db).items():
+            flag = 'index' if 'IXSCAN' in stages else 'NO INDEX' if 'COLLSCAN' in stages else ''
+            print(f"{label:32s} {' <- '.join(stages)}  {flag}")
+
+
+if __name__ == "__main__":
+    main()
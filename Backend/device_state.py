@@ -0,0 +1,198 @@
+import json
+import threading
+import zlib
+
+import numpy as np
+
+SENSOR_FIELDS = ('temperature', 'humidity', 'air_quality')
+DEVICE_NAMES = ('ac', 'purifier', 'dehumidifier')
+
+# Device id used for boards publishing on the legacy single-room topics
+DEFAULT_DEVICE_ID = "default"
+
+
+def parse_sensor_topic(topic):
+    """Return (device_id, field) for a sensor topic, or None if unrecognised.
+
+    Accepts both the per-room layout home/<room>/sensors/<field> and the
+    legacy home/sensors/<field> (mapped to DEFAULT_DEVICE_ID). The combined
+    topics home/<room>/sensors and home/sensors carry all fields in one JSON
+    payload; their field is None.
+    """
+    parts = topic.split('/')
+    if len(parts) == 3 and parts[0] == 'home' and parts[1] == 'sensors':
+        device_id, field = DEFAULT_DEVICE_ID, parts[2]
+    elif len(parts) == 4 and parts[0] == 'home' and parts[2] == 'sensors':
+        device_id, field = parts[1], parts[3]
+    elif len(parts) == 2 and parts == ['home', 'sensors']:
+        return DEFAULT_DEVICE_ID, None
+    elif len(parts) == 3 and parts[0] == 'home' and parts[2] == 'sensors':
+        return parts[1], None
+    else:
+        return None
+    if field not in SENSOR_FIELDS:
+        return None
+    return device_id, field
+
+
+def parse_sensor_payload(payload):
+    """{field: value} from a combined payload such as {"temperature": 24.1, ...}.
+
+    Keys other than the sensor fields are ignored. Raises ValueError if the
+    payload is not a JSON object, has no sensor field or a non-numeric one.
+    """
+    data = json.loads(payload)
+    if not isinstance(data, dict):
+        raise ValueError("Sensor payload must be a JSON object")
+    try:
+        values = {field: float(data[field]) for field in SENSOR_FIELDS if data.get(field) is not None}
+    except TypeError as e:
+        raise ValueError(f"Non-numeric sensor value: {e}") from None
+    if not values:
+        raise ValueError("Sensor payload has no sensor fields")
+    return values
+
+
+def control_topic(device_id, device_name):
+    """MQTT topic used to switch device_name in the given room"""
+    if device_id == DEFAULT_DEVICE_ID:
+        return f"home/devices/{device_name}"
+    return f"home/{device_id}/devices/{device_name}"
+
+
+def device_shard(device_id, instance_count):
+    """Stable shard index for a device across processor instances"""
+    return zlib.crc32(device_id.encode()) % instance_count
+
+
+class DeviceStateTable:
+    """Per-device sensor values and actuator states in flat NumPy arrays.
+
+    Each device owns one row. Rows are allocated on first sight and the
+    arrays grow by doubling, so lookups stay a dict hit plus an array index
+    no matter how many devices are attached.
+
+    Besides the latest value of every field, each row has a pending sample
+    set that collects fields published separately until all of them are in
+    (see collect).
+    """
+
+    def __init__(self, capacity=256):
+        self.lock = threading.Lock()
+        self._index = {}
+        self.device_ids = []
+        self.values = np.full((capacity, len(SENSOR_FIELDS)), np.nan)
+        self.timestamps = np.zeros(capacity)
+        # Bit i set means DEVICE_NAMES[i] is ON
+        self.device_bits = np.zeros(capacity, dtype=np.uint8)
+        # Fields of the sample set being collected, and when it started (0: none)
+        self.pending = np.full((capacity, len(SENSOR_FIELDS)), np.nan)
+        self.pending_started = np.zeros(capacity)
+
+    def __len__(self):
+        return len(self.device_ids)
+
+    def _grow(self):
+        capacity = self.values.shape[0] * 2
+        values = np.full((capacity, len(SENSOR_FIELDS)), np.nan)
+        values[:len(self.device_ids)] = self.values[:len(self.device_ids)]
+        timestamps = np.zeros(capacity)
+        timestamps[:len(self.device_ids)] = self.timestamps[:len(self.device_ids)]
+        device_bits = np.zeros(capacity, dtype=np.uint8)
+        device_bits[:len(self.device_ids)] = self.device_bits[:len(self.device_ids)]
+        pending = np.full((capacity, len(SENSOR_FIELDS)), np.nan)
+        pending[:len(self.device_ids)] = self.pending[:len(self.device_ids)]
+        pending_started = np.zeros(capacity)
+        pending_started[:len(self.device_ids)] = self.pending_started[:len(self.device_ids)]
+        self.values, self.timestamps, self.device_bits = values, timestamps, device_bits
+        self.pending, self.pending_started = pending, pending_started
+
+    def row(self, device_id):
+        """Row index for device_id, allocating one if the device is new"""
+        row = self._index.get(device_id)
+        if row is None:
+            with self.lock:
+                row = self._index.get(device_id)
+                if row is None:
+                    row = len(self.device_ids)
+                    if row >= self.values.shape[0]:
+                        self._grow()
+                    self.device_ids.append(device_id)
+                    self._index[device_id] = row
+        return row
+
+    def update(self, device_id, field, value, timestamp):
+        """Store one sensor value and return the device's row"""
+        row = self.row(device_id)
+        # Under the lock, so the write cannot land on arrays _grow is replacing
+        with self.lock:
+            self.values[row, SENSOR_FIELDS.index(field)] = value
+            self.timestamps[row] = timestamp.timestamp()
+        return row
+
+    def collect(self, row, values, now, window):
+        """Add {field: value} to the row's pending sample set.
+
+        Returns (reading, dropped). reading is the complete set, once every
+        field is in, and the set is cleared. dropped says why an unfinished
+        set was discarded before adding: 'timed_out' if it started more than
+        window seconds before now, 'superseded' if it already had one of the
+        fields (the device moved on to its next sample).
+        """
+        with self.lock:
+            pending = self.pending[row]
+            dropped = None
+            if self.pending_started[row]:
+                if now - self.pending_started[row] > window:
+                    dropped = 'timed_out'
+                elif any(not np.isnan(pending[SENSOR_FIELDS.index(field)]) for field in values):
+                    dropped = 'superseded'
+                if dropped:
+                    pending[:] = np.nan
+                    self.pending_started[row] = 0
+            if not self.pending_started[row]:
+                self.pending_started[row] = now
+            for field, value in values.items():
+                pending[SENSOR_FIELDS.index(field)] = value
+            if np.isnan(pending).any():
+                return None, dropped
+            reading = dict(zip(SENSOR_FIELDS, pending.tolist()))
+            pending[:] = np.nan
+            self.pending_started[row] = 0
+            return reading, dropped
+
+    def expire(self, now, window):
+        """Discard pending sets started more than window seconds ago; returns how many"""
+        with self.lock:
+            n = len(self.device_ids)
+            started = self.pending_started[:n]
+            stale = (started > 0) & (now - started > window)
+            self.pending[:n][stale] = np.nan
+            started[stale] = 0
+            return int(stale.sum())
+
+    def is_complete(self, row):
+        return not np.isnan(self.values[row]).any()
+
+    def reading(self, row):
+        temperature, humidity, air_quality = self.values[row].tolist()
+        return {
+            'temperature': temperature,
+            'humidity': humidity,
+            'air_quality': air_quality,
+        }
+
+    def get_state(self, row, device_name):
+        bit = 1 << DEVICE_NAMES.index(device_name)
+        return "ON" if self.device_bits[row] & bit else "OFF"
+
+    def set_state(self, row, device_name, state):
+        bit = 1 << DEVICE_NAMES.index(device_name)
+        with self.lock:
+            if state == "ON":
+                self.device_bits[row] |= bit
+            else:
+                self.device_bits[row] &= ~np.uint8(bit)
+
+    def device_states(self, row):
+        return {name: self.get_state(row, name) for name in DEVICE_NAMES}
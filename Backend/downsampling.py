@@ -0,0 +1,178 @@
+import math
+from datetime import datetime
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+
+# LTTB picks points out of this many Mongo buckets per requested point
+LTTB_OVERSAMPLE = 4
+
+# Smallest bucket we ask Mongo for, readings arrive every ~10 s
+MIN_BUCKET_SECONDS = 10
+
+
+def bucket_seconds(start_time, end_time, points, resolution=None):
+    """Bucket width in seconds for a range and target point count.
+
+    An explicit resolution (seconds) wins; otherwise the range is split into
+    roughly `points` buckets.
+    """
+    if resolution:
+        return max(int(resolution), 1)
+    span = (end_time - start_time).total_seconds()
+    return max(int(math.ceil(span / max(points, 1))), MIN_BUCKET_SECONDS)
+
+
+def bucket_expression(bucket_ms, field="$timestamp"):
+    """Aggregation expression flooring a date field to its bucket start"""
+    return {"$subtract": [
+        field,
+        {"$mod": [{"$subtract": [field, EPOCH]}, bucket_ms]},
+    ]}
+
+
+def bucket_pipeline(match, fields, bucket_s, last_fields=()):
+    """Aggregation returning one row per time bucket.
+
+    Each numeric field gets its average under the field name plus
+    `<field>_min` / `<field>_max`; last_fields keep the newest value in the
+    bucket (e.g. comfort_level).
+    """
+    group = {"_id": bucket_expression(bucket_s * 1000), "count": {"$sum": 1}}
+    project = {"_id": 0, "timestamp": "$_id", "count": 1}
+    for field in fields:
+        group[f"{field}_avg"] = {"$avg": f"${field}"}
+        group[f"{field}_min"] = {"$min": f"${field}"}
+        group[f"{field}_max"] = {"$max": f"${field}"}
+        project[field] = f"${field}_avg"
+        project[f"{field}_min"] = 1
+        project[f"{field}_max"] = 1
+    for field in last_fields:
+        group[field] = {"$last": f"${field}"}
+        project[field] = 1
+
+    pipeline = [{"$match": match}]
+    if last_fields:
+        pipeline.append({"$sort": {"timestamp": 1}})
+    pipeline += [
+        {"$group": group},
+        {"$sort": {"_id": 1}},
+        {"$project": project},
+    ]
+    return pipeline
+
+
+def concat_bucket_rows(older, newer, fields):
+    """Bucket rows from two consecutive time ranges, as if bucketed together.
+
+    Only a bucket straddling the split can appear in both; it is combined
+    with averages weighted by count.
+    """
+    if not older or not newer or older[-1]["timestamp"] != newer[0]["timestamp"]:
+        return older + newer
+    a, b = older[-1], newer[0]
+    merged = {**b, "count": a["count"] + b["count"]}
+    for field in fields:
+        if a[field] is None or b[field] is None:
+            merged[field] = b[field] if a[field] is None else a[field]
+        else:
+            merged[field] = (a[field] * a["count"] + b[field] * b["count"]) / merged["count"]
+        for suffix, pick in (("_min", min), ("_max", max)):
+            seen = [v for v in (a[field + suffix], b[field + suffix]) if v is not None]
+            merged[field + suffix] = pick(seen) if seen else None
+    return older[:-1] + [merged] + newer[1:]
+
+
+def rows_to_columns(rows, names, numeric):
+    """The arrays columns_stage and to_columns would give for bucket rows"""
+    doc = {name: [row.get(name) for row in rows] for name in names}
+    doc["timestamp"] = [int((row["timestamp"] - EPOCH).total_seconds() * 1000) for row in rows]
+    return to_columns(doc, names, numeric)
+
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: indices of n_out representative points"""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+
+    selected = np.empty(n_out, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def lttb_keep(x, columns, n_out):
+    """Sorted indices LTTB keeps for any of the y columns (NaNs skipped)"""
+    x = np.asarray(x, dtype=np.float64)
+    keep = np.zeros(len(x), dtype=bool)
+    for y in columns:
+        y = np.asarray(y, dtype=np.float64)
+        valid = np.flatnonzero(~np.isnan(y))
+        keep[valid[lttb_indices(x[valid], y[valid], n_out)]] = True
+    return np.flatnonzero(keep)
+
+
+def lttb_rows(rows, fields, n_out):
+    """Thin bucket rows with LTTB, keeping points chosen for any field"""
+    if len(rows) <= n_out:
+        return rows
+    x = np.array([(row["timestamp"] - EPOCH).total_seconds() for row in rows])
+    columns = [np.array([row[field] if row[field] is not None else np.nan for row in rows])
+               for field in fields]
+    return [rows[i] for i in lttb_keep(x, columns, n_out)]
+
+
+def lttb_columns(columns, fields, n_out):
+    """Thin columnar bucket data (see columns_stage) with LTTB"""
+    if len(columns["timestamp"]) <= n_out:
+        return columns
+    keep = lttb_keep(columns["timestamp"], [columns[field] for field in fields], n_out)
+    return {name: values[keep] for name, values in columns.items()}
+
+
+def columns_stage(names):
+    """Final $group turning sorted bucket rows into one array per column.
+
+    Timestamps are pushed as epoch milliseconds, so the whole result is a
+    single document whose arrays load straight into NumPy.
+    """
+    group = {"_id": None}
+    for name in names:
+        if name == "timestamp":
+            # date - date is a millisecond count
+            group[name] = {"$push": {"$subtract": ["$timestamp", EPOCH]}}
+        else:
+            group[name] = {"$push": f"${name}"}
+    return {"$group": group}
+
+
+def to_columns(doc, names, numeric):
+    """NumPy arrays from a columns_stage document (missing values become NaN)"""
+    columns = {}
+    for name in names:
+        values = doc.get(name, []) if doc else []
+        if name in ("timestamp", "count"):
+            columns[name] = np.array(values, dtype=np.int64)
+        elif name in numeric:
+            columns[name] = np.array(values, dtype=np.float64)
+        else:
+            # fromiter keeps list values (comfort_reasons) as single elements
+            columns[name] = np.fromiter(values, dtype=object, count=len(values))
+    return columns
@@ -0,0 +1,219 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+# How often the shared poller looks for new documents
+STREAM_POLL_INTERVAL = 1.0  # seconds
+# Documents can land slightly out of timestamp order (batched, unordered
+# inserts from several processors), so each poll re-reads this much history
+STREAM_OVERLAP = timedelta(seconds=5)
+# Per-client buffer; when full the oldest event is dropped
+STREAM_QUEUE_SIZE = 100
+# Most documents replayed per collection when a client resumes
+STREAM_REPLAY_LIMIT = 1000
+# Documents per query when polling; a poll pages through everything new
+STREAM_POLL_LIMIT = 5000
+# Comment line sent to idle clients so proxies keep the connection open
+STREAM_KEEPALIVE = 15.0  # seconds
+
+DEVICE_STATE_FIELDS = ("ac_state", "purifier_state", "dehumidifier_state")
+# Predictions backfilled by replay.py alongside the live ones are never streamed
+LIVE_PREDICTIONS = {"alongside": None}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def event_id(timestamp):
+    """Sortable SSE event id; MongoDB keeps millisecond precision"""
+    return timestamp.isoformat(timespec='milliseconds')
+
+
+def format_sse(event):
+    """Encode an event as a Server-Sent Events frame"""
+    data = json.dumps(event["data"], default=_json_default)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+class Subscriber:
+    """One connected client: a bounded queue that drops its oldest events"""
+
+    def __init__(self, device_id=None, maxsize=STREAM_QUEUE_SIZE):
+        self.device_id = device_id
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+        # Events at or before this id were already sent by the replay
+        self.replayed_until = None
+
+    def offer(self, event):
+        if self.device_id and event["data"].get("device_id") != self.device_id:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class EventBroadcaster:
+    """Polls MongoDB once per interval and fans new documents out to clients.
+
+    However many clients are connected, each API worker runs a single pair
+    of indexed range queries per interval.
+    """
+
+    def __init__(self, sensor_collection, predictions_collection,
+                 poll_interval=STREAM_POLL_INTERVAL):
+        self.sensor_collection = sensor_collection
+        self.predictions_collection = predictions_collection
+        self.poll_interval = poll_interval
+        self.subscribers = set()
+        self.device_states = {}
+        self.cursor = None
+        self.seen = {}
+        self.task = None
+        self.events_sent = 0
+
+    def subscribe(self, device_id=None):
+        subscriber = Subscriber(device_id)
+        self.subscribers.add(subscriber)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def _newest_timestamp(self):
+        newest = await self.sensor_collection.find_one(sort=[("timestamp", -1)])
+        return newest["timestamp"] if newest else datetime.now()
+
+    async def run(self):
+        # Start from the newest document and prime the overlap window so
+        # documents already in the database are not sent as new. This runs
+        # on every start: clients arriving after an idle spell get only
+        # what is new from then on, not everything since the last poll.
+        self.cursor = await self._newest_timestamp()
+        self.seen = {}
+        await self.poll(emit=False)
+        while self.subscribers:
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"Event stream poll failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+        self.task = None
+
+    async def _fetch(self, collection, since, query=None):
+        """Documents newer than since, oldest first, STREAM_POLL_LIMIT per query.
+
+        Pages continue past the (timestamp, _id) of the last document read,
+        so more documents than one page inside the overlap window cannot
+        stall the cursor.
+        """
+        docs = []
+        after = {"timestamp": {"$gt": since}}
+        while True:
+            cursor = (collection.find({**after, **(query or {})})
+                      .sort([("timestamp", 1), ("_id", 1)]).limit(STREAM_POLL_LIMIT))
+            page = await cursor.to_list(None)
+            docs += page
+            if len(page) < STREAM_POLL_LIMIT:
+                return docs
+            last = page[-1]
+            after = {"$or": [{"timestamp": {"$gt": last["timestamp"]}},
+                             {"timestamp": last["timestamp"], "_id": {"$gt": last["_id"]}}]}
+
+    async def poll(self, emit=True):
+        since = self.cursor - STREAM_OVERLAP
+        readings, predictions = await asyncio.gather(
+            self._fetch(self.sensor_collection, since),
+            self._fetch(self.predictions_collection, since, LIVE_PREDICTIONS))
+
+        events = []
+        for doc in readings:
+            if self._is_new(doc):
+                events.append(self._event("reading", doc))
+        for doc in predictions:
+            if self._is_new(doc):
+                events.append(self._event("prediction", doc))
+                devices_event = self._device_change(doc)
+                if devices_event is not None:
+                    events.append(devices_event)
+        events.sort(key=lambda event: event["id"])
+
+        newest = max((doc["timestamp"] for doc in readings + predictions), default=None)
+        if newest is not None and newest > self.cursor:
+            self.cursor = newest
+        # Forget ids that have fallen out of the overlap window
+        horizon = self.cursor - STREAM_OVERLAP
+        self.seen = {key: ts for key, ts in self.seen.items() if ts >= horizon}
+
+        if not emit:
+            return
+        for event in events:
+            for subscriber in list(self.subscribers):
+                subscriber.offer(event)
+        self.events_sent += len(events)
+
+    def _is_new(self, doc):
+        key = str(doc["_id"])
+        if key in self.seen:
+            return False
+        self.seen[key] = doc["timestamp"]
+        return True
+
+    @staticmethod
+    def _event(event_type, doc):
+        data = {k: v for k, v in doc.items() if k != "_id"}
+        return {"id": event_id(doc["timestamp"]), "type": event_type, "data": data}
+
+    def _device_change(self, prediction):
+        device_id = prediction.get("device_id")
+        states = {field: prediction.get(field) for field in DEVICE_STATE_FIELDS}
+        if self.device_states.get(device_id) == states:
+            return None
+        self.device_states[device_id] = states
+        return {
+            "id": event_id(prediction["timestamp"]),
+            "type": "devices",
+            "data": {"device_id": device_id, **states, "timestamp": prediction["timestamp"]},
+        }
+
+    async def replay(self, subscriber, since):
+        """Send documents newer than `since` that a resuming client missed"""
+        filter_ = {"timestamp": {"$gt": since}}
+        if subscriber.device_id:
+            filter_["device_id"] = subscriber.device_id
+        readings, predictions = await asyncio.gather(
+            self.sensor_collection.find(filter_).sort("timestamp", 1)
+                .limit(STREAM_REPLAY_LIMIT).to_list(None),
+            self.predictions_collection.find({**filter_, **LIVE_PREDICTIONS}).sort("timestamp", 1)
+                .limit(STREAM_REPLAY_LIMIT).to_list(None))
+        events = [self._event("reading", doc) for doc in readings]
+        events += [self._event("prediction", doc) for doc in predictions]
+        events.sort(key=lambda event: event["id"])
+        if events:
+            subscriber.replayed_until = events[-1]["id"]
+        return events
+
+    async def stream(self, subscriber, since=None):
+        """Async generator of SSE frames for one client"""
+        try:
+            if since is not None:
+                for event in await self.replay(subscriber, since):
+                    yield format_sse(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                # Skip live events the replay already covered
+                if subscriber.replayed_until is not None and event["id"] <= subscriber.replayed_until:
+                    continue
+                yield format_sse(event)
+        finally:
+            self.unsubscribe(subscriber)
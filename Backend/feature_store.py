@@ -0,0 +1,308 @@
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from inference_engine import FEATURE_NAMES
+
+SENSOR_FIELDS = ['temperature', 'humidity', 'air_quality']
+
+# Readings are averaged per device over buckets this wide before any window
+# statistics; the same width as the 1-minute rollup, so training on rollups
+# sees the same bucket means as the processor
+FEATURE_RESOLUTION = 60  # seconds
+# Rolling windows, as (label, seconds); multiples of FEATURE_RESOLUTION
+FEATURE_WINDOWS = [('15m', 15 * 60), ('1h', 60 * 60), ('6h', 6 * 60 * 60)]
+# Per window and field: the oldest bucket mean in the window, the mean and
+# standard deviation of the bucket means, and the change per hour since the
+# oldest bucket
+WINDOW_STATS = ['lag', 'mean', 'std', 'rate']
+
+ROLLING_FEATURE_NAMES = [f'{field}_{stat}_{label}'
+                         for label, _ in FEATURE_WINDOWS
+                         for field in SENSOR_FIELDS
+                         for stat in WINDOW_STATS]
+# What models are trained on: the instantaneous features, then the rolling
+# ones. Bundles trained before rolling features use the FEATURE_NAMES prefix.
+MODEL_FEATURE_NAMES = FEATURE_NAMES + ROLLING_FEATURE_NAMES
+
+# Snapshot the processor restores on startup
+FEATURE_STORE_PATH = os.environ.get("FEATURE_STORE_PATH", os.path.join('models', 'feature_store.npz'))
+
+# Relative to the squared mean; far above float64 rounding of the sums
+VARIANCE_EPSILON = 1e-9
+
+MS_PER_HOUR = 60 * 60 * 1000
+EPOCH = datetime(1970, 1, 1)
+
+
+def window_stats(count, total, total_sq, first_value, first_start, value, start):
+    """lag/mean/std/rate for windows of bucket means, stacked on a last axis.
+
+    The one definition used online (FeatureStore) and offline
+    (rolling_features), on scalars or broadcastable arrays: count buckets
+    with sums total and total_sq, oldest bucket first_value starting at
+    first_start, and the current value whose bucket starts at start
+    (epoch ms). An empty window reads as flat at the current value.
+    """
+    n = np.maximum(count, 1)
+    mean = total / n
+    variance = total_sq / n - mean * mean
+    # Variance within rounding of zero (one bucket, a flat signal) is zero, so
+    # the square root does not turn summation-order noise into a feature
+    std = np.sqrt(np.where(variance > VARIANCE_EPSILON * mean * mean, variance, 0.0))
+    hours = (start - first_start) / MS_PER_HOUR
+
+    shape = np.broadcast_shapes(np.shape(mean), np.shape(value), np.shape(first_value))
+    out = np.empty(shape + (len(WINDOW_STATS),))
+    out[..., 0] = first_value
+    out[..., 1] = mean
+    out[..., 2] = std
+    empty = count == 0
+    if np.any(empty):
+        hours = np.where(empty, 1.0, hours)
+        out[..., 0] = np.where(empty, value, out[..., 0])
+        out[..., 1] = np.where(empty, value, out[..., 1])
+        out[..., 2] = np.where(empty, 0.0, out[..., 2])
+    np.divide(value - out[..., 0], hours, out=out[..., 3])
+    return out
+
+
+def rolling_features(timestamp, device, values, windows=FEATURE_WINDOWS, resolution=FEATURE_RESOLUTION):
+    """(n, len(ROLLING_FEATURE_NAMES)) rolling features for readings in any order.
+
+    timestamp is epoch ms, device integer codes and values a dict of field
+    arrays. Each row's windows cover the same device's buckets that start
+    in [row's bucket start - window, row's bucket start); buckets are means
+    of the rows without missing values, as the processor only ever sees
+    complete readings.
+    """
+    n = len(timestamp)
+    out = np.empty((n, len(windows) * len(SENSOR_FIELDS) * len(WINDOW_STATS)))
+    if n == 0:
+        return out
+    current = np.column_stack([values[field][:n] for field in SENSOR_FIELDS]).astype(np.float64)
+    bucket = timestamp[:n] // (resolution * 1000)
+    first_bucket = bucket.min()
+    widest = max(seconds for _, seconds in windows) // resolution
+    # One sorted key per (device, bucket): devices occupy disjoint key ranges
+    stride = int(bucket.max() - first_bucket) + widest + 1
+    key = device[:n].astype(np.int64) * stride + (bucket - first_bucket)
+
+    complete = ~np.isnan(current).any(axis=1)
+    order = np.argsort(key[complete], kind='stable')
+    sorted_key = key[complete][order]
+    if len(sorted_key) == 0:
+        empty = np.zeros(n)
+        stats = window_stats(empty[:, None], 0.0, 0.0, current, 0, current, 0)
+        return np.broadcast_to(stats[:, None], (n, len(windows)) + stats.shape[1:]).reshape(n, -1).copy()
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+    bucket_key = sorted_key[starts]
+    counts = np.diff(np.r_[starts, len(sorted_key)])
+    means = np.add.reduceat(current[complete][order], starts, axis=0) / counts[:, None]
+    cumulative = np.vstack([np.zeros(len(SENSOR_FIELDS)), np.cumsum(means, axis=0)])
+    cumulative_sq = np.vstack([np.zeros(len(SENSOR_FIELDS)), np.cumsum(means * means, axis=0)])
+    bucket_ms = (bucket_key % stride + first_bucket) * (resolution * 1000)
+
+    row_start = (bucket * (resolution * 1000))[:, None]
+    # Buckets before the row's own bucket end at hi
+    hi = np.searchsorted(bucket_key, key, side='left')
+    per_window = []
+    for _, seconds in windows:
+        lo = np.searchsorted(bucket_key, key - seconds // resolution, side='left')
+        first = np.minimum(lo, len(bucket_key) - 1)
+        per_window.append(window_stats(
+            (hi - lo)[:, None],
+            cumulative[hi] - cumulative[lo],
+            cumulative_sq[hi] - cumulative_sq[lo],
+            means[first], bucket_ms[first][:, None],
+            current, row_start))
+    out[:] = np.stack(per_window, axis=1).reshape(n, -1)
+    return out
+
+
+class DeviceWindows:
+    """One device's closed bucket means in a ring, with running sums per window.
+
+    Buckets are pushed in time order and dropped from each window once they
+    start more than the window before the current bucket, so an update
+    costs O(number of windows) whatever the reporting rate. Sums of a
+    window that empties are reset to exactly zero, so rounding does not
+    accumulate over a long-running process.
+    """
+
+    def __init__(self, window_buckets):
+        self.window_buckets = np.asarray(window_buckets, dtype=np.int64)
+        capacity = int(self.window_buckets.max()) + 1
+        n_windows, n_fields = len(window_buckets), len(SENSOR_FIELDS)
+        self.bucket_ids = np.zeros(capacity, dtype=np.int64)
+        self.means = np.zeros((capacity, n_fields))
+        self.heads = np.zeros(n_windows, dtype=np.int64)  # absolute index of each window's oldest bucket
+        self.tail = 0  # absolute index of the next bucket to push
+        self.total = np.zeros((n_windows, n_fields))
+        self.total_sq = np.zeros((n_windows, n_fields))
+        self.current = None  # open bucket id, its value sums and reading count
+        self.current_sum = np.zeros(n_fields)
+        self.current_count = 0
+
+    def _push(self, bucket_id, mean):
+        slot = self.tail % len(self.bucket_ids)
+        self.bucket_ids[slot] = bucket_id
+        self.means[slot] = mean
+        self.tail += 1
+        self.total += mean
+        self.total_sq += mean * mean
+
+    def _evict(self, bucket_id):
+        capacity = len(self.bucket_ids)
+        for w, width in enumerate(self.window_buckets):
+            head = self.heads[w]
+            while head < self.tail and self.bucket_ids[head % capacity] < bucket_id - width:
+                mean = self.means[head % capacity]
+                self.total[w] -= mean
+                self.total_sq[w] -= mean * mean
+                head += 1
+            if head == self.tail:
+                self.total[w] = 0.0
+                self.total_sq[w] = 0.0
+            self.heads[w] = head
+
+    def add(self, bucket_id, values):
+        """Count a reading; closes the open bucket when a later one starts"""
+        if self.current is not None and bucket_id > self.current:
+            self._push(self.current, self.current_sum / self.current_count)
+            self.current = None
+        if self.current is None:
+            self._evict(bucket_id)
+            self.current = bucket_id
+            self.current_sum[:] = 0.0
+            self.current_count = 0
+        # A clock step backwards keeps counting into the open bucket
+        self.current_sum += values
+        self.current_count += 1
+
+    def stats(self, values, resolution_ms):
+        """(windows, fields, stats) window_stats of the closed buckets for the open one"""
+        first = self.heads % len(self.bucket_ids)
+        return window_stats((self.tail - self.heads)[:, None], self.total, self.total_sq,
+                            self.means[first], (self.bucket_ids[first] * resolution_ms)[:, None],
+                            values, self.current * resolution_ms)
+
+    def closed(self):
+        """(bucket ids, means) still inside the widest window, oldest first"""
+        indices = np.arange(self.heads.min(), self.tail) % len(self.bucket_ids)
+        return self.bucket_ids[indices], self.means[indices]
+
+
+class FeatureStore:
+    """Per-device rolling features, updated in O(1) per reading.
+
+    update() folds a complete reading into its device's open bucket and
+    returns the full MODEL_FEATURE_NAMES vector for it. The statistics come
+    from window_stats, the same definition training uses through
+    rolling_features, so online and offline features agree. Readings arrive
+    on the MQTT thread and snapshots are taken from the main loop, so state
+    is behind a lock.
+    """
+
+    def __init__(self, windows=FEATURE_WINDOWS, resolution=FEATURE_RESOLUTION):
+        self.windows = list(windows)
+        self.resolution_ms = resolution * 1000
+        self.window_buckets = [seconds // resolution for _, seconds in self.windows]
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def _device(self, device_id):
+        windows = self.devices.get(device_id)
+        if windows is None:
+            windows = self.devices[device_id] = DeviceWindows(self.window_buckets)
+        return windows
+
+    def update(self, device_id, timestamp, reading):
+        """Feature vector (MODEL_FEATURE_NAMES order) for a reading taken at a naive datetime"""
+        values = np.array([reading[field] for field in SENSOR_FIELDS], dtype=np.float64)
+        bucket_id = ((timestamp - EPOCH) // timedelta(milliseconds=1)) // self.resolution_ms
+        with self.lock:
+            windows = self._device(device_id)
+            windows.add(bucket_id, values)
+            stats = windows.stats(values, self.resolution_ms)
+        return np.concatenate([values, (timestamp.hour, timestamp.weekday()), stats.ravel()])
+
+    def save(self, path=FEATURE_STORE_PATH):
+        """Write a snapshot (closed buckets and open bucket per device) atomically"""
+        device_ids, bucket_devices, bucket_ids, means = [], [], [], []
+        open_ids, open_sums, open_counts = [], [], []
+        with self.lock:
+            for code, (device_id, windows) in enumerate(self.devices.items()):
+                ids, device_means = windows.closed()
+                device_ids.append('' if device_id is None else device_id)
+                bucket_devices.append(np.full(len(ids), code, dtype=np.int64))
+                bucket_ids.append(ids)
+                means.append(device_means)
+                open_ids.append(-1 if windows.current is None else windows.current)
+                open_sums.append(windows.current_sum.copy())
+                open_counts.append(windows.current_count)
+        n_fields = len(SENSOR_FIELDS)
+        arrays = {
+            'device_ids': np.array(device_ids, dtype=str),
+            'bucket_device': np.concatenate(bucket_devices) if bucket_devices else np.empty(0, np.int64),
+            'bucket_ids': np.concatenate(bucket_ids) if bucket_ids else np.empty(0, np.int64),
+            'means': np.concatenate(means) if means else np.empty((0, n_fields)),
+            'open_ids': np.array(open_ids, dtype=np.int64),
+            'open_sums': np.array(open_sums).reshape(-1, n_fields),
+            'open_counts': np.array(open_counts, dtype=np.int64),
+            'window_buckets': np.array(self.window_buckets, dtype=np.int64),
+            'resolution_ms': np.array(self.resolution_ms, dtype=np.int64),
+        }
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def restore(self, path=FEATURE_STORE_PATH):
+        """Load a snapshot taken with the same windows; returns the number of devices restored.
+
+        Running sums are rebuilt from the saved bucket means, not saved
+        themselves.
+        """
+        with np.load(path, allow_pickle=False) as snapshot:
+            if (snapshot['window_buckets'].tolist() != self.window_buckets
+                    or int(snapshot['resolution_ms']) != self.resolution_ms):
+                raise ValueError("Feature store snapshot was taken with other windows")
+            arrays = {name: snapshot[name] for name in snapshot.files}
+
+        devices = {}
+        for code, device_id in enumerate(arrays['device_ids'].tolist()):
+            windows = DeviceWindows(self.window_buckets)
+            rows = arrays['bucket_device'] == code
+            for bucket_id, mean in zip(arrays['bucket_ids'][rows].tolist(), arrays['means'][rows]):
+                windows._push(bucket_id, mean)
+            if arrays['open_ids'][code] >= 0:
+                windows._evict(int(arrays['open_ids'][code]))
+                windows.current = int(arrays['open_ids'][code])
+                windows.current_sum[:] = arrays['open_sums'][code]
+                windows.current_count = int(arrays['open_counts'][code])
+            devices[device_id or None] = windows
+        with self.lock:
+            self.devices = devices
+        return len(devices)
+
+
+def standalone_features(reading, hour, day_of_week):
+    """Feature vector for a reading with no history: every window reads as flat"""
+    values = np.array([reading[field] for field in SENSOR_FIELDS], dtype=np.float64)
+    stats = window_stats(0, 0.0, 0.0, values, 0, values, 0)
+    flat = np.broadcast_to(stats, (len(FEATURE_WINDOWS),) + stats.shape)
+    return np.concatenate([values, (hour, day_of_week), flat.ravel()])
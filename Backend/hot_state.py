@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import quote, urlparse
+
+# Where the processor publishes the latest state for the API to read.
+#   file:///dev/shm/iot_hot_state   directory on tmpfs, shared by local processes
+#   redis://host:6379/0             Redis, for processors/APIs on several hosts
+_default_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+HOT_STATE_URL = os.environ.get(
+    "HOT_STATE_URL", "file://" + os.path.join(_default_dir, "iot_hot_state"))
+
+# Entries older than this are treated as missing (processor not running)
+HOT_STATE_MAX_AGE = float(os.environ.get("HOT_STATE_MAX_AGE", "120"))
+
+# Key holding the newest state across all devices
+ALL_DEVICES = "__all__"
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def device_key(device_id):
+    return f"latest:{device_id or ALL_DEVICES}"
+
+
+class FileHotStateStore:
+    """One JSON file per key, replaced atomically on every publish.
+
+    On tmpfs this is a shared-memory store: reads and writes never touch
+    disk and any number of API workers can read concurrently.
+    """
+
+    # Reads are local and cheap enough to make on the event loop
+    blocking = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, quote(key, safe='') + '.json')
+
+    def set(self, key, value):
+        data = json.dumps(value, default=_json_default).encode()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+class RedisHotStateStore:
+    """Hot state in Redis, for deployments spanning several hosts"""
+
+    # Every call is a network round trip, so async callers use a thread
+    blocking = True
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def set(self, key, value):
+        self.redis.set(key, json.dumps(value, default=_json_default))
+
+    def get(self, key):
+        data = self.redis.get(key)
+        return json.loads(data) if data is not None else None
+
+
+def open_store(url=HOT_STATE_URL):
+    parsed = urlparse(url)
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisHotStateStore(url)
+    if parsed.scheme == 'file':
+        return FileHotStateStore(parsed.path)
+    raise ValueError(f"Unsupported HOT_STATE_URL: {url}")
+
+
+class HotState:
+    """Latest reading, prediction and device states per device"""
+
+    def __init__(self, store=None, max_age=HOT_STATE_MAX_AGE):
+        self.store = store if store is not None else open_store()
+        self.max_age = max_age
+
+    def publish(self, device_id, sensor, prediction, devices):
+        state = {
+            'sensor': sensor,
+            'prediction': prediction,
+            'devices': devices,
+            'updated_at': time.time(),
+        }
+        self.store.set(device_key(device_id), state)
+        self.store.set(device_key(None), state)
+
+    def latest(self, device_id=None):
+        """Fresh state for a device (or across all devices), None if cold"""
+        state = self.store.get(device_key(device_id))
+        if state is None or time.time() - state.get('updated_at', 0) > self.max_age:
+            return None
+        return state
@@ -0,0 +1,261 @@
+import threading
+
+import numpy as np
+
+# Instantaneous features and target order shared by training and inference;
+# models now also take rolling features after these (see feature_store)
+FEATURE_NAMES = ['temperature', 'humidity', 'air_quality', 'hour', 'day_of_week']
+TARGET_NAMES = ['temperature', 'humidity', 'air_quality']
+
+# Rows per chunk when predicting a batch, bounds the (trees x rows) work arrays
+BATCH_CHUNK = 4096
+
+# Arrays that fully describe a compiled engine, with the dtype each is stored in
+ENGINE_ARRAYS = {
+    'feature': np.intp,
+    'threshold': np.float64,
+    'left': np.intp,
+    'right': np.intp,
+    'value': np.float64,
+    'roots': np.intp,
+    'tree_weight': np.float64,
+    'bias': np.float64,
+}
+
+
+def _float32_split_bound(threshold):
+    """Float64 bound b such that float32(x) <= threshold  <=>  x < b.
+
+    sklearn trees cast inputs to float32 before comparing against float64
+    thresholds, and thresholds on discrete features (hour, day_of_week) can
+    sit exactly on a float32 value. The bound is the midpoint between the
+    largest float32 <= threshold and the next float32 up, so folded
+    comparisons on raw float64 inputs take the same branch as sklearn.
+    """
+    lower = threshold.astype(np.float32)
+    lower = np.where(lower > threshold, np.nextafter(lower, np.float32(-np.inf)), lower)
+    upper = np.nextafter(lower, np.float32(np.inf))
+    return (lower.astype(np.float64) + upper.astype(np.float64)) / 2
+
+
+def _estimator_trees(estimator, n_features):
+    """Return (trees, per-tree weight, bias) for a fitted tree ensemble.
+
+    Supports RandomForest/ExtraTrees regressors (mean of trees), a single
+    DecisionTreeRegressor and GradientBoostingRegressor (init + lr * sum).
+    """
+    if hasattr(estimator, 'tree_'):
+        return [estimator.tree_], [1.0], 0.0
+
+    trees = getattr(estimator, 'estimators_', None)
+    if trees is None:
+        raise TypeError(f"Unsupported estimator: {type(estimator).__name__}")
+
+    if hasattr(estimator, 'learning_rate'):
+        # Gradient boosting: estimators_ is (n_stages, K) of trees
+        trees = [t.tree_ for t in np.asarray(trees).ravel()]
+        init = estimator.init_
+        if isinstance(init, str):
+            bias = 0.0
+        else:
+            bias = np.ravel(init.predict(np.zeros((1, n_features))))
+        return trees, [estimator.learning_rate] * len(trees), bias
+
+    trees = [t.tree_ for t in trees]
+    return trees, [1.0 / len(trees)] * len(trees), 0.0
+
+
+class ForestEngine:
+    """Flattened tree ensembles evaluated with NumPy.
+
+    All trees of all models are packed into contiguous node arrays. Leaves
+    point at themselves, so traversal is a fixed number of vectorised steps
+    (the deepest tree's depth) with no per-tree Python loop. When a scaler is
+    given its transform is folded into the split thresholds, so raw feature
+    values go straight in.
+
+    A row goes left when x < threshold; thresholds are stored as float32
+    rounding bounds (see _float32_split_bound).
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots,
+                 tree_weight, bias, max_depth, n_features=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.tree_weight = tree_weight
+        self.bias = bias
+        self.max_depth = max_depth
+        self.n_targets = value.shape[1]
+        # Models see a prefix of the feature vector, the older the fewer
+        self.n_features = n_features or len(FEATURE_NAMES)
+        self._local = threading.local()
+
+    @classmethod
+    def from_models(cls, heads, scaler=None, n_targets=None):
+        """Build an engine from [(estimator, [target index, ...]), ...].
+
+        Each head predicts the listed targets; a single-output model uses
+        one index, a multi-output model lists all of its outputs in order.
+        """
+        n_features = getattr(heads[0][0], 'n_features_in_', len(FEATURE_NAMES))
+        if n_targets is None:
+            n_targets = max(i for _, targets in heads for i in targets) + 1
+
+        if scaler is not None:
+            mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+            scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+        else:
+            mean, scale = np.zeros(n_features), np.ones(n_features)
+
+        features, thresholds, lefts, rights, values = [], [], [], [], []
+        roots, weights = [], []
+        bias = np.zeros(n_targets)
+        max_depth = 0
+        offset = 0
+
+        for estimator, targets in heads:
+            trees, tree_weights, head_bias = _estimator_trees(estimator, n_features)
+            bias[targets] += head_bias
+
+            for tree, weight in zip(trees, tree_weights):
+                n = tree.node_count
+                is_leaf = tree.children_left == -1
+                local = np.arange(n)
+
+                feat = np.where(is_leaf, 0, tree.feature).astype(np.intp)
+                # x_scaled <= t  <=>  x <= t * scale + mean  (scale > 0)
+                bound = _float32_split_bound(tree.threshold)
+                thr = np.where(is_leaf, 0.0, bound * scale[feat] + mean[feat])
+
+                node_value = np.zeros((n, n_targets))
+                node_value[:, targets] = tree.value[:, :len(targets), 0]
+
+                features.append(feat)
+                thresholds.append(thr)
+                lefts.append(np.where(is_leaf, local, tree.children_left) + offset)
+                rights.append(np.where(is_leaf, local, tree.children_right) + offset)
+                values.append(node_value)
+                roots.append(offset)
+                weights.append(weight)
+                max_depth = max(max_depth, tree.max_depth)
+                offset += n
+
+        return cls(
+            feature=np.ascontiguousarray(np.concatenate(features), dtype=np.intp),
+            threshold=np.ascontiguousarray(np.concatenate(thresholds), dtype=np.float64),
+            left=np.ascontiguousarray(np.concatenate(lefts), dtype=np.intp),
+            right=np.ascontiguousarray(np.concatenate(rights), dtype=np.intp),
+            value=np.ascontiguousarray(np.concatenate(values), dtype=np.float64),
+            roots=np.asarray(roots, dtype=np.intp),
+            tree_weight=np.asarray(weights, dtype=np.float64),
+            bias=bias,
+            max_depth=max_depth,
+            n_features=n_features,
+        )
+
+    def arrays(self):
+        """The engine's arrays by ENGINE_ARRAYS name, enough to rebuild it with max_depth"""
+        return {name: np.ascontiguousarray(getattr(self, name), dtype=dtype)
+                for name, dtype in ENGINE_ARRAYS.items()}
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _buffers(self):
+        # Work arrays for predict_one, one set per thread
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            n = self.n_trees
+            buffers = {
+                'nodes': np.empty(n, dtype=np.intp),
+                'feat': np.empty(n, dtype=np.intp),
+                'child': np.empty(n, dtype=np.intp),
+                'x': np.empty(n, dtype=np.float64),
+                'thr': np.empty(n, dtype=np.float64),
+                'mask': np.empty(n, dtype=bool),
+                'leaf_values': np.empty((n, self.n_targets), dtype=np.float64),
+                'out': np.empty(self.n_targets, dtype=np.float64),
+            }
+            self._local.buffers = buffers
+        return buffers
+
+    def predict_one(self, x):
+        """Predict one feature row (the first n_features of MODEL_FEATURE_NAMES).
+
+        Reuses per-thread work arrays, so steady-state calls do not allocate
+        beyond the returned result.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        b = self._buffers()
+        nodes, feat, child = b['nodes'], b['feat'], b['child']
+        xv, thr, mask = b['x'], b['thr'], b['mask']
+
+        np.copyto(nodes, self.roots)
+        for _ in range(self.max_depth):
+            np.take(self.feature, nodes, out=feat)
+            np.take(x, feat, out=xv)
+            np.take(self.threshold, nodes, out=thr)
+            # mask marks trees that branch right
+            np.greater_equal(xv, thr, out=mask)
+            np.take(self.right, nodes, out=child)
+            np.take(self.left, nodes, out=nodes)
+            np.copyto(nodes, child, where=mask)
+
+        np.take(self.value, nodes, axis=0, out=b['leaf_values'])
+        np.dot(self.tree_weight, b['leaf_values'], out=b['out'])
+        return b['out'] + self.bias
+
+    def predict(self, X):
+        """Predict a (n_rows, n_features) array, returns (n_rows, n_targets)"""
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        out = np.empty((X.shape[0], self.n_targets))
+        for start in range(0, X.shape[0], BATCH_CHUNK):
+            chunk = X[start:start + BATCH_CHUNK]
+            out[start:start + len(chunk)] = self._predict_chunk(chunk)
+        return out
+
+    def _predict_chunk(self, X):
+        n_rows = X.shape[0]
+        flat_x = X.ravel()
+        row_offset = np.arange(n_rows) * X.shape[1]
+
+        # nodes[t, r] is the current node of tree t for row r
+        nodes = np.repeat(self.roots[:, None], n_rows, axis=1)
+        for _ in range(self.max_depth):
+            feat = self.feature[nodes]
+            go_left = flat_x[feat + row_offset] < self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        # (trees, rows, targets) weighted sum over trees
+        leaf_values = self.value[nodes]
+        return np.einsum('t,trk->rk', self.tree_weight, leaf_values) + self.bias
+
+
+def legacy_heads(temp_model, humid_model, air_quality_model):
+    """Heads for the three single-target forests used by the processor"""
+    return [(temp_model, [0]), (humid_model, [1]), (air_quality_model, [2])]
+
+
+_engine_cache = {}
+
+
+def engine_for(temp_model, humid_model, air_quality_model, scaler):
+    """Cached engine for a model set, rebuilt only when a model object changes"""
+    key = (id(temp_model), id(humid_model), id(air_quality_model), id(scaler))
+    cached = _engine_cache.get(key)
+    if cached is None:
+        engine = ForestEngine.from_models(
+            legacy_heads(temp_model, humid_model, air_quality_model), scaler)
+        # Keep the models referenced so their ids cannot be reused
+        cached = (engine, (temp_model, humid_model, air_quality_model, scaler))
+        if len(_engine_cache) >= 4:
+            _engine_cache.clear()
+        _engine_cache[key] = cached
+    return cached[0]
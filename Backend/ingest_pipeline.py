@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+
+from device_state import device_shard
+
+# What a stage does when its queue is full
+OVERLOAD_POLICIES = ('block', 'shed')
+
+# Put after the last item of a queue to stop its worker
+_STOP = object()
+
+
+class Stage:
+    """Worker threads fed by bounded queues, one queue per worker.
+
+    put(key, item) routes every item with the same key (a device id) to the
+    same worker, so each device's items are handled in arrival order while
+    different devices run side by side. When the worker's queue is full,
+    overload='block' makes put() wait for room, which slows the caller down
+    (backpressure); overload='shed' drops the item and counts it instead.
+
+    handler(item) runs on the worker thread. Exceptions are counted and
+    printed, and the worker carries on with the next item. after(wait)
+    is called with the seconds each item spent queued.
+    """
+
+    def __init__(self, name, handler, workers=1, queue_size=1000, overload='block', after=None):
+        if overload not in OVERLOAD_POLICIES:
+            raise ValueError(f"overload must be one of {OVERLOAD_POLICIES}, not {overload!r}")
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.overload = overload
+        self.after = after
+
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # Counters
+        self.processed = 0
+        self.shed = 0
+        self.errors = 0
+        self.blocked_seconds = 0.0
+
+    def start(self):
+        if self._threads:
+            return
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(q,),
+                                      name=f"pipeline-{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, key, item):
+        """Queue item for the worker owning key; False if it was shed"""
+        q = self._queues[device_shard(key, self.workers) if self.workers > 1 else 0]
+        entry = (time.perf_counter(), item)
+        try:
+            q.put_nowait(entry)
+            return True
+        except queue.Full:
+            if self.overload == 'shed':
+                with self._lock:
+                    self.shed += 1
+                return False
+        started = time.perf_counter()
+        q.put(entry)
+        with self._lock:
+            self.blocked_seconds += time.perf_counter() - started
+        return True
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q):
+        while True:
+            entry = q.get()
+            if entry is _STOP:
+                return
+            queued_at, item = entry
+            if self.after is not None:
+                self.after(time.perf_counter() - queued_at)
+            try:
+                self.handler(item)
+                failed = False
+            except Exception as e:
+                failed = True
+                print(f"Pipeline stage {self.name} failed: {e}")
+            with self._lock:
+                self.processed += 1
+                self.errors += failed
+
+    def stop(self):
+        """Handle everything already queued, then stop the workers"""
+        if not self._threads:
+            return
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'overload': self.overload,
+            'queue_depth': self.depth(),
+            'queue_size': self.queue_size * self.workers,
+            'processed': self.processed,
+            'shed': self.shed,
+            'errors': self.errors,
+            'blocked_seconds': self.blocked_seconds,
+        }
+
+
+class Pipeline:
+    """Stages in the order items flow through them.
+
+    stop() drains them in that order: a stage is only stopped once every
+    stage feeding it has stopped, so nothing queued is lost on shutdown.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
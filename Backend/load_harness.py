@@ -0,0 +1,437 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+import numpy as np
+
+from data_loader import SENSOR_FIELDS
+from device_state import DEFAULT_DEVICE_ID
+from synthetic_data import generate as generate_synthetic
+
+PERCENTILES = (50, 95, 99)
+BACKLOG_SAMPLE_INTERVAL = 0.1  # seconds
+PREDICTION_POLL_INTERVAL = 0.02  # seconds, broker mode only
+DRAIN_TIMEOUT = 30.0  # seconds to wait for the processor to catch up
+# Share of readings with a spike, so control messages are exercised too
+ANOMALY_RATE = 0.02
+
+
+def sensor_topic(device_id, field):
+    """Per-field topic, or the combined JSON topic when field is None"""
+    base = "home/sensors" if device_id == DEFAULT_DEVICE_ID else f"home/{device_id}/sensors"
+    return base if field is None else f"{base}/{field}"
+
+
+def latency_summary(samples):
+    """Count, mean and percentiles in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    ms = np.asarray(samples) * 1000
+    summary = {'count': int(len(ms)), 'mean_ms': float(ms.mean()), 'max_ms': float(ms.max())}
+    for p, value in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+        summary[f'p{p}_ms'] = float(value)
+    return summary
+
+
+def backlog_summary(samples):
+    if not samples:
+        return {'max': 0, 'mean': 0.0, 'final': 0}
+    return {'max': int(max(samples)), 'mean': float(np.mean(samples)), 'final': int(samples[-1])}
+
+
+class LatencyTracker:
+    """Pairs published messages with the predictions and control messages they cause.
+
+    The processor predicts once per complete sample set: a combined
+    message, or one message per field (a repeated field starts a new set,
+    as in DeviceStateTable.collect). Predictions are matched to the publish
+    times of the messages completing a set, first-in first-out per device.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fields_seen = defaultdict(set)
+        self.pending = defaultdict(deque)
+        self.last_published = {}
+        self.prediction = []
+        self.control = []
+        self.published_count = 0
+        self.predicted_count = 0
+
+    def published(self, device_id, field, published_at):
+        with self.lock:
+            self.published_count += 1
+            self.last_published[device_id] = published_at
+            fields = self.fields_seen[device_id]
+            if field in fields:
+                fields.clear()
+            fields.update(SENSOR_FIELDS if field is None else (field,))
+            if len(fields) == len(SENSOR_FIELDS):
+                fields.clear()
+                self.pending[device_id].append(published_at)
+
+    def predictions_inserted(self, docs, inserted_at):
+        with self.lock:
+            for doc in docs:
+                waiting = self.pending.get(doc.get('device_id'))
+                if waiting:
+                    self.prediction.append(inserted_at - waiting.popleft())
+                    self.predicted_count += 1
+
+    def control_published(self, device_id, published_at, received_at):
+        with self.lock:
+            if published_at is None:
+                published_at = self.last_published.get(device_id)
+            if published_at is not None:
+                self.control.append(received_at - published_at)
+
+    def in_flight(self):
+        with self.lock:
+            return sum(len(waiting) for waiting in self.pending.values())
+
+
+def sensor_messages(devices, interval, duration, seed, anomaly_rate=ANOMALY_RATE, combined=False):
+    """(device_id, field, payload) tuples in publish order, from synthetic readings.
+
+    combined=True sends each reading as one JSON message (field None).
+    """
+    steps = max(int(duration / interval), 1)
+    columns, _ = generate_synthetic(devices=devices, days=steps * interval / 86400,
+                                    interval=interval, seed=seed, anomaly_rate=anomaly_rate)
+    device_ids = np.asarray(columns.device_ids, dtype=object)[columns.device]
+    values = [np.char.mod('%.2f', columns.values[field]) for field in SENSOR_FIELDS]
+    for i in range(len(columns)):
+        if combined:
+            payload = ', '.join(f'"{field}": {field_values[i]}' for field, field_values in zip(SENSOR_FIELDS, values))
+            yield device_ids[i], None, '{' + payload + '}'
+            continue
+        for field, field_values in zip(SENSOR_FIELDS, values):
+            yield device_ids[i], field, field_values[i]
+
+
+def publish_paced(messages, rate, publish):
+    """Publish messages open-loop at `rate` per second; returns (count, elapsed)"""
+    start = time.perf_counter()
+    count = 0
+    for count, (device_id, field, payload) in enumerate(messages, 1):
+        due = start + (count - 1) / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        publish(device_id, field, payload)
+    return count, time.perf_counter() - start
+
+
+def sample_backlog(measure, samples, stop):
+    while not stop.wait(BACKLOG_SAMPLE_INTERVAL):
+        samples.append(measure())
+
+
+# --- Hermetic run: in-process fake broker and Mongo stand-in ---
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeMqttClient:
+    """What the processor publishes control messages through"""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.current = None  # (device_id, publish time) of the message being handled
+        self.published = 0
+
+    def publish(self, topic, payload):
+        self.published += 1
+        if self.current is None:
+            # Published from a pipeline worker: time it from the device's latest message
+            parts = topic.split('/')
+            device_id = DEFAULT_DEVICE_ID if parts[1] == 'devices' else parts[1]
+            self.tracker.control_published(device_id, None, time.perf_counter())
+            return
+        device_id, published_at = self.current
+        self.tracker.control_published(device_id, published_at, time.perf_counter())
+
+
+class MemoryCollection:
+    """Counts writes instead of storing them"""
+
+    def __init__(self, name, on_insert=None):
+        self.name = name
+        self.on_insert = on_insert
+        self.inserted = 0
+        self.bulk_ops = 0
+
+    def insert_many(self, docs, ordered=True):
+        self.inserted += len(docs)
+        if self.on_insert is not None:
+            self.on_insert(docs, time.perf_counter())
+
+    def bulk_write(self, requests, ordered=True):
+        self.bulk_ops += len(requests)
+
+    def estimated_document_count(self):
+        return self.inserted
+
+
+class MemoryDatabase:
+    def __init__(self, hooks=None):
+        self.hooks = hooks or {}
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name, self.hooks.get(name))
+        return self.collections[name]
+
+
+class MemoryHotStateStore:
+    blocking = False
+
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def get(self, key):
+        return self.data.get(key)
+
+
+def _sample_bundle(seed):
+    """Small in-memory bundle for when no trained models are on disk"""
+    from sklearn.ensemble import RandomForestRegressor
+    from data_loader import training_arrays
+    from model_bundle import ModelBundle
+
+    columns, _ = generate_synthetic(days=5, interval=600, seed=seed)
+    features, targets = training_arrays(columns)
+    model = RandomForestRegressor(n_estimators=20, random_state=seed).fit(features, targets)
+    return ModelBundle('load-harness', [(model, [0, 1, 2])], None)
+
+
+def install_stand_ins(mp, tracker, seed):
+    """Point the processor's writers and hot state at in-memory stand-ins"""
+    from batch_writer import BatchWriter
+    from hot_state import HotState
+    from rollups import RollupWriter
+
+    db = MemoryDatabase({'predictions': tracker.predictions_inserted})
+    mp.db = db
+    mp.sensor_data_collection = db['sensor_data']
+    mp.predictions_collection = db['predictions']
+    mp.rollup_writer = RollupWriter(db)
+    mp.sensor_writer = BatchWriter(db['sensor_data'], mp.WRITE_BATCH_SIZE, mp.WRITE_BATCH_DELAY,
+                                   after_flush=mp.rollup_writer.apply)
+    mp.prediction_writer = BatchWriter(db['predictions'], mp.WRITE_BATCH_SIZE, mp.WRITE_BATCH_DELAY)
+    mp.hot_state = HotState(store=MemoryHotStateStore())
+    mp.INSTANCE_COUNT = 1
+
+    mp.load_models()
+    if mp.current_bundle is None:
+        mp.current_bundle = _sample_bundle(seed)
+    return db
+
+
+def run_hermetic(devices, interval, duration, seed=0, combined=False, pipeline=False):
+    import mqtt_processor as mp
+
+    tracker = LatencyTracker()
+    install_stand_ins(mp, tracker, seed)
+    client = FakeMqttClient(tracker)
+    broker = queue.Queue()
+    processed = [0]
+
+    def dispatch():
+        # paho delivers messages on a single network thread, so does this
+        while True:
+            item = broker.get()
+            if item is None:
+                break
+            topic, payload, device_id, published_at = item
+            if not pipeline:
+                client.current = (device_id, published_at)
+            mp.on_message(client, None, FakeMessage(topic, payload))
+            processed[0] += 1
+
+    def publish(device_id, field, payload):
+        published_at = time.perf_counter()
+        tracker.published(device_id, field, published_at)
+        broker.put((sensor_topic(device_id, field), payload.encode(), device_id, published_at))
+
+    mp.sensor_writer.start()
+    mp.prediction_writer.start()
+    if pipeline:
+        mp.start_pipeline(client)
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+    backlog, stop = [], threading.Event()
+    sampler = threading.Thread(target=sample_backlog, args=(broker.qsize, backlog, stop), daemon=True)
+    sampler.start()
+
+    rate = devices * (1 if combined else len(SENSOR_FIELDS)) / interval
+    start = time.perf_counter()
+    published, publish_elapsed = publish_paced(
+        sensor_messages(devices, interval, duration, seed, combined=combined), rate, publish)
+    broker.put(None)
+    dispatcher.join(DRAIN_TIMEOUT)
+    pipeline_stats = mp.pipeline_stats()
+    mp.stop_pipeline()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    mp.sensor_writer.stop()
+    mp.prediction_writer.stop()
+
+    report = build_report('hermetic', devices, interval, duration, seed, tracker, backlog,
+                          published, processed[0], publish_elapsed, elapsed)
+    report['config']['combined'] = combined
+    report['config']['pipeline'] = pipeline
+    report['messages']['control_published'] = client.published
+    report['sample_sets'] = {key[0]: value for key, value in mp.SAMPLE_SETS.values.items()}
+    report['writers'] = mp.writer_stats()
+    if pipeline:
+        report['pipeline'] = pipeline_stats
+    return report
+
+
+# --- Broker run: real MQTT broker and a separately started mqtt_processor ---
+
+def run_broker(devices, interval, duration, seed=0, host="localhost", port=1883,
+               mongo_uri="mongodb://localhost:27017/", combined=False):
+    """Drive a running mqtt_processor through a broker and watch its outputs.
+
+    Control latency is measured from the device's last published message to
+    the control message arriving back through the broker; prediction
+    latency from publish to the document showing up in `predictions`
+    (polled, so it includes up to PREDICTION_POLL_INTERVAL of delay).
+    """
+    import paho.mqtt.client as mqtt
+    import pymongo
+
+    tracker = LatencyTracker()
+    predictions = pymongo.MongoClient(mongo_uri)["iot_monitoring"]["predictions"]
+    newest = predictions.find_one(sort=[('_id', -1)])
+    last_id = [newest['_id'] if newest else None]
+    control_count = [0]
+
+    def on_control(client, userdata, msg):
+        parts = msg.topic.split('/')
+        device_id = DEFAULT_DEVICE_ID if parts[1] == 'devices' else parts[1]
+        control_count[0] += 1
+        tracker.control_published(device_id, None, time.perf_counter())
+
+    subscriber = mqtt.Client()
+    subscriber.on_message = on_control
+    subscriber.connect(host, port, 60)
+    subscriber.subscribe([("home/devices/#", 0), ("home/+/devices/#", 0)])
+    subscriber.loop_start()
+
+    publisher = mqtt.Client()
+    publisher.connect(host, port, 60)
+    publisher.loop_start()
+
+    stop = threading.Event()
+
+    def poll_predictions():
+        while not stop.wait(PREDICTION_POLL_INTERVAL):
+            query = {'_id': {'$gt': last_id[0]}} if last_id[0] is not None else {}
+            docs = list(predictions.find(query, {'device_id': 1}).sort('_id', 1))
+            if docs:
+                last_id[0] = docs[-1]['_id']
+                tracker.predictions_inserted(docs, time.perf_counter())
+
+    def publish(device_id, field, payload):
+        tracker.published(device_id, field, time.perf_counter())
+        publisher.publish(sensor_topic(device_id, field), payload)
+
+    poller = threading.Thread(target=poll_predictions, daemon=True)
+    poller.start()
+    backlog = []
+    sampler = threading.Thread(target=sample_backlog, args=(tracker.in_flight, backlog, stop), daemon=True)
+    sampler.start()
+
+    rate = devices * (1 if combined else len(SENSOR_FIELDS)) / interval
+    start = time.perf_counter()
+    published, publish_elapsed = publish_paced(
+        sensor_messages(devices, interval, duration, seed, combined=combined), rate, publish)
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while tracker.in_flight() and time.perf_counter() < deadline:
+        time.sleep(PREDICTION_POLL_INTERVAL)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    publisher.loop_stop()
+    subscriber.loop_stop()
+
+    processed = tracker.predicted_count
+    report = build_report('broker', devices, interval, duration, seed, tracker, backlog,
+                          published, processed, publish_elapsed, elapsed)
+    report['messages']['control_published'] = control_count[0]
+    report['config']['broker'] = f"{host}:{port}"
+    report['config']['combined'] = combined
+    return report
+
+
+def build_report(mode, devices, interval, duration, seed, tracker, backlog,
+                 published, processed, publish_elapsed, elapsed):
+    return {
+        'mode': mode,
+        'generated_at': datetime.now().isoformat(),
+        'config': {'devices': devices, 'interval': interval, 'duration': duration, 'seed': seed},
+        'messages': {'published': published, 'processed': processed,
+                     'predictions': tracker.predicted_count},
+        'throughput': {
+            'offered_msgs_per_sec': published / publish_elapsed if publish_elapsed else 0.0,
+            'processed_msgs_per_sec': processed / elapsed if elapsed else 0.0,
+            'elapsed_s': elapsed,
+            'drain_s': max(elapsed - publish_elapsed, 0.0),
+        },
+        'latency_ms': {
+            'prediction_insert': latency_summary(tracker.prediction),
+            'control_publish': latency_summary(tracker.control),
+        },
+        'backlog': backlog_summary(backlog),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest load test for mqtt_processor")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=10, help="seconds between readings per device")
+    parser.add_argument('--duration', type=float, default=60, help="seconds of load to publish")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--broker', help="host[:port] of a broker with mqtt_processor running; "
+                                         "omit for an in-process run")
+    parser.add_argument('--mongo-uri', default="mongodb://localhost:27017/")
+    parser.add_argument('--report', help="write the JSON report here instead of stdout")
+    parser.add_argument('--combined', action='store_true',
+                        help="publish each reading as one JSON message instead of one per field")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="in-process runs only: hand messages to the staged pipeline "
+                             "instead of handling them inside on_message")
+    args = parser.parse_args()
+
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        report = run_broker(args.devices, args.interval, args.duration, args.seed,
+                            host, int(port or 1883), args.mongo_uri, combined=args.combined)
+    else:
+        report = run_hermetic(args.devices, args.interval, args.duration, args.seed,
+                              combined=args.combined, pipeline=args.pipeline)
+
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text + '\n')
+        print(f"Report written to {args.report}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
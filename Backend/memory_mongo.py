@@ -0,0 +1,442 @@
+import operator
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from downsampling import EPOCH
+
+# Comparison operators understood by $match, on NumPy columns and on rows
+COMPARISONS = {
+    '$gte': operator.ge,
+    '$gt': operator.gt,
+    '$lte': operator.le,
+    '$lt': operator.lt,
+    '$ne': operator.ne,
+}
+
+ONE_MS = timedelta(milliseconds=1)
+
+
+def to_ms(value):
+    """Epoch milliseconds for a datetime, other values unchanged"""
+    if isinstance(value, datetime):
+        return (value - EPOCH) // ONE_MS
+    return value
+
+
+def from_ms(ms):
+    return EPOCH + timedelta(milliseconds=int(ms))
+
+
+def get_path(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _subtract(a, b):
+    if isinstance(a, datetime) and isinstance(b, datetime):
+        # date - date is a millisecond count
+        return (a - b) // ONE_MS
+    if isinstance(a, datetime):
+        return a - timedelta(milliseconds=b)
+    return a - b
+
+
+def _divide(a, b):
+    return a / b if b else None
+
+
+EXPRESSIONS = {
+    '$subtract': _subtract,
+    '$mod': operator.mod,
+    '$divide': _divide,
+}
+
+
+def evaluate(expr, doc):
+    """Value of an aggregation expression ("$field", operator or literal) for one row"""
+    if isinstance(expr, str) and expr.startswith('$'):
+        return get_path(doc, expr[1:])
+    if isinstance(expr, dict):
+        if len(expr) == 1:
+            op, args = next(iter(expr.items()))
+            if op.startswith('$'):
+                if op not in EXPRESSIONS:
+                    raise NotImplementedError(f"Expression {op} is not supported")
+                return EXPRESSIONS[op](*[evaluate(arg, doc) for arg in args])
+        return {key: evaluate(value, doc) for key, value in expr.items()}
+    return expr
+
+
+def _freeze(value):
+    """Hashable group key"""
+    if isinstance(value, dict):
+        return tuple((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def bucket_field(expr):
+    """(field, bucket_ms) when expr is downsampling.bucket_expression, else None"""
+    try:
+        field, mod = expr['$subtract']
+        (inner_field, epoch), bucket_ms = mod['$mod'][0]['$subtract'], mod['$mod'][1]
+    except (TypeError, KeyError, ValueError, IndexError):
+        return None
+    if field != inner_field or epoch != EPOCH or not isinstance(field, str):
+        return None
+    return field[1:], int(bucket_ms)
+
+
+# --- Row-at-a-time stages, used once a pipeline has left the columns ---
+
+def matches(doc, query):
+    for field, condition in query.items():
+        value = get_path(doc, field)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if value is None or not COMPARISONS[op](value, operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def sort_rows(rows, spec):
+    rows = list(rows)
+    # Stable sorts from the least significant key up
+    for field, direction in reversed(list(spec.items())):
+        rows.sort(key=lambda doc: (get_path(doc, field) is not None, get_path(doc, field)),
+                  reverse=direction < 0)
+    return rows
+
+
+def group_rows(rows, spec):
+    groups = {}
+    for doc in rows:
+        key = evaluate(spec['_id'], doc)
+        frozen = _freeze(key)
+        state = groups.get(frozen)
+        if state is None:
+            state = groups[frozen] = {'_id': key, '__n': {}}
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (op, arg), = accumulator.items()
+            value = evaluate(arg, doc)
+            if op == '$push':
+                state.setdefault(name, []).append(value)
+            elif op == '$first':
+                state.setdefault(name, value)
+            elif op == '$last':
+                state[name] = value
+            elif value is None:
+                state.setdefault(name, 0 if op == '$sum' else None)
+            elif op in ('$sum', '$avg'):
+                state[name] = state.get(name, 0) + value
+                state['__n'][name] = state['__n'].get(name, 0) + 1
+            elif op == '$min':
+                state[name] = value if state.get(name) is None else min(state[name], value)
+            elif op == '$max':
+                state[name] = value if state.get(name) is None else max(state[name], value)
+            else:
+                raise NotImplementedError(f"Accumulator {op} is not supported")
+    results = []
+    for state in groups.values():
+        counts = state.pop('__n')
+        for name, accumulator in spec.items():
+            if name != '_id' and '$avg' in accumulator:
+                state[name] = state[name] / counts[name] if counts.get(name) else None
+        results.append(state)
+    return results
+
+
+def project_rows(rows, spec):
+    include_id = spec.get('_id', 1) not in (0, False)
+    fields = {key: value for key, value in spec.items() if key != '_id'}
+    inclusion = any(value not in (0, False) for value in fields.values())
+    results = []
+    for doc in rows:
+        if inclusion:
+            out = {'_id': doc['_id']} if include_id and '_id' in doc else {}
+            for key, value in fields.items():
+                if value is True or value == 1:
+                    if key in doc:
+                        out[key] = doc[key]
+                else:
+                    out[key] = evaluate(value, doc)
+        else:
+            out = {key: value for key, value in doc.items() if key not in fields}
+            if not include_id:
+                out.pop('_id', None)
+        results.append(out)
+    return results
+
+
+class ColumnarCollection:
+    """Read-only collection kept as NumPy columns, with an async PyMongo-like API.
+
+    Supports what the API's queries use: find_one, distinct, document counts
+    and aggregation with $match, $sort, $limit, $skip, $group, $project,
+    $addFields and uncorrelated $lookup. Leading $match/$sort/$limit stages
+    and a $group on a time bucket run vectorized, so ranges over millions of
+    documents cost milliseconds; later stages see ordinary dicts.
+
+    Columns are NumPy arrays. Date fields hold epoch milliseconds, and
+    categorical fields (device ids, comfort levels) hold int codes into a
+    list of values.
+    """
+
+    def __init__(self, name, database):
+        self.name = name
+        self.database = database
+        self.size = 0
+        self.columns = {}
+        self.dates = set()
+        self.categories = {}
+
+    def load(self, columns, dates=(), categories=None):
+        """Replace the contents with equal-length arrays, one per field"""
+        self.columns = {field: np.asarray(values) for field, values in columns.items()}
+        self.size = len(next(iter(self.columns.values()))) if self.columns else 0
+        self.dates = set(dates)
+        self.categories = {field: list(values) for field, values in (categories or {}).items()}
+
+    def _encode(self, field, value):
+        """Operand of a comparison in the column's representation"""
+        if field in self.categories:
+            try:
+                return self.categories[field].index(value)
+            except ValueError:
+                return -1
+        if field in self.dates:
+            return to_ms(value)
+        return value
+
+    def _decode(self, field, values):
+        """Python values for part of a column"""
+        if field in self.categories:
+            categories = self.categories[field]
+            return [categories[code] for code in values.tolist()]
+        if field in self.dates:
+            return [from_ms(ms) for ms in values.tolist()]
+        return values.tolist()
+
+    def _rows(self, index):
+        names = list(self.columns)
+        decoded = [self._decode(name, self.columns[name][index]) for name in names]
+        ids = index.tolist()
+        rows = []
+        for i, values in enumerate(zip(*decoded)):
+            doc = {'_id': ids[i]}
+            doc.update(zip(names, values))
+            rows.append(doc)
+        return rows
+
+    def _match(self, query, index):
+        mask = np.ones(len(index), dtype=bool)
+        for field, condition in query.items():
+            column = self.columns.get(field)
+            # Loaded columns have a value in every row
+            exists = condition.get('$exists') if isinstance(condition, dict) else None
+            if exists is not None:
+                if bool(exists) != (column is not None):
+                    mask[:] = False
+                condition = {op: operand for op, operand in condition.items() if op != '$exists'}
+            if column is None:
+                if condition is not None and exists is None:
+                    mask[:] = False
+                continue
+            values = column[index]
+            if isinstance(condition, dict):
+                for op, operand in condition.items():
+                    mask &= COMPARISONS[op](values, self._encode(field, operand))
+            else:
+                mask &= values == self._encode(field, condition)
+        return index[mask]
+
+    def _sort_key(self, field, index, direction):
+        column = self.columns.get(field)
+        if column is None:
+            return np.zeros(len(index))
+        key = column[index]
+        return -key if direction < 0 else key
+
+    def _sort(self, spec, index, limit=None):
+        if len(spec) == 1 and limit is not None and limit < len(index):
+            # Top-k without sorting the whole range, like an indexed sort + limit
+            field, direction = next(iter(spec.items()))
+            key = self._sort_key(field, index, direction)
+            top = np.argpartition(key, limit - 1)[:limit] if limit > 0 else np.empty(0, np.intp)
+            return index[top[np.argsort(key[top], kind='stable')]]
+        keys = [self._sort_key(field, index, direction) for field, direction in spec.items()]
+        return index[np.lexsort(keys[::-1])] if keys else index
+
+    def _group(self, spec, index):
+        """Vectorized $group on None or a time bucket; None when not supported"""
+        id_expr = spec['_id']
+        if id_expr is None:
+            field, keys = None, np.zeros(len(index), dtype=np.int64)
+        else:
+            parsed = bucket_field(id_expr)
+            if parsed is None or parsed[0] not in self.dates:
+                return None
+            field, bucket_ms = parsed
+            times = self.columns[field][index]
+            keys = times - times % bucket_ms
+
+        accumulators = []
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (op, arg), = accumulator.items()
+            if op not in ('$sum', '$avg', '$min', '$max', '$first', '$last'):
+                return None
+            if isinstance(arg, str) and arg.startswith('$'):
+                field_name = arg[1:]
+                if field_name not in self.columns:
+                    return None
+                if field_name in self.categories and op not in ('$first', '$last'):
+                    return None
+                accumulators.append((name, op, arg[1:]))
+            elif op == '$sum' and isinstance(arg, (int, float)):
+                accumulators.append((name, op, arg))
+            else:
+                return None
+        if len(index) == 0:
+            return []
+
+        order = np.argsort(keys, kind='stable')
+        keys, index = keys[order], index[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        counts = ends - starts
+
+        ids = [None] * len(starts) if field is None else [from_ms(ms) for ms in keys[starts].tolist()]
+        results = [{'_id': group_id} for group_id in ids]
+        for name, op, arg in accumulators:
+            if not isinstance(arg, str):
+                values = (counts * arg).tolist()
+            elif op in ('$first', '$last'):
+                rows = index[starts] if op == '$first' else index[ends - 1]
+                values = self._decode(arg, self.columns[arg][rows])
+            else:
+                column = self.columns[arg][index]
+                if op == '$sum':
+                    values = np.add.reduceat(column, starts)
+                elif op == '$avg':
+                    values = np.add.reduceat(column, starts) / counts
+                elif op == '$min':
+                    values = np.minimum.reduceat(column, starts)
+                else:
+                    values = np.maximum.reduceat(column, starts)
+                values = self._decode(arg, values)
+            for row, value in zip(results, values):
+                row[name] = value
+        return results
+
+    def run(self, pipeline):
+        """Evaluate a pipeline and return the resulting documents"""
+        index = np.arange(self.size)
+        rows = None
+        stages = list(pipeline)
+        i = 0
+        while i < len(stages) and rows is None:
+            (op, spec), = stages[i].items()
+            if op == '$match':
+                index = self._match(spec, index)
+            elif op == '$sort':
+                following = stages[i + 1] if i + 1 < len(stages) else {}
+                index = self._sort(spec, index, following.get('$limit'))
+            elif op == '$limit':
+                index = index[:spec]
+            elif op == '$skip':
+                index = index[spec:]
+            elif op == '$group':
+                rows = self._group(spec, index)
+                if rows is None:
+                    # Not vectorizable: run this stage on rows below
+                    rows = self._rows(index)
+                    continue
+            else:
+                rows = self._rows(index)
+                continue
+            i += 1
+        if rows is None:
+            rows = self._rows(index)
+        for stage in stages[i:]:
+            rows = self.database.apply_stage(stage, rows)
+        return rows
+
+    async def aggregate(self, pipeline, **kwargs):
+        return MemoryCursor(self.run(pipeline))
+
+    async def find_one(self, filter=None, projection=None, sort=None):
+        pipeline = [{'$match': filter or {}}]
+        if sort:
+            pipeline.append({'$sort': dict(sort)})
+        pipeline.append({'$limit': 1})
+        if projection:
+            pipeline.append({'$project': projection})
+        rows = self.run(pipeline)
+        return rows[0] if rows else None
+
+    async def distinct(self, field, filter=None):
+        index = self._match(filter or {}, np.arange(self.size))
+        column = self.columns.get(field)
+        if column is None:
+            return []
+        return self._decode(field, np.unique(column[index]))
+
+    async def estimated_document_count(self):
+        return self.size
+
+    async def count_documents(self, filter):
+        return len(self._match(filter, np.arange(self.size)))
+
+
+class MemoryCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def to_list(self, length=None):
+        return self.rows if length is None else self.rows[:length]
+
+
+class ColumnarDatabase:
+    """In-memory stand-in for the async iot_monitoring database"""
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = ColumnarCollection(name, self)
+        return self.collections[name]
+
+    def apply_stage(self, stage, rows):
+        (op, spec), = stage.items()
+        if op == '$match':
+            return [doc for doc in rows if matches(doc, spec)]
+        if op == '$sort':
+            return sort_rows(rows, spec)
+        if op == '$limit':
+            return rows[:spec]
+        if op == '$skip':
+            return rows[spec:]
+        if op == '$group':
+            return group_rows(rows, spec)
+        if op == '$project':
+            return project_rows(rows, spec)
+        if op == '$addFields':
+            return [{**doc, **{key: evaluate(value, doc) for key, value in spec.items()}}
+                    for doc in rows]
+        if op == '$lookup' and 'pipeline' in spec and 'localField' not in spec:
+            # Uncorrelated: the sub-pipeline runs once for all rows
+            joined = self[spec['from']].run(spec['pipeline'])
+            return [{**doc, spec['as']: [dict(item) for item in joined]} for doc in rows]
+        raise NotImplementedError(f"Stage {op} is not supported")
@@ -0,0 +1,286 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; spans sub-millisecond stages up to slow Mongo round trips
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with zero or more labels.
+
+    Values are kept per tuple of label values. A value can also be a
+    function, evaluated when the registry is rendered, for numbers another
+    component already tracks (queue depths, writer error counts).
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.functions = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def set_function(self, fn, **labels):
+        self.functions[self._key(labels)] = fn
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, fn in self.functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        return [(self.name, key, (), value) for key, value in values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, value, **labels):
+        """Set one label combination and drop all others (e.g. model version info)"""
+        key = self._key(labels)
+        with self.lock:
+            self.values = {key: value}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # per-bucket counts (last one is +Inf), sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        samples = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', key, (('le', _format_value(bound)),), cumulative))
+            samples.append((f'{self.name}_sum', key, (), total))
+            samples.append((f'{self.name}_count', key, (), cumulative))
+        return samples
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class StageTimer:
+    """Times consecutive stages of one pass through a hot path.
+
+    mark(stage) records the time since the previous mark (or creation)
+    under that stage label, so each stage costs a single perf_counter call.
+    """
+
+    __slots__ = ('histogram', 'started', 'last')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, stage=stage)
+        self.last = now
+
+
+def process_start_time():
+    """Epoch seconds when this process started, or None where /proc is not available"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the parenthesised command name; starttime is field 22
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+        return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
+class StartupClock:
+    """Seconds from process start to named startup milestones.
+
+    Process start comes from /proc, so interpreter startup and imports are
+    included (at clock-tick resolution); elsewhere it falls back to when
+    the clock was created. Each milestone is recorded once, in order, and
+    exported as a gauge sample.
+    """
+
+    def __init__(self, gauge):
+        self.gauge = gauge
+        self.started = process_start_time() or time.time()
+        self.milestones = {}
+
+    def mark(self, milestone):
+        """Record a milestone the first time it is reached; returns whether it was new"""
+        if milestone in self.milestones:
+            return False
+        seconds = time.time() - self.started
+        self.milestones[milestone] = seconds
+        self.gauge.set(seconds, milestone=milestone)
+        return True
+
+    def report(self):
+        return dict(self.milestones)
+
+    def summary(self):
+        return ', '.join(f'{name} {seconds * 1000:.0f} ms' for name, seconds in self.milestones.items())
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, extra, value in metric.samples():
+                labels = _format_labels(metric.labelnames, key, extra)
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(port, host='0.0.0.0', registry=REGISTRY, json_routes=None):
+    """Serve /metrics from a daemon thread; returns the server.
+
+    json_routes maps extra paths to functions returning JSON-serializable
+    status (e.g. the retrain scheduler's decisions).
+    """
+    json_routes = json_routes or {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/metrics':
+                body, content_type = registry.render().encode(), CONTENT_TYPE
+            elif path in json_routes:
+                body = json.dumps(json_routes[path](), default=str).encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    return server
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware observing request latency per route template"""
+
+    def __init__(self, app, histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                # Time to response headers; streaming bodies are not included
+                route = scope.get('route')
+                self.histogram.observe(
+                    time.perf_counter() - start,
+                    route=getattr(route, 'path', 'unmatched'),
+                    method=scope['method'],
+                    status=message['status'])
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
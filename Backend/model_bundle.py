@@ -0,0 +1,321 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from inference_engine import ENGINE_ARRAYS, ForestEngine, legacy_heads
+
+# Versioned bundles live next to the legacy pickles
+MODEL_DIR = 'models'
+BUNDLE_DIR = os.path.join(MODEL_DIR, 'bundles')
+CURRENT_POINTER = 'CURRENT'
+LEGACY_VERSION = 'legacy'
+LEGACY_FILES = ('temp_model.pkl', 'humid_model.pkl', 'air_quality_model.pkl', 'scaler.pkl')
+
+# Compiled bundle file: magic, header length, JSON header, then the engine
+# arrays, each starting on an ARRAY_ALIGNMENT boundary so they can be used
+# straight from a memory map
+COMPILED_MAGIC = b'IOTFRST1'
+COMPILED_SUFFIX = '.forest'
+PICKLE_SUFFIX = '.joblib'
+ARRAY_ALIGNMENT = 64
+
+
+class ModelBundle:
+    """Scaler and target models that are always swapped together.
+
+    heads is a list of (estimator, [target index, ...]) as accepted by
+    ForestEngine.from_models. The compiled engine is rebuilt after
+    unpickling rather than stored. Bundles read from a compiled file have
+    only the engine; heads and scaler are None.
+    """
+
+    def __init__(self, version, heads, scaler, metadata=None):
+        self.version = version
+        self.heads = heads
+        self.scaler = scaler
+        self.metadata = metadata or {}
+        self.engine = ForestEngine.from_models(heads, scaler)
+
+    @classmethod
+    def compiled(cls, version, engine, metadata=None):
+        """Bundle around an already compiled engine, without estimators"""
+        bundle = cls.__new__(cls)
+        bundle.version = version
+        bundle.heads = None
+        bundle.scaler = None
+        bundle.metadata = metadata or {}
+        bundle.engine = engine
+        return bundle
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['engine']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.engine = ForestEngine.from_models(self.heads, self.scaler)
+
+    def predict_one(self, features):
+        return self.engine.predict_one(features)
+
+
+def new_version():
+    """Sortable version id for a freshly trained bundle"""
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def _atomic_write(path, write):
+    """Write via a temp file in the same directory, then rename over path"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _aligned(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def _encode_metadata(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value).__name__} in bundle metadata")
+
+
+def _decode_metadata(value):
+    if set(value) == {'$date'}:
+        return datetime.fromisoformat(value['$date'])
+    return value
+
+
+def write_compiled(bundle, f):
+    """Write a bundle's engine and metadata in the compiled format (no pickle)"""
+    arrays = bundle.engine.arrays()
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({
+        'version': bundle.version,
+        'max_depth': int(bundle.engine.max_depth),
+        'n_features': int(bundle.engine.n_features),
+        'metadata': bundle.metadata,
+        'arrays': layout,
+    }, default=_encode_metadata).encode()
+
+    start = _aligned(len(COMPILED_MAGIC) + 8 + len(header))
+    f.write(COMPILED_MAGIC + struct.pack('<Q', len(header)) + header)
+    position = len(COMPILED_MAGIC) + 8 + len(header)
+    for name, array in arrays.items():
+        target = start + layout[name]['offset']
+        f.write(b'\0' * (target - position))
+        f.write(array.tobytes())
+        position = target + array.nbytes
+
+
+def read_compiled(path):
+    """Map a compiled bundle file; engine arrays are views of the file, not copies.
+
+    Pages are read on first use and shared with every process mapping the
+    same file. Replacing the file (save_bundle renames over it) leaves an
+    existing map valid.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    prefix = len(COMPILED_MAGIC) + 8
+    if buffer[:len(COMPILED_MAGIC)] != COMPILED_MAGIC:
+        raise ValueError(f"{path} is not a compiled model bundle")
+    (header_length,) = struct.unpack('<Q', buffer[len(COMPILED_MAGIC):prefix])
+    header = json.loads(buffer[prefix:prefix + header_length], object_hook=_decode_metadata)
+    start = _aligned(prefix + header_length)
+
+    arrays = {}
+    for name, dtype in ENGINE_ARRAYS.items():
+        spec = header['arrays'][name]
+        stored = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        array = np.frombuffer(buffer, stored, count, start + spec['offset']).reshape(spec['shape'])
+        # Only copies when the file came from a machine with another intp
+        arrays[name] = array.astype(dtype, copy=False)
+    engine = ForestEngine(max_depth=header['max_depth'], n_features=header.get('n_features'), **arrays)
+    return ModelBundle.compiled(header['version'], engine, header['metadata'])
+
+
+def bundle_path(version, bundle_dir=BUNDLE_DIR):
+    return os.path.join(bundle_dir, f'bundle-{version}{PICKLE_SUFFIX}')
+
+
+def compiled_path(version, bundle_dir=BUNDLE_DIR):
+    return os.path.join(bundle_dir, f'bundle-{version}{COMPILED_SUFFIX}')
+
+
+def save_bundle(bundle, bundle_dir=BUNDLE_DIR, make_current=True):
+    """Persist a bundle and optionally point CURRENT at it, all atomically.
+
+    The compiled file is what the processor loads. Estimators and scaler
+    are pickled next to it for tooling and processors from older releases.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    _atomic_write(compiled_path(bundle.version, bundle_dir),
+                  lambda f: write_compiled(bundle, f))
+    if bundle.heads is not None:
+        import joblib
+        _atomic_write(bundle_path(bundle.version, bundle_dir),
+                      lambda f: joblib.dump(bundle, f))
+    if make_current:
+        set_current_version(bundle.version, bundle_dir)
+    return bundle.version
+
+
+def set_current_version(version, bundle_dir=BUNDLE_DIR):
+    if not (os.path.exists(compiled_path(version, bundle_dir))
+            or os.path.exists(bundle_path(version, bundle_dir))):
+        raise FileNotFoundError(f"No bundle with version {version}")
+    _atomic_write(os.path.join(bundle_dir, CURRENT_POINTER),
+                  lambda f: f.write(version.encode()))
+
+
+def current_version(bundle_dir=BUNDLE_DIR):
+    try:
+        with open(os.path.join(bundle_dir, CURRENT_POINTER)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def list_versions(bundle_dir=BUNDLE_DIR):
+    if not os.path.isdir(bundle_dir):
+        return []
+    versions = set()
+    for name in os.listdir(bundle_dir):
+        for suffix in (COMPILED_SUFFIX, PICKLE_SUFFIX):
+            if name.startswith('bundle-') and name.endswith(suffix):
+                versions.add(name[len('bundle-'):-len(suffix)])
+    return sorted(versions)
+
+
+def load_bundle(version=None, bundle_dir=BUNDLE_DIR, estimators=False):
+    """Load a bundle by version, or the one CURRENT points at.
+
+    The compiled file is mapped in when there is one. estimators=True
+    unpickles the fitted models and scaler instead.
+    """
+    version = version or current_version(bundle_dir)
+    if version is None:
+        raise FileNotFoundError("No current model bundle")
+    path = compiled_path(version, bundle_dir)
+    if not estimators and os.path.exists(path):
+        return read_compiled(path)
+    import joblib
+    return joblib.load(bundle_path(version, bundle_dir))
+
+
+def load_legacy_bundle(model_dir=MODEL_DIR, estimators=False, bundle_dir=BUNDLE_DIR):
+    """Wrap the four separate pickles written by older releases.
+
+    The first load compiles them into legacy.forest in bundle_dir (kept
+    out of version control with the other bundles); later loads map that
+    file in while it is newer than all four pickles.
+    """
+    paths = [os.path.join(model_dir, name) for name in LEGACY_FILES]
+    newest = max(os.path.getmtime(path) for path in paths)  # FileNotFoundError if one is missing
+    cache = os.path.join(bundle_dir, LEGACY_VERSION + COMPILED_SUFFIX)
+    if not estimators and os.path.exists(cache) and os.path.getmtime(cache) >= newest:
+        return read_compiled(cache)
+
+    import joblib
+    temp_model, humid_model, air_quality_model, scaler = (joblib.load(path) for path in paths)
+    bundle = ModelBundle(LEGACY_VERSION,
+                         legacy_heads(temp_model, humid_model, air_quality_model),
+                         scaler)
+    try:
+        os.makedirs(bundle_dir, exist_ok=True)
+        _atomic_write(cache, lambda f: write_compiled(bundle, f))
+    except OSError as e:
+        print(f"Could not cache compiled legacy models: {e}")
+    return bundle
+
+
+def load_latest_bundle():
+    """Current versioned bundle, falling back to the legacy pickles"""
+    try:
+        return load_bundle()
+    except FileNotFoundError:
+        return load_legacy_bundle()
+
+
+def restore_bundle(version, bundle_dir=BUNDLE_DIR):
+    """Make an older bundle current again and return it"""
+    set_current_version(version, bundle_dir)
+    return load_bundle(version, bundle_dir)
+
+
+def train_bundle(features, targets, n_estimators=50, bundle_dir=BUNDLE_DIR, candidate=None):
+    """Fit scaler and per-target forests and save them as a new bundle.
+
+    Runs in a worker process, so heavy imports stay local and all inputs are
+    plain NumPy arrays (features in MODEL_FEATURE_NAMES order, targets with one
+    column per TARGET_NAMES entry). A candidate from model_selection (the
+    one a sweep picked) replaces the default forests.
+    """
+    if candidate is not None:
+        from model_selection import fit_bundle
+        bundle = fit_bundle(candidate, features, targets)
+        save_bundle(bundle, bundle_dir)
+        return bundle
+
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+    scaled_features = scaler.fit_transform(features)
+
+    heads = []
+    for i in range(targets.shape[1]):
+        model = RandomForestRegressor(n_estimators=n_estimators)
+        model.fit(scaled_features, targets[:, i])
+        heads.append((model, [i]))
+
+    bundle = ModelBundle(new_version(), heads, scaler, metadata={
+        'trained_at': datetime.now(),
+        'n_samples': int(len(features)),
+    })
+    save_bundle(bundle, bundle_dir)
+    return bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage versioned model bundles")
+    parser.add_argument('--list', action='store_true', help="list saved bundle versions")
+    parser.add_argument('--restore', metavar='VERSION', help="make VERSION the current bundle")
+    args = parser.parse_args()
+
+    if args.restore:
+        restore_bundle(args.restore)
+        print(f"Current bundle is now {args.restore}")
+    else:
+        current = current_version()
+        for version in list_versions():
+            marker = '*' if version == current else ' '
+            print(f"{marker} {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from inference_engine import TARGET_NAMES
+from model_bundle import ModelBundle, new_version
+
+# Newest share of the data held out for testing
+TEST_FRACTION = 0.2
+# Wall-clock seconds the sweep may spend fitting candidates
+SWEEP_BUDGET = 300
+# Candidates this close to the most accurate one (relative score) compete on latency
+ACCURACY_TOLERANCE = 0.02
+# Test rows predicted one at a time to measure latency
+LATENCY_ROWS = 200
+
+# What train_models.py has always fitted
+DEFAULT_CANDIDATE = {'family': 'random_forest', 'multi_output': False,
+                     'params': {'n_estimators': 100}}
+
+# Sweep candidates, cheapest first so a short budget still finishes some.
+# multi_output fits one model for all targets instead of one per target.
+CANDIDATES = [
+    {'family': 'random_forest', 'multi_output': True,
+     'params': {'n_estimators': 50, 'max_depth': 12, 'min_samples_leaf': 5}},
+    {'family': 'random_forest', 'multi_output': False,
+     'params': {'n_estimators': 50, 'max_depth': 12, 'min_samples_leaf': 5}},
+    {'family': 'gradient_boosting', 'multi_output': False,
+     'params': {'n_estimators': 200, 'max_depth': 3, 'learning_rate': 0.1}},
+    {'family': 'extra_trees', 'multi_output': True,
+     'params': {'n_estimators': 100, 'max_depth': 16, 'min_samples_leaf': 2}},
+    {'family': 'random_forest', 'multi_output': True,
+     'params': {'n_estimators': 100, 'max_depth': 16, 'min_samples_leaf': 2}},
+    {'family': 'extra_trees', 'multi_output': False,
+     'params': {'n_estimators': 100}},
+    DEFAULT_CANDIDATE,
+    {'family': 'random_forest', 'multi_output': False,
+     'params': {'n_estimators': 200, 'min_samples_leaf': 2}},
+]
+
+
+def describe(candidate):
+    params = ', '.join(f'{key}={value}' for key, value in candidate['params'].items())
+    shape = 'multi-output' if candidate['multi_output'] else 'per-target'
+    return f"{candidate['family']} {shape} ({params})"
+
+
+def time_split(features, targets, timestamps, test_fraction=TEST_FRACTION):
+    """Train on the oldest rows and test on the newest, so no future readings leak into training"""
+    order = np.argsort(timestamps, kind='stable')
+    cut = int(len(order) * (1 - test_fraction))
+    train, test = order[:cut], order[cut:]
+    return features[train], features[test], targets[train], targets[test]
+
+
+def _estimator(candidate, n_jobs):
+    from sklearn.ensemble import ExtraTreesRegressor, GradientBoostingRegressor, RandomForestRegressor
+
+    cls = {
+        'random_forest': RandomForestRegressor,
+        'extra_trees': ExtraTreesRegressor,
+        'gradient_boosting': GradientBoostingRegressor,
+    }[candidate['family']]
+    params = dict(candidate['params'])
+    params.setdefault('random_state', 42)
+    if candidate['family'] != 'gradient_boosting':
+        params['n_jobs'] = n_jobs
+    return cls(**params)
+
+
+def fit_heads(candidate, scaled_features, targets, n_jobs=-1):
+    """Fitted heads for ForestEngine: one multi-output model or one model per target.
+
+    Forests build their trees on n_jobs cores (-1 = all); inside a sweep
+    worker n_jobs is 1, as the pool already keeps every core busy.
+    """
+    if candidate['multi_output'] and candidate['family'] != 'gradient_boosting':
+        model = _estimator(candidate, n_jobs).fit(scaled_features, targets)
+        return [(model, list(range(targets.shape[1])))]
+    return [(_estimator(candidate, n_jobs).fit(scaled_features, targets[:, i]), [i])
+            for i in range(targets.shape[1])]
+
+
+def fit_bundle(candidate, features, targets, n_jobs=-1, metadata=None):
+    """Scaler and heads for a candidate, as an unsaved ModelBundle"""
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+    heads = fit_heads(candidate, scaler.fit_transform(features), targets, n_jobs)
+    return ModelBundle(new_version(), heads, scaler, metadata={
+        'trained_at': datetime.now(),
+        'n_samples': int(len(features)),
+        'candidate': candidate,
+        **(metadata or {}),
+    })
+
+
+def predict_latency(bundle, rows):
+    """Median seconds per predict_one call, as the processor makes them"""
+    for row in rows[:10]:
+        bundle.predict_one(row)
+    timings = np.empty(len(rows))
+    for i, row in enumerate(rows):
+        start = time.perf_counter()
+        bundle.predict_one(row)
+        timings[i] = time.perf_counter() - start
+    return float(np.median(timings))
+
+
+def evaluate_candidate(candidate, X_train, y_train, X_test, y_test, n_jobs=1):
+    """Fit on the training rows and score accuracy and latency on the test rows.
+
+    score is the mean over targets of RMSE divided by the target's standard
+    deviation in the test set, so the three targets weigh the same.
+    """
+    start = time.perf_counter()
+    bundle = fit_bundle(candidate, X_train, y_train, n_jobs)
+    fit_seconds = time.perf_counter() - start
+
+    predicted = bundle.engine.predict(X_test)
+    squared = (predicted - y_test) ** 2
+    rmse = np.sqrt(squared.mean(axis=0))
+    spread = np.maximum(y_test.std(axis=0), 1e-12)
+    r2 = 1 - squared.mean(axis=0) / spread ** 2
+    return {
+        'candidate': candidate,
+        'name': describe(candidate),
+        'fit_s': fit_seconds,
+        'rmse': dict(zip(TARGET_NAMES, rmse.tolist())),
+        'r2': dict(zip(TARGET_NAMES, r2.tolist())),
+        'score': float(np.mean(rmse / spread)),
+        'latency_s': predict_latency(bundle, X_test[:LATENCY_ROWS]),
+        'trees': bundle.engine.n_trees,
+        'bundle': bundle,
+    }
+
+
+def select(results, accuracy_tolerance=ACCURACY_TOLERANCE, max_latency=None):
+    """Fastest candidate whose score is within accuracy_tolerance of the best.
+
+    Candidates slower than max_latency seconds per prediction are dropped
+    first, unless that would leave none.
+    """
+    eligible = [r for r in results if max_latency is None or r['latency_s'] <= max_latency] or results
+    best = min(r['score'] for r in eligible)
+    close = [r for r in eligible if r['score'] <= best * (1 + accuracy_tolerance)]
+    return min(close, key=lambda r: r['latency_s'])
+
+
+def sweep(features, targets, timestamps, budget=SWEEP_BUDGET, workers=None, candidates=CANDIDATES,
+          test_fraction=TEST_FRACTION, accuracy_tolerance=ACCURACY_TOLERANCE, max_latency=None):
+    """Evaluate candidates in a process pool for at most `budget` seconds.
+
+    Candidates still running at the deadline are killed with the pool and
+    reported as timed out. Returns (chosen result or None, report) where
+    the report lists every candidate's outcome.
+    """
+    X_train, X_test, y_train, y_test = time_split(features, targets, timestamps, test_fraction)
+    workers = workers or min(len(candidates), os.cpu_count() or 1)
+    pool = multiprocessing.get_context('spawn').Pool(workers)
+    deadline = time.monotonic() + budget
+    try:
+        pending = [(candidate, pool.apply_async(evaluate_candidate,
+                                                (candidate, X_train, y_train, X_test, y_test)))
+                   for candidate in candidates]
+        for _, async_result in pending:
+            async_result.wait(max(deadline - time.monotonic(), 0))
+
+        results, report = [], []
+        for candidate, async_result in pending:
+            if not async_result.ready():
+                report.append({'name': describe(candidate), 'status': 'timed_out'})
+                continue
+            try:
+                result = async_result.get()
+            except Exception as e:
+                report.append({'name': describe(candidate), 'status': 'failed', 'error': str(e)})
+                continue
+            results.append(result)
+            report.append({'status': 'done', **{key: value for key, value in result.items()
+                                                 if key != 'bundle'}})
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if not results:
+        return None, report
+    chosen = select(results, accuracy_tolerance, max_latency)
+    for entry in report:
+        entry['chosen'] = entry.get('name') == chosen['name'] and entry['status'] == 'done'
+    return chosen, report
+
+
+def print_report(report):
+    print(f"{'candidate':<82} {'score':>7} {'latency':>10} {'fit':>8}  status")
+    for entry in report:
+        if entry['status'] != 'done':
+            print(f"{entry['name']:<82} {'':>7} {'':>10} {'':>8}  {entry['status']}")
+            continue
+        marker = '  <- chosen' if entry.get('chosen') else ''
+        print(f"{entry['name']:<82} {entry['score']:7.4f} {entry['latency_s'] * 1e6:8.1f}us "
+              f"{entry['fit_s']:7.1f}s  done{marker}")
+
+
+def main():
+    from data_loader import training_arrays
+    from model_bundle import save_bundle
+    from train_models import get_real_data
+
+    parser = argparse.ArgumentParser(description="Sweep model families and hyperparameters "
+                                                 "and save the best bundle")
+    parser.add_argument('--budget', type=float, default=SWEEP_BUDGET, help="seconds for the sweep")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    parser.add_argument('--tolerance', type=float, default=ACCURACY_TOLERANCE,
+                        help="relative score difference traded for lower latency")
+    parser.add_argument('--max-latency-us', type=float, help="drop candidates slower than this")
+    parser.add_argument('--dry-run', action='store_true', help="report without saving a bundle")
+    args = parser.parse_args()
+
+    features, targets, timestamps = training_arrays(get_real_data(), with_timestamps=True)
+    max_latency = args.max_latency_us / 1e6 if args.max_latency_us else None
+    chosen, report = sweep(features, targets, timestamps, args.budget, args.workers,
+                           accuracy_tolerance=args.tolerance, max_latency=max_latency)
+    print_report(report)
+    if chosen is None:
+        print("No candidate finished within the budget")
+        return
+    if args.dry_run:
+        return
+
+    # The test rows are the newest readings, so refit the winner on everything
+    bundle = fit_bundle(chosen['candidate'], features, targets, metadata={
+        'score': chosen['score'], 'latency_s': chosen['latency_s']})
+    version = save_bundle(bundle)
+    print(f"Saved {chosen['name']} as bundle {version}")
+
+
+if __name__ == "__main__":
+    main()
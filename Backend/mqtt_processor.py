@@ -1,117 +1,216 @@
 import paho.mqtt.client as mqtt
+import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import pymongo
-import numpy as np
-import joblib
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.preprocessing import StandardScaler
+from batch_writer import BatchWriter
+from db_setup import bootstrap
+from hot_state import HotState
+from rollups import RollupWriter
+from model_bundle import load_latest_bundle, load_bundle, current_version
+from data_loader import load_window, training_arrays
+from device_state import (SENSOR_FIELDS, DeviceStateTable, parse_sensor_topic, parse_sensor_payload,
+                          control_topic, device_shard)
+from metrics import Counter, Gauge, Histogram, StageTimer, StartupClock, start_http_server
+from retrain_scheduler import RetrainScheduler
+from feature_store import FEATURE_RESOLUTION, FEATURE_STORE_PATH, FeatureStore
+from ingest_pipeline import Pipeline, Stage
 
 # MongoDB connection
 client = pymongo.MongoClient("mongodb://localhost:27017/")
 db = client["iot_monitoring"]
 sensor_data_collection = db["sensor_data"]
+predictions_collection = db["predictions"]
+
+# Write-behind batching for inserts (flush on size or age)
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_DELAY = 1.0  # seconds
+# Documents each writer holds while MongoDB is unreachable before dropping the oldest
+WRITE_BUFFER_MAX = int(os.environ.get("WRITE_BUFFER_MAX", "100000"))
+
+# Rollup collections (1 min / 1 h / 1 day) are updated from each flushed batch
+rollup_writer = RollupWriter(db)
+
+sensor_writer = BatchWriter(sensor_data_collection, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY,
+                            after_flush=rollup_writer.apply, max_buffer=WRITE_BUFFER_MAX)
+prediction_writer = BatchWriter(predictions_collection, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY,
+                                max_buffer=WRITE_BUFFER_MAX)
 
 # MQTT settings
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 MQTT_KEEPALIVE = 60
 
-# Topics
-TEMP_TOPIC = "home/sensors/temperature"
-HUMID_TOPIC = "home/sensors/humidity"
-AIR_QUALITY_TOPIC = "home/sensors/air_quality"
+# Topics: per-room sensors are published on home/<room>/sensors/<field>,
+# single-room boards still use the legacy home/sensors/<field> layout. The
+# wildcards also match home/<room>/sensors and home/sensors, where a board
+# can publish all fields at once as JSON.
+SENSOR_TOPICS = ["home/+/sensors/#", "home/sensors/#"]
+
+# Fields published as separate messages are merged into one sample set per
+# device when they all arrive within this many seconds; the pipeline runs
+# once per set. Keep it below the boards' publish interval (10 s).
+COALESCE_WINDOW = float(os.environ.get("READING_COALESCE_WINDOW", "5"))
+
+# Spreading devices over several processor instances. Either give every
+# instance PROCESSOR_INSTANCE_INDEX/PROCESSOR_INSTANCE_COUNT so each one
+# keeps only the devices hashed to it, or set MQTT_SHARED_GROUP to let the
+# broker balance messages with $share subscriptions. Shared subscriptions
+# balance per message, so a device's three topics may land on different
+# instances; hash sharding keeps each device on one instance.
+INSTANCE_INDEX = int(os.environ.get("PROCESSOR_INSTANCE_INDEX", "0"))
+INSTANCE_COUNT = int(os.environ.get("PROCESSOR_INSTANCE_COUNT", "1"))
+MQTT_SHARED_GROUP = os.environ.get("MQTT_SHARED_GROUP")
+
+# Sensor messages run through four stages, each on its own worker threads
+# fed by bounded queues: decode (parse and merge sample sets), control
+# (comfort level and device commands), infer (rolling features and
+# predictions) and persist (MongoDB writers and hot state). on_message only
+# hands messages to decode, so paho's network thread keeps up with the
+# broker. Every stage shards by device, so a device's messages stay in
+# order. PROCESSOR_PIPELINE=0 runs all stages inside on_message instead.
+PIPELINE_ENABLED = os.environ.get("PROCESSOR_PIPELINE", "1") != "0"
+PIPELINE_STAGES = ('decode', 'control', 'infer', 'persist')
+PIPELINE_WORKERS = {stage: int(os.environ.get(f"PIPELINE_{stage.upper()}_WORKERS", "1"))
+                    for stage in PIPELINE_STAGES}
+# Sample sets (messages for decode) each worker may have waiting
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "1000"))
+# When decode is full, 'block' holds up the network thread so the backlog
+# stays on the broker; 'shed' drops the message
+PIPELINE_OVERLOAD = os.environ.get("PIPELINE_OVERLOAD", "block")
+# When infer or persist is full, 'shed' drops the sample set's prediction
+# and storage so control never waits for them; 'block' keeps every reading
+# but lets control fall behind with storage
+PIPELINE_STORAGE_OVERLOAD = os.environ.get("PIPELINE_STORAGE_OVERLOAD", "shed")
+
+pipeline = None
+
+# Latest sensor values and actuator states for every device
+device_table = DeviceStateTable()
+
+# Latest reading/prediction/device states shared with the API workers
+hot_state = HotState()
 
-# Control topics
-AC_CONTROL_TOPIC = "home/devices/ac"
-PURIFIER_CONTROL_TOPIC = "home/devices/purifier"
-DEHUMIDIFIER_CONTROL_TOPIC = "home/devices/dehumidifier"
+# Rolling per-device features for the models, snapshotted to FEATURE_STORE_PATH
+feature_store = FeatureStore()
 
-# Device states
-ac_state = "OFF"
-purifier_state = "OFF"
-dehumidifier_state = "OFF"
+# Current model bundle. It is only ever replaced as a whole, so a reader that
+# takes one reference to it always sees a consistent scaler and models.
+current_bundle = None
+
+# Retraining runs in a separate process so the MQTT thread keeps predicting.
+# Workers are spawned, so they re-import this module: keep loading and pool
+# creation out of import time.
+training_pool = None
+training_future = None
+training_started = None
+
+# Retrains on prediction drift, new data volume or model age (see retrain_scheduler)
+retrain_scheduler = RetrainScheduler()
+
+# Prometheus metrics, served on PROCESSOR_METRICS_PORT (0 disables the server)
+METRICS_PORT = int(os.environ.get("PROCESSOR_METRICS_PORT", "9100"))
+MESSAGES = Counter('processor_messages_total', 'Sensor messages handled, by outcome', ['result'])
+SAMPLE_SETS = Counter('processor_sample_sets_total',
+                      'Sample sets completed (merged, combined) or dropped (timed_out, superseded)',
+                      ['result'])
+MESSAGE_SECONDS = Histogram('processor_message_seconds', 'Time spent in on_message')
+SAMPLE_SET_SECONDS = Histogram('processor_sample_set_seconds',
+                               'Time from receiving the message completing a sample set to storing it')
+STAGE_SECONDS = Histogram('processor_stage_seconds', 'Time per processing step', ['stage'])
+PIPELINE_QUEUE = Gauge('processor_pipeline_queue_depth', 'Items waiting for a pipeline stage', ['stage'])
+PIPELINE_WAIT = Histogram('processor_pipeline_wait_seconds', 'Time items spent queued for a pipeline stage',
+                          ['stage'])
+PIPELINE_SHED = Counter('processor_pipeline_shed_total', 'Items dropped because a stage was full', ['stage'])
+PIPELINE_ERRORS = Counter('processor_pipeline_errors_total', 'Items a stage failed to handle', ['stage'])
+MODEL_INFO = Gauge('processor_model_info', 'Model bundle version in use', ['version'])
+RETRAINS = Counter('processor_retrains_total', 'Finished retrains, by outcome', ['result'])
+RETRAIN_SECONDS = Histogram('processor_retrain_seconds', 'Time from starting a retrain to installing it',
+                            buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+RETRAIN_DECISIONS = Counter('processor_retrain_decisions_total', 'Retrain scheduler decisions, by reason',
+                            ['reason'])
+PREDICTION_MAE = Gauge('processor_prediction_mae', 'Rolling MAE of 1-hour predictions', ['field'])
+NEW_SAMPLES = Gauge('processor_retrain_new_samples', 'Complete readings since the last retrain')
+MONGO_ERRORS = Counter('processor_mongo_errors_total', 'Failed MongoDB writes', ['collection'])
+WRITER_QUEUE = Gauge('processor_writer_queue_depth', 'Documents waiting to be written', ['collection'])
+WRITER_DOCS = Counter('processor_writer_docs_written_total', 'Documents written', ['collection'])
+WRITER_FLUSHES = Counter('processor_writer_flushes_total', 'Batch flushes', ['collection'])
+WRITER_FLUSH_SECONDS = Counter('processor_writer_flush_seconds_total',
+                               'Time spent in insert_many', ['collection'])
+WRITER_DROPPED = Counter('processor_writer_dropped_total',
+                         'Documents dropped because the write buffer was full', ['collection'])
+STARTUP_SECONDS = Gauge('processor_startup_seconds', 'Seconds from process start to each startup milestone',
+                        ['milestone'])
+
+# imported, db_ready, model_loaded, mqtt_connected, first_prediction
+startup = StartupClock(STARTUP_SECONDS)
+
+# Writer numbers are read from the writers when metrics are scraped
+for _name, _writer in (('sensor_data', lambda: sensor_writer), ('predictions', lambda: prediction_writer)):
+    MONGO_ERRORS.set_function(lambda w=_writer: w().flush_errors, collection=_name)
+    WRITER_QUEUE.set_function(lambda w=_writer: w().queue_depth(), collection=_name)
+    WRITER_DOCS.set_function(lambda w=_writer: w().docs_written, collection=_name)
+    WRITER_FLUSHES.set_function(lambda w=_writer: w().flush_count, collection=_name)
+    WRITER_FLUSH_SECONDS.set_function(lambda w=_writer: w().total_flush_latency, collection=_name)
+    WRITER_DROPPED.set_function(lambda w=_writer: w().dropped, collection=_name)
+MONGO_ERRORS.set_function(lambda: rollup_writer.errors, collection='rollups')
+for _field in ('temperature', 'humidity', 'air_quality'):
+    PREDICTION_MAE.set_function(lambda f=_field: retrain_scheduler.mae[f].value(), field=_field)
+NEW_SAMPLES.set_function(lambda: retrain_scheduler.new_samples)
+for _stage in PIPELINE_STAGES:
+    PIPELINE_QUEUE.set_function(lambda s=_stage: pipeline[s].depth() if pipeline else 0, stage=_stage)
+    PIPELINE_SHED.set_function(lambda s=_stage: pipeline[s].shed if pipeline else 0, stage=_stage)
+    PIPELINE_ERRORS.set_function(lambda s=_stage: pipeline[s].errors if pipeline else 0, stage=_stage)
+
+def set_current_bundle(bundle):
+    global current_bundle
+    current_bundle = bundle
+    if bundle is not None:
+        MODEL_INFO.replace(1, version=bundle.version)
+        retrain_scheduler.model_installed(bundle.version, bundle.metadata.get('trained_at'))
 
 # Load ML models
-try:
-    temp_model = joblib.load('models/temp_model.pkl')
-    humid_model = joblib.load('models/humid_model.pkl')
-    air_quality_model = joblib.load('models/air_quality_model.pkl')
-    scaler = joblib.load('models/scaler.pkl')
-    models_loaded = True
-    print("ML models loaded successfully")
-except FileNotFoundError:
-    models_loaded = False
-    print("ML models not found. Will create new models with incoming data.")
-    # Initialize data storage for training
-    train_data = pd.DataFrame(columns=['timestamp', 'temperature', 'humidity', 'air_quality'])
-
-
-# Data storage for predictions
-current_data = {
-    'temperature': None,
-    'humidity': None,
-    'air_quality': None,
-    'timestamp': None
-}
+def load_models():
+    try:
+        started = time.perf_counter()
+        set_current_bundle(load_latest_bundle())
+        print(f"ML models loaded successfully (version {current_bundle.version}, "
+              f"{(time.perf_counter() - started) * 1000:.1f} ms)")
+    except FileNotFoundError:
+        set_current_bundle(None)
+        print("ML models not found. Will create new models with incoming data.")
+
+
+# Retraining reads 1-minute buckets, the ones the feature store averages over
+RETRAIN_RESOLUTION = FEATURE_RESOLUTION  # seconds
 
 # Get historical data for prediction
-def get_historical_data(hours=24):
+def get_historical_data(hours=24, resolution=None):
+    """Readings from the last `hours` as NumPy columns.
+
+    With a resolution (seconds) rows are per-device averages over buckets of
+    that width, read from the coarsest rollup that fits; otherwise raw
+    sensor_data documents are streamed in.
+    """
     end_time = datetime.now()
-    start_time = end_time - pd.Timedelta(hours=hours)
+    start_time = end_time - timedelta(hours=hours)
+    return load_window(db, start_time, end_time, resolution)
+
+# Predict using ML models
+def predict_values(features):
+    """Next-hour predictions from a feature_store vector (MODEL_FEATURE_NAMES order)"""
+    bundle = current_bundle
+    if bundle is None:
+        return None, None, None, None
     
-    cursor = sensor_data_collection.find({
-        'timestamp': {'$gte': start_time, '$lte': end_time}
-    })
+    # Bundles from before rolling features take only the leading features;
+    # the scaler is folded into the engine
+    features = features[:bundle.engine.n_features]
     
-    data = pd.DataFrame(list(cursor))
-    if not data.empty and 'timestamp' in data.columns:
-        data['hour'] = data['timestamp'].dt.hour
-        data['day_of_week'] = data['timestamp'].dt.dayofweek
+    # Make predictions for next hour with all three forests in one pass
+    temp_pred, humid_pred, air_quality_pred = bundle.predict_one(features).tolist()
     
-    return data
-
-# Predict using ML models
-def predict_values():
-    if not models_loaded or None in current_data.values():
-        return None, None, None
-    
-    # Get time features for prediction
-    now = datetime.now()
-    hour = now.hour
-    day_of_week = now.weekday()
-    
-    # # Create feature vector for prediction
-    # features = np.array([[
-    #     current_data['temperature'], 
-    #     current_data['humidity'],
-    #     current_data['air_quality'],
-    #     hour,
-    #     day_of_week
-    # ]])
-    
-    # # Scale features
-    # scaled_features = scaler.transform(features)
-    # Define feature names in the same order used during training
-    feature_names = ['temperature', 'humidity', 'air_quality', 'hour', 'day_of_week']
-    features = pd.DataFrame([[
-        current_data['temperature'], 
-        current_data['humidity'],
-        current_data['air_quality'],
-        hour,
-        day_of_week
-    ]], columns=feature_names)
-
-    # Now transform safely
-    scaled_features = scaler.transform(features)
-    
-    # Make predictions for next hour
-    temp_pred = temp_model.predict(scaled_features)[0]
-    humid_pred = humid_model.predict(scaled_features)[0]
-    air_quality_pred = air_quality_model.predict(scaled_features)[0]
-    
-    return temp_pred, humid_pred, air_quality_pred
+    return temp_pred, humid_pred, air_quality_pred, bundle.version
 
 # Determine comfort level
 def determine_comfort_level(temp, humid, air_quality):
@@ -142,149 +241,354 @@ def determine_comfort_level(temp, humid, air_quality):
     return comfort, reasons
 
 # Control devices based on comfort level
-def control_devices(comfort, reasons, mqtt_client):
-    global ac_state, purifier_state, dehumidifier_state
-    
+def control_devices(comfort, reasons, mqtt_client, device_id, row):
     # Default states if comfortable
-    new_ac_state = "OFF"
-    new_purifier_state = "OFF"
-    new_dehumidifier_state = "OFF"
+    new_states = {
+        'ac': "OFF",
+        'purifier': "OFF",
+        'dehumidifier': "OFF",
+    }
     
     # Adjust for discomfort
     if "high temperature" in reasons:
-        new_ac_state = "ON"
+        new_states['ac'] = "ON"
     
     if "poor air quality" in reasons:
-        new_purifier_state = "ON"
+        new_states['purifier'] = "ON"
     
     if "high humidity" in reasons:
-        new_dehumidifier_state = "ON"
+        new_states['dehumidifier'] = "ON"
     
     # Publish changes if needed
-    if new_ac_state != ac_state:
-        mqtt_client.publish(AC_CONTROL_TOPIC, new_ac_state)
-        ac_state = new_ac_state
-    
-    if new_purifier_state != purifier_state:
-        mqtt_client.publish(PURIFIER_CONTROL_TOPIC, new_purifier_state)
-        purifier_state = new_purifier_state
-    
-    if new_dehumidifier_state != dehumidifier_state:
-        mqtt_client.publish(DEHUMIDIFIER_CONTROL_TOPIC, new_dehumidifier_state)
-        dehumidifier_state = new_dehumidifier_state
+    for device_name, new_state in new_states.items():
+        if new_state != device_table.get_state(row, device_name):
+            mqtt_client.publish(control_topic(device_id, device_name), new_state)
+            device_table.set_state(row, device_name, new_state)
+
+# Only the version comes back from the worker: the processor maps the saved
+# compiled file in, so it never unpickles estimators or imports sklearn
+def train_in_worker(features, targets, candidate=None):
+    """Fit and save a bundle in the training process; returns its version"""
+    from model_bundle import train_bundle
+    return train_bundle(features, targets, candidate=candidate).version
+
+def training_running():
+    return training_future is not None and not training_future.done()
 
 # Create or update ML models
-def update_ml_models():
-    global temp_model, humid_model, air_quality_model, scaler, models_loaded
+def update_ml_models(reason=None):
+    """Start a retrain in the worker process; returns whether one was started"""
+    global training_future, training_pool, training_started
+    
+    # Only one retrain at a time
+    if training_running():
+        return False
     
     # Get historical data
-    data = get_historical_data(hours=72)  # Use 3 days of data
+    data = get_historical_data(hours=72, resolution=RETRAIN_RESOLUTION)  # Use 3 days of data
     
     if len(data) < 24:  # Need at least a day of data
         print("Not enough data to train models")
-        return
-    
-    # Feature engineering
-    data['hour'] = data['timestamp'].dt.hour
-    data['day_of_week'] = data['timestamp'].dt.dayofweek
-    
-    # Prepare features and targets
-    features = data[['temperature', 'humidity', 'air_quality', 'hour', 'day_of_week']].values
-    temp_target = data['temperature'].shift(-6).dropna()  # Predict 1 hour ahead (assuming readings every 10 min)
-    humid_target = data['humidity'].shift(-6).dropna()
-    air_quality_target = data['air_quality'].shift(-6).dropna()
-    
-    # Drop NaN values from features to match target length
-    features = features[:len(temp_target)]
-    
-    # Scale features
-    scaler = StandardScaler()
-    scaled_features = scaler.fit_transform(features)
+        return False
     
-    # Train models
-    temp_model = RandomForestRegressor(n_estimators=50)
-    temp_model.fit(scaled_features, temp_target)
-    
-    humid_model = RandomForestRegressor(n_estimators=50)
-    humid_model.fit(scaled_features, humid_target)
-    
-    air_quality_model = RandomForestRegressor(n_estimators=50)
-    air_quality_model.fit(scaled_features, air_quality_target)
-    
-    # Save models
-    joblib.dump(temp_model, 'models/temp_model.pkl')
-    joblib.dump(humid_model, 'models/humid_model.pkl')
-    joblib.dump(air_quality_model, 'models/air_quality_model.pkl')
-    joblib.dump(scaler, 'models/scaler.pkl')
-    
-    models_loaded = True
-    print("ML models updated and saved")
+    # Predict 1 hour ahead, within each device's own series; targets are
+    # matched on time so gaps in the data do not shift them
+    features, targets = training_arrays(
+        data, tolerance=timedelta(seconds=RETRAIN_RESOLUTION // 2))
+    if len(features) == 0:
+        print("Not enough data to train models")
+        return False
+    
+    # Fit and save the new bundle in the worker process
+    if training_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        training_pool = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    training_started = time.perf_counter()
+    # Keep the model family a model_selection sweep chose, if any
+    candidate = current_bundle.metadata.get('candidate') if current_bundle is not None else None
+    training_future = training_pool.submit(train_in_worker, features, targets, candidate=candidate)
+    training_future.add_done_callback(install_bundle)
+    print(f"ML model retraining started ({reason})" if reason else "ML model retraining started")
+    return True
+
+def install_bundle(future):
+    """Swap in a freshly trained bundle with a single reference assignment"""
+    try:
+        bundle = load_bundle(future.result())
+    except Exception as e:
+        RETRAINS.inc(result='failed')
+        print(f"ML model retraining failed: {e}")
+        return
+    RETRAINS.inc(result='installed')
+    RETRAIN_SECONDS.observe(time.perf_counter() - training_started)
+    set_current_bundle(bundle)
+    print(f"ML models updated and saved (version {bundle.version})")
+
+def reload_current_bundle():
+    """Pick up a bundle restored with `python model_bundle.py --restore`"""
+    version = current_version()
+    if version is None or (current_bundle is not None and current_bundle.version == version):
+        return
+    try:
+        set_current_bundle(load_bundle(version))
+        print(f"Switched to model bundle {version}")
+    except (FileNotFoundError, OSError) as e:
+        print(f"Could not load model bundle {version}: {e}")
 
 # MQTT callbacks
 def on_connect(client, userdata, flags, rc):
     print(f"Connected with result code {rc}")
-    client.subscribe(TEMP_TOPIC)
-    client.subscribe(HUMID_TOPIC)
-    client.subscribe(AIR_QUALITY_TOPIC)
+    startup.mark('mqtt_connected')
+    for topic in SENSOR_TOPICS:
+        if MQTT_SHARED_GROUP:
+            topic = f"$share/{MQTT_SHARED_GROUP}/{topic}"
+        client.subscribe(topic)
 
 def on_message(client, userdata, msg):
-    topic = msg.topic
-    value = float(msg.payload.decode())
-    timestamp = datetime.now()
+    timer = StageTimer(STAGE_SECONDS)
+    current = pipeline
+    if current is None:
+        MESSAGES.inc(result=handle_message(client, msg, timer))
+    else:
+        # The network thread only routes the message; decode counts its outcome
+        parsed = parse_sensor_topic(msg.topic)
+        if parsed is None:
+            MESSAGES.inc(result='ignored')
+        elif not current['decode'].put(parsed[0], (msg, parsed, timer.started)):
+            MESSAGES.inc(result='shed')
+    MESSAGE_SECONDS.observe(time.perf_counter() - timer.started)
+
+def handle_message(client, msg, timer):
+    """Process one sensor message on the calling thread; returns the outcome counted in metrics"""
+    result, sample = decode_message(msg, timer)
+    if sample is None:
+        return result
+    control_sample(client, sample, timer)
+    infer_sample(sample, timer)
+    persist_sample(sample, timer)
+    return result
+
+def decode_message(msg, timer, parsed=None):
+    """(outcome, sample set) for one sensor message; the sample set is None
+    unless this message completed one"""
+    parsed = parsed or parse_sensor_topic(msg.topic)
+    if parsed is None:
+        return 'ignored', None
+    device_id, field = parsed
+    
+    # Skip devices owned by another processor instance
+    if INSTANCE_COUNT > 1 and device_shard(device_id, INSTANCE_COUNT) != INSTANCE_INDEX:
+        return 'other_shard', None
     
-    # Update current data
-    if topic == TEMP_TOPIC:
-        current_data['temperature'] = value
-    elif topic == HUMID_TOPIC:
-        current_data['humidity'] = value
-    elif topic == AIR_QUALITY_TOPIC:
-        current_data['air_quality'] = value
-    
-    current_data['timestamp'] = timestamp
-    
-    # Save to MongoDB
-    if None not in current_data.values():
-        sensor_data = {
-            'temperature': current_data['temperature'],
-            'humidity': current_data['humidity'],
-            'air_quality': current_data['air_quality'],
-            'timestamp': current_data['timestamp']
+    try:
+        if field is None:
+            values = parse_sensor_payload(msg.payload)
+        else:
+            values = {field: float(msg.payload.decode())}
+    except ValueError:
+        return 'invalid', None
+    timestamp = datetime.now()
+    epoch_seconds = timestamp.timestamp()
+    timer.mark('decode')
+    
+    # Update current data for this device and its pending sample set
+    for name, value in values.items():
+        row = device_table.update(device_id, name, value, timestamp)
+    reading, dropped = device_table.collect(row, values, epoch_seconds, COALESCE_WINDOW)
+    if dropped:
+        SAMPLE_SETS.inc(result=dropped)
+    timer.mark('state_update')
+    
+    # Everything after decode runs once per complete sample set
+    if reading is None:
+        return 'partial', None
+    SAMPLE_SETS.inc(result='combined' if len(values) == len(SENSOR_FIELDS) else 'merged')
+    return 'processed', {
+        'device_id': device_id,
+        'row': row,
+        'reading': reading,
+        'timestamp': timestamp,
+        'epoch_seconds': epoch_seconds,
+    }
+
+def control_sample(client, sample, timer):
+    """Comfort level and device commands; needs only the reading, so it runs
+    before inference and storage"""
+    reading = sample['reading']
+    comfort, reasons = determine_comfort_level(
+        reading['temperature'], 
+        reading['humidity'], 
+        reading['air_quality']
+    )
+    timer.mark('comfort')
+    
+    control_devices(comfort, reasons, client, sample['device_id'], sample['row'])
+    sample['comfort'] = comfort
+    sample['reasons'] = reasons
+    sample['device_states'] = device_table.device_states(sample['row'])
+    timer.mark('control')
+
+def infer_sample(sample, timer):
+    """Rolling features and next-hour predictions for a sample set"""
+    device_id, epoch_seconds = sample['device_id'], sample['epoch_seconds']
+    # Scores the predictions made an hour ago against this reading
+    retrain_scheduler.record_reading(device_id, epoch_seconds, sample['reading'])
+    
+    # Rolling windows advance with every complete reading, model or not
+    features = feature_store.update(device_id, sample['timestamp'], sample['reading'])
+    timer.mark('features')
+    
+    # Predict future values
+    prediction = predict_values(features)
+    if prediction[0] is not None:
+        retrain_scheduler.record_prediction(device_id, epoch_seconds, prediction[:3])
+        if startup.mark('first_prediction'):
+            print(f"Startup: {startup.summary()}")
+    sample['prediction'] = prediction
+    timer.mark('predict')
+
+def persist_sample(sample, timer):
+    """Queue the reading and prediction for MongoDB and share them as hot state"""
+    device_id, reading, timestamp = sample['device_id'], sample['reading'], sample['timestamp']
+    sensor_data = {
+        'device_id': device_id,
+        'temperature': reading['temperature'],
+        'humidity': reading['humidity'],
+        'air_quality': reading['air_quality'],
+        'timestamp': timestamp
+    }
+    # The writer gets its own copy, insert_many adds _id to it on flush
+    sensor_writer.add(dict(sensor_data))
+    timer.mark('sensor_insert')
+    
+    # Save prediction and comfort to MongoDB
+    temp_pred, humid_pred, air_quality_pred, model_version = sample['prediction']
+    device_states = sample['device_states']
+    prediction_data = None
+    if temp_pred is not None:
+        prediction_data = {
+            'device_id': device_id,
+            'temperature_pred': temp_pred,
+            'humidity_pred': humid_pred,
+            'air_quality_pred': air_quality_pred,
+            'comfort_level': sample['comfort'],
+            'comfort_reasons': sample['reasons'],
+            'ac_state': device_states['ac'],
+            'purifier_state': device_states['purifier'],
+            'dehumidifier_state': device_states['dehumidifier'],
+            'model_version': model_version,
+            'timestamp': timestamp
         }
-        sensor_data_collection.insert_one(sensor_data)
-        
-        # Predict future values
-        temp_pred, humid_pred, air_quality_pred = predict_values()
-        
-        # Determine comfort level
-        comfort, reasons = determine_comfort_level(
-            current_data['temperature'], 
-            current_data['humidity'], 
-            current_data['air_quality']
-        )
-        
-        # Control devices based on comfort
-        control_devices(comfort, reasons, client)
-        
-        # Save prediction and comfort to MongoDB
-        if temp_pred is not None:
-            prediction_data = {
-                'temperature_pred': temp_pred,
-                'humidity_pred': humid_pred,
-                'air_quality_pred': air_quality_pred,
-                'comfort_level': comfort,
-                'comfort_reasons': reasons,
-                'ac_state': ac_state,
-                'purifier_state': purifier_state,
-                'dehumidifier_state': dehumidifier_state,
-                'timestamp': timestamp
-            }
-            db["predictions"].insert_one(prediction_data)
+        prediction_writer.add(dict(prediction_data))
+    timer.mark('prediction_insert')
+    
+    publish_hot_state(device_id, sensor_data, prediction_data, device_states)
+    timer.mark('hot_state')
+
+def start_pipeline(client):
+    """Start the decode, control, infer and persist workers for messages from client"""
+    global pipeline
+    
+    def decode(item):
+        msg, parsed, received = item
+        result, sample = decode_message(msg, StageTimer(STAGE_SECONDS), parsed)
+        MESSAGES.inc(result=result)
+        if sample is not None:
+            sample['received'] = received
+            stages['control'].put(sample['device_id'], sample)
+    
+    def control(sample):
+        control_sample(client, sample, StageTimer(STAGE_SECONDS))
+        stages['infer'].put(sample['device_id'], sample)
+    
+    def infer(sample):
+        infer_sample(sample, StageTimer(STAGE_SECONDS))
+        stages['persist'].put(sample['device_id'], sample)
+    
+    def persist(sample):
+        persist_sample(sample, StageTimer(STAGE_SECONDS))
+        SAMPLE_SET_SECONDS.observe(time.perf_counter() - sample['received'])
+    
+    # Control is never shed: a full control stage holds up decode
+    overload = {'decode': PIPELINE_OVERLOAD, 'control': 'block',
+                'infer': PIPELINE_STORAGE_OVERLOAD, 'persist': PIPELINE_STORAGE_OVERLOAD}
+    handlers = {'decode': decode, 'control': control, 'infer': infer, 'persist': persist}
+    stages = {name: Stage(name, handlers[name], PIPELINE_WORKERS[name], PIPELINE_QUEUE_SIZE,
+                          overload[name], after=lambda wait, s=name: PIPELINE_WAIT.observe(wait, stage=s))
+              for name in PIPELINE_STAGES}
+    current = Pipeline(stages[name] for name in PIPELINE_STAGES)
+    current.start()
+    pipeline = current
+    return current
+
+def stop_pipeline():
+    """Finish every queued message, stage by stage, then run on_message inline"""
+    global pipeline
+    current, pipeline = pipeline, None
+    if current is None:
+        return
+    started = time.perf_counter()
+    current.stop()
+    print(f"Pipeline drained in {time.perf_counter() - started:.2f} s")
+
+def pipeline_stats():
+    return pipeline.stats() if pipeline is not None else {}
+
+def publish_hot_state(device_id, sensor_data, prediction_data, device_states):
+    """Share the newest values with the API so it can skip Mongo for "latest" reads"""
+    try:
+        hot_state.publish(device_id, sensor_data, prediction_data, device_states)
+    except OSError as e:
+        print(f"Could not publish hot state: {e}")
+
+def restore_feature_store():
+    """Pick the rolling windows up where the last run left them"""
+    try:
+        devices = feature_store.restore(FEATURE_STORE_PATH)
+        print(f"Feature store restored ({devices} devices)")
+    except FileNotFoundError:
+        print("No feature store snapshot, rolling features start empty")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not restore feature store: {e}")
+
+def save_feature_store():
+    try:
+        feature_store.save(FEATURE_STORE_PATH)
+    except OSError as e:
+        print(f"Could not save feature store: {e}")
+
+def writer_stats():
+    """Queue depth and flush latency counters for the batch writers"""
+    return {
+        'sensor_data': sensor_writer.stats(),
+        'predictions': prediction_writer.stats(),
+    }
 
 def main():
+    startup.mark('imported')
+    # Make sure collections and indexes exist before the first write
+    bootstrap(db)
+    startup.mark('db_ready')
+    load_models()
+    startup.mark('model_loaded')
+    restore_feature_store()
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT, json_routes={'/retrain': retrain_scheduler.snapshot,
+                                                     '/startup': startup.report,
+                                                     '/pipeline': pipeline_stats})
+        print(f"Metrics on http://localhost:{METRICS_PORT}/metrics, "
+              f"retrain decisions on http://localhost:{METRICS_PORT}/retrain")
+    sensor_writer.start()
+    prediction_writer.start()
+    
     # Setup MQTT client
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
+    if PIPELINE_ENABLED:
+        start_pipeline(client)
     
     client.connect(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
     
@@ -293,16 +597,37 @@ def main():
     
     try:
         while True:
-            # Update ML models every 6 hours
-            if not models_loaded or int(time.time()) % (6*60*60) < 10:
-                update_ml_models()
+            # Follow CURRENT if a bundle was restored by hand
+            reload_current_bundle()
+            # Count sample sets that never completed
+            SAMPLE_SETS.inc(device_table.expire(time.time(), COALESCE_WINDOW), result='timed_out')
+            save_feature_store()
+            
+            # Retrain on drift, enough new data or an old model (see RetrainScheduler)
+            if not training_running():
+                now = time.time()
+                decision = retrain_scheduler.decide(now, has_model=current_bundle is not None)
+                RETRAIN_DECISIONS.inc(reason=decision['reason'])
+                if decision['retrain'] and update_ml_models(decision['reason']):
+                    retrain_scheduler.retrain_started(now)
             
             time.sleep(60)  # Check every minute
             
     except KeyboardInterrupt:
         print("Exiting program")
+    finally:
+        # Stop taking messages, finish the queued ones while still connected
+        # (without the network thread paho sends publishes directly), then
+        # disconnect and flush anything still buffered before exiting
         client.loop_stop()
+        stop_pipeline()
         client.disconnect()
+        if training_pool is not None:
+            training_pool.shutdown(wait=False, cancel_futures=True)
+        sensor_writer.stop()
+        prediction_writer.stop()
+        save_feature_store()
+        print(f"Writer stats: {writer_stats()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,311 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from cold_storage import COLD_STORAGE_DIR
+from data_loader import SENSOR_FIELDS, load_raw
+from downsampling import EPOCH
+from feature_store import FEATURE_WINDOWS
+
+# The rules of mqtt_processor.determine_comfort_level
+COMFORT_THRESHOLDS = {
+    'temperature_high': 28.0,
+    'temperature_low': 18.0,
+    'humidity_high': 65.0,
+    'humidity_low': 30.0,
+    'air_quality_high': 700.0,
+}
+COMFORT_LEVELS = ["comfortable", "uncomfortable", "poor air"]
+COMFORT_REASONS = ["high temperature", "low temperature", "high humidity", "low humidity",
+                   "poor air quality"]
+# Reason that switches each device on, as in mqtt_processor.control_devices
+DEVICE_REASONS = {
+    'ac': "high temperature",
+    'purifier': "poor air quality",
+    'dehumidifier': "high humidity",
+}
+
+# Readings are replayed this much at a time, plus the widest rolling window before it
+REPLAY_CHUNK = timedelta(days=1)
+# Predictions per insert_many
+WRITE_BATCH = 5000
+WRITE_MODES = ('replace', 'alongside')
+
+
+def to_ms(value):
+    return int((value - EPOCH).total_seconds() * 1000)
+
+
+def comfort_columns(values, thresholds=COMFORT_THRESHOLDS):
+    """Vectorized determine_comfort_level.
+
+    Returns level codes and their values, reason codes (one bit per rule)
+    and their reason lists, and the per-rule masks.
+    """
+    temp, humid, air = (values[field] for field in SENSOR_FIELDS)
+    high_temp = temp > thresholds['temperature_high']
+    high_humid = humid > thresholds['humidity_high']
+    # Low is only checked when high is not (elif), like the scalar rules
+    flags = [high_temp, (temp < thresholds['temperature_low']) & ~high_temp,
+             high_humid, (humid < thresholds['humidity_low']) & ~high_humid,
+             air > thresholds['air_quality_high']]
+    reason_code = sum(flag.astype(np.int32) << bit for bit, flag in enumerate(flags))
+    reasons = [[name for bit, name in enumerate(COMFORT_REASONS) if code >> bit & 1]
+               for code in range(1 << len(COMFORT_REASONS))]
+
+    level = np.where(flags[4], 2, np.where(reason_code > 0, 1, 0)).astype(np.int32)
+    return level, COMFORT_LEVELS, reason_code, reasons, flags
+
+
+def device_columns(flags):
+    """ON masks per device for comfort_columns flags, the control_devices policy"""
+    return {device: flags[COMFORT_REASONS.index(reason)] for device, reason in DEVICE_REASONS.items()}
+
+
+class ReplayBatch:
+    """Readings of one chunk, sorted by time, with their replayed predictions"""
+
+    def __init__(self, timestamp, device, device_ids, values, predicted=None):
+        self.timestamp = timestamp
+        self.device = device
+        self.device_ids = device_ids
+        self.values = values
+        self.predicted = predicted
+
+    def __len__(self):
+        return len(self.timestamp)
+
+
+def replay_batches(db, bundle, start_time, end_time, device_id=None, chunk=REPLAY_CHUNK,
+                   archive_dir=COLD_STORAGE_DIR):
+    """ReplayBatch per chunk of [start_time, end_time).
+
+    Each chunk is loaded with the widest rolling window of history before
+    it, so features match what the processor computed live; features and
+    predictions are computed for the whole chunk at once. bundle=None
+    skips predicting.
+    """
+    warmup = timedelta(seconds=max(seconds for _, seconds in FEATURE_WINDOWS))
+    chunk_start = start_time
+    while chunk_start < end_time:
+        chunk_end = min(chunk_start + chunk, end_time)
+        columns = load_raw(db['sensor_data'], chunk_start - warmup, chunk_end, device_id,
+                           archive_dir=archive_dir)
+        n = len(columns)
+        timestamp = columns.timestamp[:n]
+        current = np.column_stack([columns.values[field][:n] for field in SENSOR_FIELDS])
+        keep = ((timestamp >= to_ms(chunk_start)) & (timestamp < to_ms(chunk_end))
+                & ~np.isnan(current).any(axis=1))
+        predicted = None
+        if bundle is not None and keep.any():
+            features = columns.features()[keep]
+            predicted = bundle.engine.predict(features[:, :bundle.engine.n_features])
+        yield ReplayBatch(timestamp[keep], columns.device[:n][keep], columns.device_ids,
+                          {field: columns.values[field][:n][keep] for field in SENSOR_FIELDS},
+                          predicted)
+        chunk_start = chunk_end
+
+
+def prediction_docs(batch, version, replayed_at, alongside=False):
+    """predictions documents shaped like the processor's, built column-wise"""
+    level, levels, reason_code, reasons, flags = comfort_columns(batch.values)
+    on = device_columns(flags)
+    timestamps = batch.timestamp.astype('datetime64[ms]').astype(object)
+    device_ids = np.asarray(batch.device_ids, dtype=object)[batch.device]
+    predicted = batch.predicted.tolist()
+    states = {device: np.where(mask, "ON", "OFF").tolist() for device, mask in on.items()}
+    docs = []
+    for i, (device_id, ts, pred) in enumerate(zip(device_ids, timestamps, predicted)):
+        doc = {
+            'device_id': device_id,
+            'temperature_pred': pred[0],
+            'humidity_pred': pred[1],
+            'air_quality_pred': pred[2],
+            'comfort_level': levels[level[i]],
+            'comfort_reasons': reasons[reason_code[i]],
+            'ac_state': states['ac'][i],
+            'purifier_state': states['purifier'][i],
+            'dehumidifier_state': states['dehumidifier'][i],
+            'model_version': version,
+            'timestamp': ts,
+            'replayed_at': replayed_at,
+        }
+        if alongside:
+            doc['alongside'] = True
+        docs.append(doc)
+    return docs
+
+
+def write_batch(collection, batch, chunk_start, chunk_end, version, mode, device_id=None,
+                replayed_at=None, batch_size=WRITE_BATCH):
+    """Write one chunk's predictions; returns the documents inserted.
+
+    mode='replace' deletes the live predictions in the chunk first, leaving
+    other versions' alongside replays in place; mode='alongside' keeps them
+    and only deletes an earlier alongside replay of the same model version,
+    so replays can be rerun.
+    """
+    query = {'timestamp': {'$gte': chunk_start, '$lt': chunk_end}}
+    if device_id:
+        query['device_id'] = device_id
+    if mode == 'alongside':
+        query.update({'alongside': True, 'model_version': version})
+    else:
+        query['alongside'] = {'$ne': True}
+    collection.delete_many(query)
+    if batch.predicted is None:
+        return 0
+    docs = prediction_docs(batch, version, replayed_at or datetime.now(), mode == 'alongside')
+    for start in range(0, len(docs), batch_size):
+        collection.insert_many(docs[start:start + batch_size], ordered=False)
+    return len(docs)
+
+
+def hold_seconds(timestamp, device, end_ms):
+    """Seconds each reading's device states stay in force.
+
+    States last until the same device's next reading, or until end_ms for
+    its last one. Returns (hold, order) with order sorting rows by device,
+    then time.
+    """
+    order = np.lexsort((timestamp, device))
+    ts, dev = timestamp[order], device[order]
+    following = np.empty_like(ts)
+    following[:-1] = ts[1:]
+    last = np.r_[dev[1:] != dev[:-1], True]
+    following[last] = end_ms
+    hold = np.empty(len(ts))
+    hold[order] = (np.maximum(following, ts) - ts) / 1000
+    return hold, order
+
+
+def on_time(values, hold, order, device, thresholds=COMFORT_THRESHOLDS):
+    """Hours ON and switch count per device under the given thresholds.
+
+    A switch is a state change between a device's consecutive readings,
+    i.e. a control message the processor would have published.
+    """
+    _, _, _, _, flags = comfort_columns(values, thresholds)
+    same_device = device[order][1:] == device[order][:-1]
+    report = {}
+    for name, mask in device_columns(flags).items():
+        ordered = mask[order]
+        report[name] = {
+            'on_hours': float(hold[mask].sum() / 3600),
+            'switches': int(((ordered[1:] != ordered[:-1]) & same_device).sum()),
+        }
+    return report
+
+
+def threshold_report(values, timestamp, device, end_ms, thresholds):
+    """Device on-time under the current rules and under `thresholds`"""
+    started = time.perf_counter()
+    hold, order = hold_seconds(timestamp, device, end_ms)
+    current = on_time(values, hold, order, device)
+    changed = on_time(values, hold, order, device, {**COMFORT_THRESHOLDS, **thresholds})
+    elapsed = time.perf_counter() - started
+    return {
+        'thresholds': {**COMFORT_THRESHOLDS, **thresholds},
+        'rows_per_sec': len(timestamp) / elapsed if elapsed else None,
+        'devices': {
+            name: {
+                'current': current[name],
+                'changed': changed[name],
+                'on_hours_delta': changed[name]['on_hours'] - current[name]['on_hours'],
+                'switches_delta': changed[name]['switches'] - current[name]['switches'],
+            }
+            for name in DEVICE_REASONS
+        },
+    }
+
+
+def run(db, start_time, end_time, bundle=None, mode=None, device_id=None, thresholds=None,
+        chunk=REPLAY_CHUNK, archive_dir=COLD_STORAGE_DIR):
+    """Replay a range: predictions written with `mode` (if a bundle is given)
+    and a threshold report (if thresholds are given)"""
+    started = time.perf_counter()
+    replayed_at = datetime.now()
+    rows, written = 0, 0
+    kept = []
+    chunk_start = start_time
+    for batch in replay_batches(db, bundle, start_time, end_time, device_id, chunk, archive_dir):
+        chunk_end = min(chunk_start + chunk, end_time)
+        rows += len(batch)
+        if mode is not None:
+            written += write_batch(db['predictions'], batch, chunk_start, chunk_end,
+                                   bundle.version, mode, device_id, replayed_at)
+        if thresholds is not None:
+            # Device codes differ per chunk, so keep ids for the report
+            kept.append((batch.timestamp, np.asarray(batch.device_ids, dtype=object)[batch.device],
+                         batch.values))
+        chunk_start = chunk_end
+
+    report = {
+        'start': start_time.isoformat(),
+        'end': end_time.isoformat(),
+        'device_id': device_id,
+        'model_version': bundle.version if bundle is not None else None,
+        'mode': mode,
+        'rows': rows,
+        'written': written,
+        'elapsed_s': time.perf_counter() - started,
+    }
+    if thresholds is not None:
+        timestamp = np.concatenate([part[0] for part in kept] + [np.zeros(0, dtype=np.int64)])
+        _, device = np.unique(np.concatenate([part[1] for part in kept] + [np.zeros(0, dtype=object)]),
+                              return_inverse=True)
+        values = {field: np.concatenate([part[2][field] for part in kept] + [np.zeros(0)])
+                  for field in SENSOR_FIELDS}
+        report['on_time'] = threshold_report(values, timestamp, device, to_ms(end_time), thresholds)
+    return report
+
+
+def parse_threshold(text):
+    name, _, value = text.partition('=')
+    if name not in COMFORT_THRESHOLDS or not value:
+        raise argparse.ArgumentTypeError(
+            f"expected <name>=<value> with name one of {', '.join(COMFORT_THRESHOLDS)}")
+    return name, float(value)
+
+
+def main():
+    import pymongo
+    from model_bundle import load_bundle, load_latest_bundle
+
+    parser = argparse.ArgumentParser(description="Replay stored readings through a model bundle "
+                                                 "and the comfort rules")
+    parser.add_argument('--start', required=True, type=datetime.fromisoformat)
+    parser.add_argument('--end', type=datetime.fromisoformat, help="default: now")
+    parser.add_argument('--device', help="only this device id")
+    parser.add_argument('--write', choices=WRITE_MODES,
+                        help="replace stored predictions, or write alongside them tagged with "
+                             "the model version; omit to only report")
+    parser.add_argument('--version', help="model bundle version (default: the current one)")
+    parser.add_argument('--threshold', type=parse_threshold, action='append', default=[],
+                        help="report device on-time with this rule changed, e.g. temperature_high=27")
+    parser.add_argument('--chunk-hours', type=float, default=REPLAY_CHUNK.total_seconds() / 3600)
+    parser.add_argument('--report', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    bundle = None
+    if args.write:
+        bundle = load_bundle(args.version) if args.version else load_latest_bundle()
+    client = pymongo.MongoClient("mongodb://localhost:27017/")
+    report = run(client["iot_monitoring"], args.start, args.end or datetime.now(), bundle, args.write,
+                 args.device, dict(args.threshold) if args.threshold else None,
+                 timedelta(hours=args.chunk_hours))
+
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text + '\n')
+        print(f"Report written to {args.report}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
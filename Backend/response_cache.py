@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Number of distinct queries kept per API worker
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+
+
+def make_etag(*parts):
+    """Weak ETag for a set of values (the body may be sent in several encodings)"""
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+def http_date(timestamp):
+    """HTTP-date for a datetime; naive datetimes are local time like the stored data"""
+    return format_datetime(timestamp.astimezone(timezone.utc), usegmt=True)
+
+
+def _opaque_tag(tag):
+    return tag.strip().removeprefix('W/')
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """True when the client's validators still match (If-None-Match wins)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {_opaque_tag(tag) for tag in if_none_match.split(",")}
+        return "*" in tags or _opaque_tag(etag) in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified.timestamp()) <= since.timestamp()
+    return False
+
+
+def accepted_encodings(request):
+    """Content codings the client accepts (q=0 excluded)"""
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding.strip():
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def json_body(content):
+    """Compact JSON bytes, encoded the way FastAPI encodes return values"""
+    return json.dumps(jsonable_encoder(content), separators=(",", ":")).encode()
+
+
+def _validator_headers(etag):
+    return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+
+
+class CachedResponse:
+    """Encoded body plus its compressed forms, compressed once"""
+
+    def __init__(self, etag, last_modified, body, media_type="application/json"):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.media_type = media_type
+        self.bodies = {"identity": body}
+        if len(body) >= COMPRESS_MIN_SIZE:
+            self.bodies["gzip"] = gzip.compress(body, GZIP_LEVEL)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+
+    def headers(self):
+        headers = _validator_headers(self.etag)
+        if self.last_modified is not None:
+            headers["Last-Modified"] = http_date(self.last_modified)
+        return headers
+
+    def response(self, request):
+        accepted = accepted_encodings(request)
+        headers = self.headers()
+        for coding in ("br", "gzip"):
+            if coding in self.bodies and coding in accepted:
+                headers["Content-Encoding"] = coding
+                return Response(self.bodies[coding], media_type=self.media_type,
+                                headers=headers)
+        return Response(self.bodies["identity"], media_type=self.media_type,
+                        headers=headers)
+
+
+class ResponseCache:
+    """LRU of encoded responses keyed on the query.
+
+    The ETag is derived from the newest data timestamp, so an entry is
+    replaced as soon as new data has been ingested for its query. Clients
+    that send a matching If-None-Match get 304 without the query running.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key, etag):
+        entry = self.entries.get(key)
+        if entry is None or entry.etag != etag:
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def respond(self, request, key, etag, last_modified, build,
+                      media_type="application/json"):
+        """Serve `key` as 304, from cache, or by awaiting build() and caching it.
+
+        build() returns the encoded body as bytes.
+        """
+        if is_not_modified(request, etag, last_modified):
+            self.not_modified += 1
+            return Response(status_code=304, headers=_validator_headers(etag))
+
+        entry = self.get(key, etag)
+        if entry is None:
+            self.misses += 1
+            entry = CachedResponse(etag, last_modified, await build(), media_type)
+            self.put(key, entry)
+        else:
+            self.hits += 1
+        return entry.response(request)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+        }
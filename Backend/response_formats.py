@@ -0,0 +1,111 @@
+import functools
+import importlib.util
+import io
+import json
+
+import numpy as np
+
+# Optional packages per format; they are imported on first use, as pyarrow
+# alone adds a few hundred milliseconds to worker startup
+OPTIONAL_PACKAGES = {
+    "arrow": "pyarrow",
+    "msgpack": "msgpack",
+}
+
+# format= value -> media type; rows is the default list-of-objects JSON
+MEDIA_TYPES = {
+    "rows": "application/json",
+    "columnar": "application/vnd.iot.columnar+json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "msgpack": "application/msgpack",
+}
+FORMATS_BY_MEDIA_TYPE = {media_type: name for name, media_type in MEDIA_TYPES.items()}
+FORMATS_BY_MEDIA_TYPE["application/x-msgpack"] = "msgpack"
+
+
+class UnsupportedFormat(ValueError):
+    """Requested format is unknown, or its optional library is not installed"""
+
+
+@functools.lru_cache(maxsize=None)
+def _installed(package):
+    return importlib.util.find_spec(package) is not None
+
+
+def available(name):
+    if name in OPTIONAL_PACKAGES:
+        return _installed(OPTIONAL_PACKAGES[name])
+    return name in MEDIA_TYPES
+
+
+def negotiate(format_param=None, accept=None):
+    """Response format from format= (wins) or the Accept header"""
+    if format_param:
+        if format_param not in MEDIA_TYPES:
+            raise UnsupportedFormat(
+                f"format must be one of: {', '.join(MEDIA_TYPES)}")
+        if not available(format_param):
+            raise UnsupportedFormat(f"{format_param} output needs an extra package installed")
+        return format_param
+
+    # First listed type we can produce; q-values are not ranked
+    for item in (accept or "").split(","):
+        media_type = item.split(";")[0].strip().lower()
+        name = FORMATS_BY_MEDIA_TYPE.get(media_type)
+        if name is not None and available(name):
+            return name
+    return "rows"
+
+
+def _json_values(values):
+    if values.dtype.kind == "f":
+        nan = np.isnan(values)
+        if nan.any():
+            # JSON has no NaN; missing values become null
+            values = values.astype(object)
+            values[nan] = None
+    return values.tolist()
+
+
+def encode_columnar(columns):
+    """{"column": [values...]} with timestamps as epoch-ms integers"""
+    payload = {name: _json_values(values) for name, values in columns.items()}
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def encode_msgpack(columns):
+    import msgpack
+
+    payload = {name: values.tolist() for name, values in columns.items()}
+    return msgpack.packb(payload)
+
+
+def encode_arrow(columns):
+    """Arrow IPC stream with a single record batch"""
+    import pyarrow
+    import pyarrow.ipc
+
+    arrays = {}
+    for name, values in columns.items():
+        if name == "timestamp":
+            arrays[name] = pyarrow.array(values, type=pyarrow.timestamp("ms"))
+        elif values.dtype.kind == "f":
+            arrays[name] = pyarrow.array(values, from_pandas=True)  # NaN -> null
+        else:
+            arrays[name] = pyarrow.array(values.tolist())
+    table = pyarrow.table(arrays)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+ENCODERS = {
+    "columnar": encode_columnar,
+    "arrow": encode_arrow,
+    "msgpack": encode_msgpack,
+}
+
+
+def encode_columns(name, columns):
+    return ENCODERS[name](columns)
@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from data_loader import SENSOR_FIELDS, TARGET_HORIZON, TARGET_TOLERANCE
+
+# Never retrain more often than this, whatever the triggers say
+RETRAIN_MIN_INTERVAL = float(os.environ.get("RETRAIN_MIN_INTERVAL", str(30 * 60)))  # seconds
+# Always retrain after this long, even if nothing changed
+RETRAIN_MAX_INTERVAL = float(os.environ.get("RETRAIN_MAX_INTERVAL", str(24 * 60 * 60)))  # seconds
+# Retrain once this many complete readings arrived since the last retrain
+RETRAIN_NEW_SAMPLES = int(os.environ.get("RETRAIN_NEW_SAMPLES", "20000"))
+# Retrain when any field's rolling MAE is this much worse than right after the last retrain
+RETRAIN_DRIFT_RATIO = float(os.environ.get("RETRAIN_DRIFT_RATIO", "0.5"))
+
+# Rolling MAE over this many matched predictions per field
+ERROR_WINDOW = 500
+# Matched predictions needed before the MAE is trusted for a baseline or drift
+MIN_ERROR_SAMPLES = 100
+# Decisions kept for inspection
+DECISION_HISTORY = 50
+
+
+class RollingMAE:
+    """Mean absolute error over the last `window` errors, O(1) per update"""
+
+    def __init__(self, window=ERROR_WINDOW):
+        self.errors = deque(maxlen=window)
+        self.total = 0.0
+
+    def add(self, error):
+        if len(self.errors) == self.errors.maxlen:
+            self.total -= self.errors[0]
+        self.errors.append(error)
+        self.total += error
+
+    def __len__(self):
+        return len(self.errors)
+
+    def value(self):
+        return self.total / len(self.errors) if self.errors else None
+
+
+class RetrainScheduler:
+    """Decides when to retrain from prediction error and data volume.
+
+    Every prediction is remembered until the reading it forecast arrives
+    (the same device's first reading at least `horizon` later, within
+    `tolerance`), and the absolute errors feed a rolling MAE per field. The
+    MAE measured once enough predictions of a freshly installed model have
+    been checked becomes the baseline; drift is the rolling MAE rising more
+    than drift_ratio above it.
+
+    decide() retrains when there is no model, when max_interval passed,
+    when new_samples readings arrived or when drift is detected, but never
+    sooner than min_interval after the last retrain. Times are epoch
+    seconds. Readings and predictions are recorded from the MQTT thread and
+    decisions made from the main loop, so state is behind a lock.
+    """
+
+    def __init__(self, min_interval=RETRAIN_MIN_INTERVAL, max_interval=RETRAIN_MAX_INTERVAL,
+                 new_samples=RETRAIN_NEW_SAMPLES, drift_ratio=RETRAIN_DRIFT_RATIO,
+                 horizon=TARGET_HORIZON, tolerance=TARGET_TOLERANCE,
+                 window=ERROR_WINDOW, min_error_samples=MIN_ERROR_SAMPLES):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.new_samples_threshold = new_samples
+        self.drift_ratio = drift_ratio
+        self.horizon = horizon.total_seconds()
+        self.tolerance = tolerance.total_seconds()
+        self.window = window
+        self.min_error_samples = min_error_samples
+
+        self.lock = threading.Lock()
+        self.pending = defaultdict(deque)  # device_id -> (due time, predicted values)
+        self.mae = {field: RollingMAE(window) for field in SENSOR_FIELDS}
+        self.baseline = None
+        self.model_version = None
+        self.last_retrain = None
+        self.new_samples = 0
+        self.predictions_checked = 0
+        self.decisions = deque(maxlen=DECISION_HISTORY)
+        self.decision_counts = defaultdict(int)
+
+    def record_prediction(self, device_id, timestamp, predicted):
+        """Remember a (temperature, humidity, air_quality) forecast made at timestamp"""
+        with self.lock:
+            self.pending[device_id].append((timestamp + self.horizon, predicted))
+
+    def record_reading(self, device_id, timestamp, reading):
+        """Count a complete reading and score the forecasts that were due by now"""
+        with self.lock:
+            self.new_samples += 1
+            pending = self.pending.get(device_id)
+            while pending and pending[0][0] <= timestamp:
+                due, predicted = pending.popleft()
+                # A reading long after the due time (device was offline) does not count
+                if timestamp - due > self.tolerance:
+                    continue
+                for field, value in zip(SENSOR_FIELDS, predicted):
+                    self.mae[field].add(abs(reading[field] - value))
+                self.predictions_checked += 1
+            if self.baseline is None and self.predictions_checked >= self.min_error_samples:
+                self.baseline = self._current_mae()
+
+    def model_installed(self, version, trained_at=None):
+        """Start scoring a new model: forecasts and errors of the old one are dropped"""
+        with self.lock:
+            if version == self.model_version:
+                return
+            self.model_version = version
+            self.pending.clear()
+            self.mae = {field: RollingMAE(self.window) for field in SENSOR_FIELDS}
+            self.baseline = None
+            self.predictions_checked = 0
+            if self.last_retrain is None:
+                # A model of unknown age counts from when it was loaded
+                self.last_retrain = (trained_at.timestamp() if isinstance(trained_at, datetime)
+                                     else time.time())
+
+    def retrain_started(self, now):
+        with self.lock:
+            self.last_retrain = now
+            self.new_samples = 0
+
+    def _current_mae(self):
+        return {field: mae.value() for field, mae in self.mae.items()}
+
+    def _drift(self):
+        """(field, ratio) of the worst MAE increase over the baseline, if measurable"""
+        if self.baseline is None or self.predictions_checked < self.min_error_samples:
+            return None, None
+        worst = (None, None)
+        for field, mae in self.mae.items():
+            base = self.baseline.get(field)
+            if not base or len(mae) < self.min_error_samples:
+                continue
+            ratio = mae.value() / base - 1
+            if worst[1] is None or ratio > worst[1]:
+                worst = (field, ratio)
+        return worst
+
+    def decide(self, now, has_model=True):
+        """Whether to retrain now, recorded with its reason"""
+        with self.lock:
+            since = None if self.last_retrain is None else now - self.last_retrain
+            drift_field, drift = self._drift()
+            if not has_model:
+                retrain, reason = True, 'no_model'
+            elif since is not None and since < self.min_interval:
+                retrain, reason = False, 'min_interval'
+            elif since is None or since >= self.max_interval:
+                retrain, reason = True, 'max_interval'
+            elif self.new_samples >= self.new_samples_threshold:
+                retrain, reason = True, 'volume'
+            elif drift is not None and drift > self.drift_ratio:
+                retrain, reason = True, 'drift'
+            else:
+                retrain, reason = False, 'no_change'
+
+            decision = {
+                'time': now,
+                'retrain': retrain,
+                'reason': reason,
+                'seconds_since_retrain': since,
+                'new_samples': self.new_samples,
+                'drift': drift,
+                'drift_field': drift_field,
+            }
+            self.decision_counts[reason] += 1
+            # Holding for the same reason every minute is not worth keeping
+            if retrain or not self.decisions or self.decisions[-1]['reason'] != reason:
+                self.decisions.append(decision)
+            return decision
+
+    def snapshot(self):
+        """Current statistics, thresholds and recent decisions"""
+        with self.lock:
+            return {
+                'model_version': self.model_version,
+                'last_retrain': self.last_retrain,
+                'new_samples': self.new_samples,
+                'predictions_checked': self.predictions_checked,
+                'pending_predictions': sum(len(pending) for pending in self.pending.values()),
+                'mae': self._current_mae(),
+                'baseline_mae': self.baseline,
+                'thresholds': {
+                    'min_interval': self.min_interval,
+                    'max_interval': self.max_interval,
+                    'new_samples': self.new_samples_threshold,
+                    'drift_ratio': self.drift_ratio,
+                },
+                'decision_counts': dict(self.decision_counts),
+                'decisions': list(self.decisions),
+            }
+
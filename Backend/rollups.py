@@ -0,0 +1,209 @@
+import argparse
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, UpdateOne
+
+from downsampling import EPOCH, bucket_expression
+
+SENSOR_FIELDS = ['temperature', 'humidity', 'air_quality']
+
+# (collection name, bucket width in seconds), finest first
+ROLLUP_LEVELS = [
+    ('sensor_data_1m', 60),
+    ('sensor_data_1h', 60 * 60),
+    ('sensor_data_1d', 24 * 60 * 60),
+]
+
+
+def bucket_start(timestamp, seconds):
+    """Floor a datetime to the start of its bucket"""
+    offset = (timestamp - EPOCH).total_seconds() % seconds
+    return timestamp - timedelta(seconds=offset)
+
+
+def rollup_for(bucket_s):
+    """Coarsest rollup level that is still at least as fine as bucket_s"""
+    chosen = None
+    for name, seconds in ROLLUP_LEVELS:
+        if seconds <= bucket_s:
+            chosen = (name, seconds)
+    return chosen
+
+
+def rollup_updates(docs, seconds):
+    """Bulk upserts folding raw readings into buckets of the given width.
+
+    Readings are pre-aggregated per (device, bucket) so a flush of many
+    readings costs one upsert per touched bucket.
+    """
+    buckets = {}
+    for doc in docs:
+        key = (doc.get('device_id'), bucket_start(doc['timestamp'], seconds))
+        acc = buckets.get(key)
+        if acc is None:
+            acc = buckets[key] = {'count': 0, 'last_timestamp': doc['timestamp']}
+            for field in SENSOR_FIELDS:
+                acc[f'{field}_sum'] = 0.0
+                acc[f'{field}_min'] = doc[field]
+                acc[f'{field}_max'] = doc[field]
+                acc[f'{field}_last'] = doc[field]
+        acc['count'] += 1
+        newest = doc['timestamp'] >= acc['last_timestamp']
+        if newest:
+            acc['last_timestamp'] = doc['timestamp']
+        for field in SENSOR_FIELDS:
+            value = doc[field]
+            acc[f'{field}_sum'] += value
+            acc[f'{field}_min'] = min(acc[f'{field}_min'], value)
+            acc[f'{field}_max'] = max(acc[f'{field}_max'], value)
+            if newest:
+                acc[f'{field}_last'] = value
+
+    updates = []
+    for (device_id, bucket), acc in buckets.items():
+        inc = {'count': acc['count']}
+        set_ = {'last_timestamp': acc['last_timestamp']}
+        minimum, maximum = {}, {}
+        for field in SENSOR_FIELDS:
+            inc[f'{field}_sum'] = acc[f'{field}_sum']
+            minimum[f'{field}_min'] = acc[f'{field}_min']
+            maximum[f'{field}_max'] = acc[f'{field}_max']
+            set_[f'{field}_last'] = acc[f'{field}_last']
+        updates.append(UpdateOne(
+            {'device_id': device_id, 'bucket': bucket},
+            {'$inc': inc, '$min': minimum, '$max': maximum, '$set': set_},
+            upsert=True))
+    return updates
+
+
+class RollupWriter:
+    """Keeps the rollup collections up to date from flushed raw readings"""
+
+    def __init__(self, db):
+        self.db = db
+        self.upserts = 0
+        self.errors = 0
+
+    def apply(self, docs):
+        for name, seconds in ROLLUP_LEVELS:
+            updates = rollup_updates(docs, seconds)
+            if not updates:
+                continue
+            try:
+                self.db[name].bulk_write(updates, ordered=False)
+                self.upserts += len(updates)
+            except Exception as e:
+                self.errors += 1
+                print(f"[{name}] rollup update failed: {e}")
+
+
+def ensure_rollup_indexes(db):
+    for name, _ in ROLLUP_LEVELS:
+        db[name].create_index([('device_id', ASCENDING), ('bucket', ASCENDING)], unique=True)
+        db[name].create_index([('bucket', ASCENDING)])
+
+
+def rollup_pipeline(match, bucket_s, per_device=False):
+    """Re-bucket a rollup collection to bucket_s seconds.
+
+    `match` filters on `bucket`/`device_id`. Rows have the same shape as the
+    raw downsampling pipeline: field averages, `<field>_min`/`_max`, count.
+    """
+    key = bucket_expression(bucket_s * 1000, "$bucket")
+    group_id = {'device_id': '$device_id', 'bucket': key} if per_device else key
+    group = {'_id': group_id, 'count': {'$sum': '$count'}}
+    project = {'_id': 0, 'count': 1}
+    if per_device:
+        project['device_id'] = '$_id.device_id'
+        project['timestamp'] = '$_id.bucket'
+    else:
+        project['timestamp'] = '$_id'
+    for field in SENSOR_FIELDS:
+        group[f'{field}_sum'] = {'$sum': f'${field}_sum'}
+        group[f'{field}_min'] = {'$min': f'${field}_min'}
+        group[f'{field}_max'] = {'$max': f'${field}_max'}
+        project[field] = {'$divide': [f'${field}_sum', '$count']}
+        project[f'{field}_min'] = 1
+        project[f'{field}_max'] = 1
+    return [
+        {'$match': match},
+        {'$group': group},
+        {'$sort': {'_id': 1}},
+        {'$project': project},
+    ]
+
+
+def _backfill_level(source, target, seconds, from_raw, start_time, end_time):
+    time_field = 'timestamp' if from_raw else 'bucket'
+    group = {
+        '_id': {'device_id': '$device_id',
+                'bucket': bucket_expression(seconds * 1000, f'${time_field}')},
+        'count': {'$sum': 1 if from_raw else '$count'},
+        'last_timestamp': {'$last': '$timestamp' if from_raw else '$last_timestamp'},
+    }
+    for field in SENSOR_FIELDS:
+        group[f'{field}_sum'] = {'$sum': f'${field}' if from_raw else f'${field}_sum'}
+        group[f'{field}_min'] = {'$min': f'${field}' if from_raw else f'${field}_min'}
+        group[f'{field}_max'] = {'$max': f'${field}' if from_raw else f'${field}_max'}
+        group[f'{field}_last'] = {'$last': f'${field}' if from_raw else f'${field}_last'}
+
+    match = {}
+    if start_time or end_time:
+        match[time_field] = {}
+        if start_time:
+            match[time_field]['$gte'] = start_time
+        if end_time:
+            match[time_field]['$lt'] = end_time
+
+    source.aggregate([
+        {'$match': match},
+        {'$sort': {time_field: 1}},
+        {'$group': group},
+        {'$addFields': {'device_id': '$_id.device_id', 'bucket': '$_id.bucket'}},
+        {'$project': {'_id': 0}},
+        {'$merge': {'into': target.name, 'on': ['device_id', 'bucket'],
+                    'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+    ], allowDiskUse=True)
+
+
+def backfill(db, start_time=None, end_time=None):
+    """Rebuild rollups from existing raw data.
+
+    The 1-minute level is built from sensor_data and each coarser level from
+    the one below it, so raw data is scanned once. Bounds should fall on day
+    boundaries so partially covered buckets are not replaced.
+    """
+    ensure_rollup_indexes(db)
+    source, from_raw = db['sensor_data'], True
+    for name, seconds in ROLLUP_LEVELS:
+        print(f"Backfilling {name}...")
+        _backfill_level(source, db[name], seconds, from_raw, start_time, end_time)
+        source, from_raw = db[name], False
+    print("Rollup backfill complete")
+
+
+def main():
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Maintain sensor_data rollup collections")
+    parser.add_argument('--backfill', action='store_true', help="rebuild rollups from raw sensor_data")
+    parser.add_argument('--days', type=int, help="only backfill the last N days")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient("mongodb://localhost:27017/")
+    db = client["iot_monitoring"]
+
+    if args.backfill:
+        start_time = None
+        if args.days:
+            today = bucket_start(datetime.now(), 24 * 60 * 60)
+            start_time = today - timedelta(days=args.days)
+        backfill(db, start_time)
+    else:
+        ensure_rollup_indexes(db)
+        for name, _ in ROLLUP_LEVELS:
+            print(f"{name}: {db[name].estimated_document_count()} buckets")
+
+
+if __name__ == "__main__":
+    main()
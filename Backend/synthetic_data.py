@@ -0,0 +1,230 @@
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from data_loader import SENSOR_FIELDS, SensorColumns, MS_PER_DAY, MS_PER_HOUR, EPOCH_WEEKDAY
+from device_state import DEFAULT_DEVICE_ID
+
+# Rows generated per chunk; bounds memory when writing tens of millions of rows
+CHUNK_ROWS = 1_000_000
+# Documents per insert_many when writing to Mongo
+INSERT_BATCH = 10_000
+
+# Daily pattern (value at mean, daily amplitude, noise std) per field,
+# same shapes as the original sample data
+BASELINES = {
+    'temperature': (22.0, 5.0, 1.0),
+    'humidity': (50.0, 10.0, 3.0),
+    'air_quality': (500.0, 100.0, 50.0),
+}
+# Humidity peaks at night, temperature and air quality during the day
+PHASE_HOURS = {'temperature': 0.0, 'humidity': 18.0, 'air_quality': 0.0}
+# Ranges values are clipped to before anomalies are injected
+RANGES = {'temperature': (15, 30), 'humidity': (30, 70), 'air_quality': (300, 800)}
+# Physical limits, also applied to anomalies
+LIMITS = {'temperature': (-20, 60), 'humidity': (0, 100), 'air_quality': (0, 5000)}
+# Spike size range per field; temperature spikes may go either way
+ANOMALY_SIZES = {'temperature': (6, 12), 'humidity': (15, 30), 'air_quality': (300, 600)}
+
+
+def device_names(devices):
+    if devices == 1:
+        return [DEFAULT_DEVICE_ID]
+    return [f"room-{i:03d}" for i in range(devices)]
+
+
+def _gap_mask(rng, n_steps, n_devices, gap_rate, gap_steps):
+    """(n_steps, n_devices) mask of readings removed by outages.
+
+    Outages start at random steps and last an exponential number of steps
+    with mean gap_steps, so about gap_rate of readings go missing.
+    """
+    if gap_rate <= 0:
+        return np.zeros((n_steps, n_devices), dtype=bool)
+    n_gaps = rng.binomial(n_steps * n_devices, min(gap_rate / max(gap_steps, 1), 1.0))
+    starts = rng.integers(0, n_steps, n_gaps)
+    devices = rng.integers(0, n_devices, n_gaps)
+    ends = np.minimum(starts + np.ceil(rng.exponential(gap_steps, n_gaps)).astype(np.int64), n_steps)
+
+    # +1 where an outage starts, -1 where it ends, running sum > 0 inside one
+    edges = np.zeros((n_steps + 1, n_devices), dtype=np.int32)
+    np.add.at(edges, (starts, devices), 1)
+    np.add.at(edges, (ends, devices), -1)
+    return np.cumsum(edges[:-1], axis=0) > 0
+
+
+def generate_chunks(devices=1, days=5, interval=600, end_time=None, seed=None,
+                    noise=1.0, seasonality=1.0, anomaly_rate=0.0, gap_rate=0.0,
+                    gap_length=1800, jitter=0.0, chunk_rows=CHUNK_ROWS):
+    """Yield (SensorColumns, anomaly mask) chunks of synthetic readings.
+
+    `devices` series each report every `interval` seconds over `days` days
+    ending at end_time (default now), in time order. Each device gets its
+    own level and phase offsets on top of daily (and, scaled by
+    `seasonality`, weekly) cycles. `noise` scales the per-reading noise,
+    `anomaly_rate` is the fraction of readings with a spike in one field,
+    `gap_rate` the fraction lost to outages averaging `gap_length`
+    seconds, and `jitter` the max seconds timestamps are shifted by.
+
+    The same seed, end_time and other arguments always produce the same
+    data; with the default end_time the timestamps, and with them the
+    daily and weekly cycles, move with the clock. Each chunk draws from its
+    own random stream, so a different chunk_rows gives different values.
+    """
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % (2 ** 32))
+    end_time = end_time or datetime.now()
+    end_ms = int(np.datetime64(end_time, 'ms').astype(np.int64))
+    interval_ms = int(interval * 1000)
+    n_steps = int(days * MS_PER_DAY // interval_ms)
+    names = device_names(devices)
+
+    # Per-device character, fixed across chunks
+    rng = np.random.default_rng([seed, 0])
+    offsets = {field: rng.normal(0, std * 1.5, devices)
+               for field, (_, _, std) in BASELINES.items()}
+    phases = rng.normal(0, 0.5, devices)  # hours
+
+    steps_per_chunk = n_steps if chunk_rows is None else max(chunk_rows // devices, 1)
+    first_ms = end_ms - (n_steps - 1) * interval_ms
+    for chunk, step0 in enumerate(range(0, n_steps, steps_per_chunk)):
+        rng = np.random.default_rng([seed, chunk + 1])
+        m = min(steps_per_chunk, n_steps - step0)
+
+        # (steps, devices) grids, flattened time-major like real interleaving
+        timestamp = first_ms + (step0 + np.arange(m, dtype=np.int64))[:, None] * interval_ms
+        timestamp = np.broadcast_to(timestamp, (m, devices))
+        if jitter:
+            timestamp = timestamp + rng.integers(-int(jitter * 1000), int(jitter * 1000) + 1, (m, devices))
+        keep = ~_gap_mask(rng, m, devices, gap_rate, gap_length / interval)
+
+        hours = (timestamp % MS_PER_DAY) / MS_PER_HOUR + phases
+        week = ((timestamp // MS_PER_DAY + EPOCH_WEEKDAY) % 7 + hours / 24) / 7
+        values = {}
+        for field, (mean, amplitude, std) in BASELINES.items():
+            daily = amplitude * seasonality * np.sin(np.pi * (hours + PHASE_HOURS[field]) / 12)
+            weekly = 0.2 * amplitude * seasonality * np.sin(2 * np.pi * week)
+            value = mean + offsets[field] + daily + weekly + rng.normal(0, std * noise, (m, devices))
+            values[field] = np.clip(value, *RANGES[field])
+
+        anomalies = rng.random((m, devices)) < anomaly_rate
+        if anomaly_rate > 0:
+            spiked = rng.integers(0, len(SENSOR_FIELDS), (m, devices))
+            for i, field in enumerate(SENSOR_FIELDS):
+                low, high = ANOMALY_SIZES[field]
+                size = rng.uniform(low, high, (m, devices))
+                if field == 'temperature':
+                    size *= rng.choice((-1.0, 1.0), (m, devices))
+                hit = anomalies & (spiked == i)
+                values[field] = np.clip(np.where(hit, values[field] + size, values[field]), *LIMITS[field])
+
+        device = np.broadcast_to(np.arange(devices, dtype=np.int32), (m, devices))
+        columns = SensorColumns.from_arrays(
+            timestamp[keep], device[keep], names,
+            {field: values[field][keep] for field in SENSOR_FIELDS})
+        yield columns, anomalies[keep]
+
+
+def generate(**kwargs):
+    """All synthetic readings as one (SensorColumns, anomaly mask) pair"""
+    kwargs.setdefault('chunk_rows', None)
+    chunks = list(generate_chunks(**kwargs))
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = SensorColumns.concatenate([columns for columns, _ in chunks])
+    anomalies = np.concatenate([anomalies for _, anomalies in chunks] + [np.zeros(0, dtype=bool)])
+    return columns, anomalies
+
+
+def write_mongo(collection, chunks, batch_size=INSERT_BATCH):
+    """Insert generated chunks with unordered bulk inserts; returns the row count"""
+    written = 0
+    for columns, _ in chunks:
+        timestamps = columns.timestamp.astype('datetime64[ms]').astype(object)
+        device_ids = np.asarray(columns.device_ids, dtype=object)[columns.device]
+        values = [columns.values[field].tolist() for field in SENSOR_FIELDS]
+        for start in range(0, len(columns), batch_size):
+            stop = start + batch_size
+            docs = [
+                {'device_id': device_id, 'temperature': t, 'humidity': h,
+                 'air_quality': a, 'timestamp': ts}
+                for device_id, t, h, a, ts in zip(
+                    device_ids[start:stop], values[0][start:stop], values[1][start:stop],
+                    values[2][start:stop], timestamps[start:stop])
+            ]
+            if docs:
+                collection.insert_many(docs, ordered=False)
+                written += len(docs)
+    return written
+
+
+def write_parquet(path, chunks):
+    """Write generated chunks to a Parquet file (one row group per chunk)"""
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([
+        ('device_id', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('timestamp', pyarrow.timestamp('ms')),
+        ('temperature', pyarrow.float64()),
+        ('humidity', pyarrow.float64()),
+        ('air_quality', pyarrow.float64()),
+        ('anomaly', pyarrow.bool_()),
+    ])
+    written = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for columns, anomalies in chunks:
+            arrays = [
+                pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(columns.device, pyarrow.int32()),
+                    pyarrow.array(columns.device_ids, pyarrow.string())),
+                pyarrow.array(columns.timestamp, pyarrow.timestamp('ms')),
+            ]
+            arrays += [pyarrow.array(columns.values[field]) for field in SENSOR_FIELDS]
+            arrays.append(pyarrow.array(anomalies))
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            written += len(columns)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic sensor data")
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--days', type=float, default=5)
+    parser.add_argument('--interval', type=float, default=600, help="seconds between readings")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        help="time of the last readings (default now); give it with --seed to "
+                             "reproduce a dataset")
+    parser.add_argument('--noise', type=float, default=1.0, help="noise scale")
+    parser.add_argument('--seasonality', type=float, default=1.0, help="daily/weekly cycle scale")
+    parser.add_argument('--anomaly-rate', type=float, default=0.0)
+    parser.add_argument('--gap-rate', type=float, default=0.0, help="fraction of readings lost to outages")
+    parser.add_argument('--gap-length', type=float, default=1800, help="mean outage length in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="max timestamp jitter in seconds")
+    parser.add_argument('--mongo', action='store_true', help="insert into iot_monitoring.sensor_data")
+    parser.add_argument('--collection', default='sensor_data')
+    parser.add_argument('--parquet', help="write to this Parquet file")
+    args = parser.parse_args()
+
+    chunks = generate_chunks(
+        devices=args.devices, days=args.days, interval=args.interval, end_time=args.end, seed=args.seed,
+        noise=args.noise, seasonality=args.seasonality, anomaly_rate=args.anomaly_rate,
+        gap_rate=args.gap_rate, gap_length=args.gap_length, jitter=args.jitter)
+
+    if args.parquet:
+        written = write_parquet(args.parquet, chunks)
+        print(f"Wrote {written} rows to {args.parquet}")
+    elif args.mongo:
+        import pymongo
+        client = pymongo.MongoClient("mongodb://localhost:27017/")
+        written = write_mongo(client["iot_monitoring"][args.collection], chunks)
+        print(f"Inserted {written} readings into {args.collection}")
+    else:
+        rows = sum(len(columns) for columns, _ in chunks)
+        print(f"Generated {rows} readings (use --mongo or --parquet to keep them)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,127 +1,93 @@
+import os
 import pandas as pd
 import numpy as np
 import joblib
 from datetime import datetime, timedelta
 import pymongo
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_squared_error, r2_score
+from inference_engine import engine_for, legacy_heads
+from model_bundle import ModelBundle, new_version, save_bundle
+from data_loader import load_window, training_arrays
+from feature_store import MODEL_FEATURE_NAMES, standalone_features
+from synthetic_data import generate as generate_synthetic
+from model_selection import DEFAULT_CANDIDATE, fit_heads, time_split
 
 # MongoDB connection
 client = pymongo.MongoClient("mongodb://localhost:27017/")
 db = client["iot_monitoring"]
 sensor_data_collection = db["sensor_data"]
 
+# Only the most recent readings are used for training; days older than
+# COLD_STORAGE_AGE_DAYS are read from the Parquet archive (see cold_storage)
+TRAINING_WINDOW = timedelta(days=int(os.environ.get("TRAINING_WINDOW_DAYS", "30")))
+
 def generate_sample_data(days=5, readings_per_hour=6):
     """Generate sample data for initial model training"""
-    data = []
-    now = datetime.now()
-    
-    for day in range(days):
-        for hour in range(24):
-            for reading in range(readings_per_hour):
-                timestamp = now - timedelta(days=day, hours=hour, minutes=reading*(60//readings_per_hour))
-                
-                # Generate reasonable values with daily patterns
-                # Temperature: cooler at night, warmer during day
-                base_temp = 22 + 5 * np.sin(np.pi * hour / 12)
-                temp = base_temp + np.random.normal(0, 1)
-                
-                # Humidity: higher at night, lower during day
-                base_humid = 50 + 10 * np.sin(np.pi * (hour + 18) / 12)
-                humid = base_humid + np.random.normal(0, 3)
-                
-                # Air quality: worse during peak hours
-                base_air = 500 + 100 * np.sin(np.pi * hour / 12)
-                air_quality = base_air + np.random.normal(0, 50)
-                
-                # Ensure values in reasonable ranges
-                temp = max(15, min(30, temp))
-                humid = max(30, min(70, humid))
-                air_quality = max(300, min(800, air_quality))
-                
-                data.append({
-                    'timestamp': timestamp,
-                    'temperature': temp,
-                    'humidity': humid,
-                    'air_quality': air_quality
-                })
-    
-    return pd.DataFrame(data)
+    # Daily patterns: warmer and worse air during the day, more humid at night
+    columns, _ = generate_synthetic(days=days, interval=3600 // readings_per_hour)
+    return pd.DataFrame({
+        'timestamp': pd.to_datetime(columns.timestamp, unit='ms'),
+        'temperature': columns.values['temperature'],
+        'humidity': columns.values['humidity'],
+        'air_quality': columns.values['air_quality'],
+    })
 
 def get_real_data():
-    """Get real data from MongoDB"""
-    cursor = sensor_data_collection.find()
-    data = list(cursor)
+    """Get real data from MongoDB as NumPy columns (see data_loader)"""
+    start_time = datetime.now() - TRAINING_WINDOW
+    data = load_window(db, start_time)
     
-    if not data:
+    if len(data) == 0:
         print("No real data found, using generated sample data.")
-        return generate_sample_data()
+        columns, _ = generate_synthetic(days=5, interval=600)
+        return columns
     
-    return pd.DataFrame(data)
+    return data
 
-def preprocess_data(df):
+def preprocess_data(data):
     """Preprocess data for model training"""
-    # Sort by timestamp
-    df = df.sort_values('timestamp')
-    
-    # Extract time features
-    df['hour'] = df['timestamp'].dt.hour
-    df['day_of_week'] = df['timestamp'].dt.dayofweek
-    
-    # Create target variables (next hour predictions)
-    # Assuming readings every 10 minutes, shift by 6 to get 1 hour ahead
-    df['next_temp'] = df['temperature'].shift(-6)
-    df['next_humid'] = df['humidity'].shift(-6)
-    df['next_air_quality'] = df['air_quality'].shift(-6)
+    # Time and rolling-window features plus the same device's reading one hour
+    # later as targets, matched on timestamps rather than a fixed number of rows
+    features, targets, timestamps = training_arrays(data, with_timestamps=True)
     
-    # Drop rows with NaN in target
-    df = df.dropna()
+    df = pd.DataFrame(features, columns=MODEL_FEATURE_NAMES)
+    df['timestamp'] = pd.to_datetime(timestamps, unit='ms')
+    df['next_temp'] = targets[:, 0]
+    df['next_humid'] = targets[:, 1]
+    df['next_air_quality'] = targets[:, 2]
     
     return df
 
 def train_models(df):
     """Train prediction models"""
     # Define features and targets
-    features = df[['temperature', 'humidity', 'air_quality', 'hour', 'day_of_week']]
-    temp_target = df['next_temp']
-    humid_target = df['next_humid']
-    air_quality_target = df['next_air_quality']
-    
-    # Split data
-    X_train, X_test, y_temp_train, y_temp_test = train_test_split(
-        features, temp_target, test_size=0.2, random_state=42)
-    _, _, y_humid_train, y_humid_test = train_test_split(
-        features, humid_target, test_size=0.2, random_state=42)
-    _, _, y_air_train, y_air_test = train_test_split(
-        features, air_quality_target, test_size=0.2, random_state=42)
+    features = df[MODEL_FEATURE_NAMES].to_numpy()
+    targets = df[['next_temp', 'next_humid', 'next_air_quality']].to_numpy()
+    
+    # One split for all targets: test on the newest readings, train on older ones
+    X_train, X_test, y_train, y_test = time_split(features, targets, df['timestamp'].to_numpy())
     
     # Scale features
     scaler = StandardScaler()
     X_train_scaled = scaler.fit_transform(X_train)
     X_test_scaled = scaler.transform(X_test)
     
-    # Train temperature model
-    temp_model = RandomForestRegressor(n_estimators=100, random_state=42)
-    temp_model.fit(X_train_scaled, y_temp_train)
+    # Train one forest per target, each building its trees on all cores
+    heads = fit_heads(DEFAULT_CANDIDATE, X_train_scaled, y_train, n_jobs=-1)
+    temp_model, humid_model, air_quality_model = (model for model, _ in heads)
+    
     temp_preds = temp_model.predict(X_test_scaled)
-    temp_rmse = np.sqrt(mean_squared_error(y_temp_test, temp_preds))
-    temp_r2 = r2_score(y_temp_test, temp_preds)
+    temp_rmse = np.sqrt(mean_squared_error(y_test[:, 0], temp_preds))
+    temp_r2 = r2_score(y_test[:, 0], temp_preds)
     
-    # Train humidity model
-    humid_model = RandomForestRegressor(n_estimators=100, random_state=42)
-    humid_model.fit(X_train_scaled, y_humid_train)
     humid_preds = humid_model.predict(X_test_scaled)
-    humid_rmse = np.sqrt(mean_squared_error(y_humid_test, humid_preds))
-    humid_r2 = r2_score(y_humid_test, humid_preds)
+    humid_rmse = np.sqrt(mean_squared_error(y_test[:, 1], humid_preds))
+    humid_r2 = r2_score(y_test[:, 1], humid_preds)
     
-    # Train air quality model
-    air_quality_model = RandomForestRegressor(n_estimators=100, random_state=42)
-    air_quality_model.fit(X_train_scaled, y_air_train)
     air_preds = air_quality_model.predict(X_test_scaled)
-    air_rmse = np.sqrt(mean_squared_error(y_air_test, air_preds))
-    air_r2 = r2_score(y_air_test, air_preds)
+    air_rmse = np.sqrt(mean_squared_error(y_test[:, 2], air_preds))
+    air_r2 = r2_score(y_test[:, 2], air_preds)
     
     # Print model performance
     print(f"Temperature Model - RMSE: {temp_rmse:.2f}, R²: {temp_r2:.2f}")
@@ -134,7 +100,12 @@ def train_models(df):
     joblib.dump(air_quality_model, 'models/air_quality_model.pkl')
     joblib.dump(scaler, 'models/scaler.pkl')
     
-    print("Models saved successfully")
+    # Also save as a versioned bundle, which the processor loads first
+    version = save_bundle(ModelBundle(
+        new_version(), legacy_heads(temp_model, humid_model, air_quality_model), scaler,
+        metadata={'trained_at': datetime.now(), 'n_samples': len(X_train)}))
+    
+    print(f"Models saved successfully (bundle version {version})")
     
     return temp_model, humid_model, air_quality_model, scaler
 
@@ -188,20 +159,14 @@ def get_device_recommendations(comfort, reasons):
 def infer_on_new_data(temp, humid, air_quality, hour, day_of_week, 
                       temp_model, humid_model, air_model, scaler):
     """Make predictions on new data"""
-    # Create feature vector
-    # features = np.array([[temp, humid, air_quality, hour, day_of_week]])
-    features = pd.DataFrame([[
-    temp, humid, air_quality, hour, day_of_week
-    ]], columns=['temperature', 'humidity', 'air_quality', 'hour', 'day_of_week'])
-
-    
-    # Scale features
-    scaled_features = scaler.transform(features)
+    # Create feature vector; without history the rolling windows read as flat,
+    # and scaling is folded into the compiled engine
+    features = standalone_features(
+        {'temperature': temp, 'humidity': humid, 'air_quality': air_quality}, hour, day_of_week)
     
     # Make predictions
-    temp_pred = temp_model.predict(scaled_features)[0]
-    humid_pred = humid_model.predict(scaled_features)[0]
-    air_pred = air_model.predict(scaled_features)[0]
+    engine = engine_for(temp_model, humid_model, air_model, scaler)
+    temp_pred, humid_pred, air_pred = engine.predict_one(features[:engine.n_features]).tolist()
     
     # Current comfort level
     current_comfort, current_reasons = determine_comfort_level(temp, humid, air_quality)
@@ -233,7 +198,6 @@ def infer_on_new_data(temp, humid, air_quality, hour, day_of_week,
 def main():
     """Main function to train and test models"""
     # Create models directory if it doesn't exist
-    import os
     if not os.path.exists('models'):
         os.makedirs('models')
     
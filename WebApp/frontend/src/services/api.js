@@ -64,4 +64,44 @@ export const fetchDashboardSummary = async () => {
     console.error('Error fetching dashboard summary:', error);
     throw error;
   }
-};
\ No newline at end of file
+};
+
+// Live updates pushed by /api/stream. Handlers receive the parsed event data;
+// the browser reconnects on its own and resumes from the last event it saw.
+// Returns a function that closes the stream.
+export const subscribeToStream = ({
+  deviceId,
+  since,
+  onReading,
+  onPrediction,
+  onDevices,
+  onError,
+} = {}) => {
+  const params = new URLSearchParams();
+  if (deviceId) params.set('device_id', deviceId);
+  if (since) params.set('since', since instanceof Date ? since.toISOString() : since);
+  const query = params.toString();
+  const source = new EventSource(`${API_BASE_URL}/stream${query ? `?${query}` : ''}`);
+
+  const listen = (type, handler) => {
+    if (!handler) return;
+    source.addEventListener(type, (event) => {
+      try {
+        handler(JSON.parse(event.data));
+      } catch (error) {
+        console.error(`Error parsing ${type} event:`, error);
+      }
+    });
+  };
+
+  listen('reading', onReading);
+  listen('prediction', onPrediction);
+  listen('devices', onDevices);
+
+  source.onerror = (error) => {
+    console.error('Stream connection error:', error);
+    if (onError) onError(error);
+  };
+
+  return () => source.close();
+};